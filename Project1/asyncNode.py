@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains a node runtime built on asyncio. It does the same job as the
+# listener, the senders, and the share log thread in main.py, but all of the
+# connections and the gossip run as tasks on one event loop. The frames and codec
+# negotiation are the same as in connections.py so it can talk to threaded nodes.
+# Since a node only needs an event loop, many logical nodes can be run in a single
+# process for scale testing.
+#
+# Example usage:
+# - "python ./asyncNode.py 20" runs 20 nodes on localhost until they converge
+# - "python ./asyncNode.py 50 3 2" runs 50 nodes sending to 3 random peers every 2 seconds
+
+import asyncio
+import random
+import sys
+import threading
+import time
+
+import connections
+import codec
+import ourCalendar
+import distributedLog
+import gossip
+
+
+defaultGossipInterval = 5.0 # in seconds, the average time between gossip rounds
+defaultGossipJitter   = 0.2 # the fraction the interval is randomly changed by each round
+connectTimeout = 3.0 # in seconds
+sendTimeout    = 3.0 # in seconds, how long to wait for a peer to take a message
+snapshotChunksPerSend = 8 # the most snapshot chunks sent to a peer each round
+
+
+async def readFrame(reader):
+  # Reads one frame from the stream and returns its message as bytes.
+  # Returns None if the stream has been closed.
+  try:
+    header = await reader.readexactly(connections.frameHeader.size)
+    length = connections.frameHeader.unpack(header)[0]
+    if length > connections.maxFrameSize:
+      raise ConnectionError("frame of %d bytes is too big"%(length))
+    return await reader.readexactly(length)
+  except asyncio.IncompleteReadError:
+    return None
+
+
+class asyncNode:
+  # This is a node for the given distributed log which listens on its own host and port
+  # and gossips with the other nodes. The fan-out is the number of random peers sent to
+  # each round, or None to send to all of them. If a gossip scheduler is given, it picks
+  # the peers to send to instead of the fan-out and interval.
+
+  def __init__(self, log, nodeId, nodeIdToHostsAndPorts, useMyHost=False, codecs=None,
+               fanOut=None, gossipInterval=None, gossipJitter=None, gossipScheduler=None):
+    self.__log = log
+    self.__nodeId = nodeId
+    self.__hostsAndPorts = nodeIdToHostsAndPorts
+    self.__useMyHost = useMyHost
+    self.__codecs = codecs if codecs else [connections.codecJson]
+    self.__fanOut = fanOut
+    self.__gossipInterval = gossipInterval if gossipInterval is not None else defaultGossipInterval
+    self.__gossipJitter = gossipJitter if gossipJitter is not None else defaultGossipJitter
+    self.__random = random.Random()
+    self.__scheduler = gossipScheduler
+    self.sendMessages = True
+
+    self.__server = None
+    self.__gossipTask = None
+    self.__peers = {} # node Id to [writer, codec] for the connected peers
+    self.__connections = {} # the incoming connections' writers to the tasks reading them
+
+    self.__loop = None
+    self.__thread = None
+
+
+  async def start(self):
+    # Starts listening for connections and the gossip task.
+    parts = self.__hostsAndPorts[self.__nodeId].split(':')
+    host = parts[0] if self.__useMyHost else None
+    self.__server = await asyncio.start_server(self.__handleConnection, host, int(parts[1]))
+    self.__gossipTask = asyncio.ensure_future(self.__gossip())
+
+
+  async def close(self):
+    # Stops the gossip, the listener, and closes all the connections.
+    if self.__gossipTask:
+      self.__gossipTask.cancel()
+      try:
+        await self.__gossipTask
+      except asyncio.CancelledError:
+        pass
+    if self.__server:
+      self.__server.close()
+    for writer, peerCodec in self.__peers.values():
+      writer.close()
+    self.__peers = {}
+    # Closing the incoming connections ends their reading tasks, wait for them
+    # to finish so that none are left running when the event loop stops.
+    tasks = list(self.__connections.values())
+    for writer in list(self.__connections):
+      writer.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if self.__server:
+      await self.__server.wait_closed()
+
+
+  async def __handleConnection(self, reader, writer):
+    # Reads the messages from a connection from another node. This does the
+    # same as `connections.inConnection` including replying to the codec hello.
+    self.__connections[writer] = asyncio.current_task()
+    peerCodec = connections.codecJson
+    first = True
+    try:
+      while True:
+        frame = await readFrame(reader)
+        if frame is None:
+          break
+        if first:
+          first = False
+          if frame.startswith(connections.codecHello):
+            offered = frame[len(connections.codecHello):].decode().split(" ")
+            peerCodec = self.__pickCodec(offered)
+            writer.write(connections.frameMessage(connections.codecPicked + peerCodec.encode()))
+            continue
+        connections.receivedMessages.inc()
+        connections.receivedBytes.inc(len(frame))
+        if peerCodec == connections.codecJson:
+          fromNodeId = self.__log.receiveMessage(frame.decode())
+        else:
+          fromNodeId = self.__log.receiveMessage(frame)
+        if self.__scheduler:
+          self.__scheduler.received(fromNodeId, time.time())
+    except (ConnectionError, OSError) as e:
+      print("Listener connection closed: %s"%(e))
+    finally:
+      self.__connections.pop(writer, None)
+      writer.close()
+
+
+  def __pickCodec(self, offered):
+    # Picks the sender's most preferred codec which this node can use.
+    for name in offered:
+      if name in self.__codecs:
+        return name
+    return connections.codecJson
+
+
+  async def __connect(self, nodeId):
+    # Connects to the given peer and negotiates the codec.
+    # Returns the [writer, codec] for the peer or None if it couldn't connect.
+    parts = self.__hostsAndPorts[nodeId].split(':')
+    try:
+      reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts[0], int(parts[1])), connectTimeout)
+    except (asyncio.TimeoutError, OSError):
+      return None
+
+    peerCodec = connections.codecJson
+    if self.__codecs != [connections.codecJson]:
+      writer.write(connections.frameMessage(connections.codecHello + " ".join(self.__codecs).encode()))
+      try:
+        reply = await asyncio.wait_for(readFrame(reader), connections.codecReplyTimeout)
+      except (asyncio.TimeoutError, OSError):
+        reply = None
+      if reply and reply.startswith(connections.codecPicked):
+        name = reply[len(connections.codecPicked):].decode()
+        if name in self.__codecs:
+          peerCodec = name
+    peer = [writer, peerCodec]
+    self.__peers[nodeId] = peer
+    return peer
+
+
+  async def __sendTo(self, nodeId):
+    # Sends the gossip message to the given peer, connecting first if needed.
+    peer = self.__peers.get(nodeId)
+    if not peer:
+      peer = await self.__connect(nodeId)
+      if not peer:
+        return
+    writer, peerCodec = peer
+    msgs = self.__log.getSnapshotMessages(nodeId, snapshotChunksPerSend)
+    msgs.append(self.__log.getSendMessage(nodeId, True, peerCodec == codec.BinaryCodec))
+    try:
+      for msg in msgs:
+        writer.write(connections.frameMessage(msg))
+      await asyncio.wait_for(writer.drain(), sendTimeout)
+    except (asyncio.TimeoutError, OSError):
+      # Lost the connection, it will be reconnected next round.
+      del self.__peers[nodeId]
+      writer.close()
+
+
+  def __pickPeers(self):
+    # Picks the peers to gossip with this round.
+    peers = [nodeId for nodeId in self.__hostsAndPorts if nodeId != self.__nodeId]
+    if (self.__fanOut is None) or (self.__fanOut >= len(peers)):
+      return peers
+    return self.__random.sample(peers, self.__fanOut)
+
+
+  async def gossipOnce(self):
+    # Sends this node's log and time table to the peers picked for this round.
+    if self.__scheduler:
+      peers = self.__scheduler.pickPeers(time.time())
+    else:
+      peers = self.__pickPeers()
+    await asyncio.gather(*[self.__sendTo(nodeId) for nodeId in peers])
+
+
+  async def __gossip(self):
+    # This periodically gossips with the other nodes. The interval is jittered
+    # so that nodes started together don't all send at the same time.
+    while True:
+      if self.__scheduler:
+        await asyncio.sleep(self.__scheduler.tickInterval())
+        if self.sendMessages:
+          await self.gossipOnce()
+        continue
+      jitter = self.__random.uniform(-self.__gossipJitter, self.__gossipJitter)
+      await asyncio.sleep(self.__gossipInterval * (1.0 + jitter))
+      if self.sendMessages:
+        await self.gossipOnce()
+
+
+  def startThread(self):
+    # Runs this node on an event loop in a new thread, used by main.py
+    # so that the menu can keep blocking on user input.
+    self.__loop = asyncio.new_event_loop()
+    started = threading.Event()
+    def run():
+      asyncio.set_event_loop(self.__loop)
+      self.__loop.run_until_complete(self.start())
+      started.set()
+      self.__loop.run_forever()
+      self.__loop.close()
+    self.__thread = threading.Thread(target=run)
+    self.__thread.start()
+    started.wait()
+
+
+  def stopThread(self):
+    # Closes this node and stops the thread started by `startThread`.
+    asyncio.run_coroutine_threadsafe(self.close(), self.__loop).result()
+    self.__loop.call_soon_threadsafe(self.__loop.stop)
+    self.__thread.join()
+
+
+async def runLocalCluster(nodeCount, fanOut, gossipInterval, basePort=18600, timeout=120.0):
+  # Runs the given number of nodes in this process on localhost, inserts one
+  # appointment on each node, then waits until every calendar has all of them.
+  hostsAndPorts = {}
+  for nodeId in range(nodeCount):
+    hostsAndPorts[nodeId] = "127.0.0.1:%d"%(basePort + nodeId)
+
+  cals = []
+  nodes = []
+  for nodeId in range(nodeCount):
+    cal = ourCalendar.calendar(nodeId, False)
+    log = distributedLog.distributedLog(cal, nodeId, nodeCount, False)
+    node = asyncNode(log, nodeId, hostsAndPorts, True, [codec.BinaryCodec, codec.JsonCodec],
+      fanOut, gossipInterval)
+    await node.start()
+    log.insert("appt%d"%(nodeId), nodeId%7 + 1, 12.0, 12.5, [nodeId])
+    cals.append(cal)
+    nodes.append(node)
+
+  start = time.time()
+  converged = False
+  while time.time() - start < timeout:
+    await asyncio.sleep(0.1)
+    calStrs = [cal.toString() for cal in cals]
+    if calStrs[0].count("appt") == nodeCount and calStrs.count(calStrs[0]) == nodeCount:
+      converged = True
+      break
+
+  for node in nodes:
+    await node.close()
+  if converged:
+    print("%d nodes converged in %.2fs"%(nodeCount, time.time() - start))
+  else:
+    print("%d nodes did not converge in %.2fs"%(nodeCount, timeout))
+
+
+if __name__ == "__main__":
+  nodeCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  fanOut = int(sys.argv[2]) if len(sys.argv) > 2 else None
+  gossipInterval = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+  asyncio.run(runLocalCluster(nodeCount, fanOut, gossipInterval))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains the compact binary codec for the distributed log's messages.
+# A binary message decodes to the same list as the JSON message would, so the
+# distributed log handles both the same way once decoded:
+# - full:    [nodeId, tuples, timeTable]
+# - tracked: [nodeId, tuples, timeTable, seq, ack]
+# - delta:   [nodeId, tuples, None, seq, ack, row, cells]
+#
+# The binary layout is the magic byte, the message kind, the node Id, the seq and
+# ack (tracked and delta only), the interned participant lists, the records, then
+# the time table as a dense array (or the row as a dense array and the cells).
+# Integers are varints, the op type is a single byte, and each record refers to
+# its participants by the index of the interned list.
+
+import array
+import struct
+import sys
+
+
+JsonCodec   = "json"
+BinaryCodec = "binary"
+
+# The first byte of every binary message. Since a JSON message always starts
+# with "[" this can be used to tell binary and JSON messages apart.
+binaryMagic = 0xB1
+
+kindFull    = 0
+kindTracked = 1
+kindDelta   = 2
+
+opTypeToByte = {
+  "Insert": 0,
+  "Delete": 1,
+}
+byteToOpType = {
+  0: "Insert",
+  1: "Delete",
+}
+
+# The tags for the values of an appointment (day, start_time, end_time, and participants).
+valueInt   = 0
+valueFloat = 1
+valueStr   = 2
+
+floatStruct = struct.Struct("<d")
+
+
+def isBinary(message):
+  # Determines if the given message is a binary message.
+  return isinstance(message, (bytes, bytearray)) and len(message) > 0 and \
+    bytearray(message[:1])[0] == binaryMagic
+
+
+class writer:
+  # This is a buffer for writing the parts of a binary message.
+
+  def __init__(self):
+    self.data = bytearray()
+
+
+  def byte(self, value):
+    self.data.append(value)
+
+
+  def varint(self, value):
+    # Writes an unsigned integer 7 bits at a time.
+    while value >= 0x80:
+      self.data.append((value & 0x7F) | 0x80)
+      value >>= 7
+    self.data.append(value)
+
+
+  def signed(self, value):
+    # Writes a signed integer as a zigzag encoded varint.
+    self.varint((value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+  def string(self, value):
+    raw = value.encode("utf-8")
+    self.varint(len(raw))
+    self.data.extend(raw)
+
+
+  def value(self, value):
+    # Writes a tagged int, float, or string value.
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      self.byte(valueStr)
+      self.string(str(value))
+    elif isinstance(value, int):
+      self.byte(valueInt)
+      self.signed(value)
+    else:
+      self.byte(valueFloat)
+      self.data.extend(floatStruct.pack(value))
+
+
+  def dense(self, values):
+    # Writes a list of non-negative integers as a dense little-endian 32 or 64 bit array.
+    arr = array.array("I" if (not values) or max(values) <= 0xFFFFFFFF else "Q", values)
+    if sys.byteorder != "little":
+      arr.byteswap()
+    self.byte(arr.itemsize)
+    self.varint(len(values))
+    self.data.extend(arr.tobytes())
+
+
+  def denseMatrix(self, matrix):
+    # Writes a NumPy matrix of non-negative integers the same as `dense` would
+    # write its flattened values, but directly from the matrix's buffer.
+    itemType = "<u4" if (not matrix.size) or int(matrix.max()) <= 0xFFFFFFFF else "<u8"
+    raw = matrix.astype(itemType).tobytes()
+    self.byte(len(raw) // matrix.size if matrix.size else 4)
+    self.varint(matrix.size)
+    self.data.extend(raw)
+
+
+class reader:
+  # This is a cursor for reading the parts of a binary message.
+
+  def __init__(self, data):
+    self.data = bytearray(data)
+    self.offset = 0
+
+
+  def byte(self):
+    value = self.data[self.offset]
+    self.offset += 1
+    return value
+
+
+  def varint(self):
+    value = 0
+    shift = 0
+    data = self.data
+    while True:
+      b = data[self.offset]
+      self.offset += 1
+      value |= (b & 0x7F) << shift
+      if b < 0x80:
+        return value
+      shift += 7
+
+
+  def signed(self):
+    value = self.varint()
+    return (value >> 1) if not (value & 1) else -((value + 1) >> 1)
+
+
+  def string(self):
+    length = self.varint()
+    raw = self.data[self.offset:self.offset+length]
+    self.offset += length
+    return raw.decode("utf-8")
+
+
+  def value(self):
+    tag = self.byte()
+    if tag == valueInt:
+      return self.signed()
+    if tag == valueFloat:
+      value = floatStruct.unpack_from(self.data, self.offset)[0]
+      self.offset += floatStruct.size
+      return value
+    return self.string()
+
+
+  def dense(self):
+    width = self.byte()
+    count = self.varint()
+    arr = array.array("I" if width == 4 else "Q")
+    end = self.offset + count*width
+    arr.frombytes(bytes(self.data[self.offset:end]))
+    if sys.byteorder != "little":
+      arr.byteswap()
+    self.offset = end
+    return arr.tolist()
+
+
+def encodeMessage(msg):
+  # Encodes the given message list into the binary format.
+  w = writer()
+  w.byte(binaryMagic)
+  if len(msg) <= 3:
+    kind = kindFull
+  elif msg[2] is not None:
+    kind = kindTracked
+  else:
+    kind = kindDelta
+  w.byte(kind)
+  w.varint(msg[0])
+  if kind != kindFull:
+    w.varint(msg[3])
+    w.varint(msg[4])
+
+  # Intern the participant lists since the same groups of people tend to meet.
+  tuples = msg[1]
+  internIndex = {}
+  interned = []
+  for logTuple in tuples:
+    if logTuple[2] == "Insert":
+      key = tuple(logTuple[3][4])
+      if key not in internIndex:
+        internIndex[key] = len(interned)
+        interned.append(key)
+  w.varint(len(interned))
+  for participants in interned:
+    w.varint(len(participants))
+    for participant in participants:
+      w.value(participant)
+
+  w.varint(len(tuples))
+  for logTuple in tuples:
+    opType = logTuple[2]
+    opArgs = logTuple[3]
+    w.varint(logTuple[0])
+    w.varint(logTuple[1])
+    w.byte(opTypeToByte[opType])
+    w.string(opArgs[0])
+    if opType == "Insert":
+      w.value(opArgs[1])
+      w.value(opArgs[2])
+      w.value(opArgs[3])
+      w.varint(internIndex[tuple(opArgs[4])])
+
+  if kind != kindDelta:
+    timeTable = msg[2]
+    w.varint(len(timeTable))
+    if hasattr(timeTable, "tobytes"):
+      w.denseMatrix(timeTable)
+    else:
+      flat = []
+      for row in timeTable:
+        flat.extend(row)
+      w.dense(flat)
+  else:
+    w.dense(list(msg[5]))
+    cells = msg[6]
+    w.varint(len(cells))
+    for x, y, value in cells:
+      w.varint(x)
+      w.varint(y)
+      w.varint(value)
+  return bytes(w.data)
+
+
+def decodeMessage(data):
+  # Decodes the given binary message into the same list the JSON message would be.
+  r = reader(data)
+  if r.byte() != binaryMagic:
+    raise ValueError("not a binary message")
+  kind = r.byte()
+  nodeId = r.varint()
+  seq = ack = 0
+  if kind != kindFull:
+    seq = r.varint()
+    ack = r.varint()
+
+  interned = []
+  for i in range(r.varint()):
+    interned.append([r.value() for j in range(r.varint())])
+
+  tuples = []
+  for i in range(r.varint()):
+    time = r.varint()
+    recNodeId = r.varint()
+    opType = byteToOpType[r.byte()]
+    name = r.string()
+    if opType == "Insert":
+      day = r.value()
+      start_time = r.value()
+      end_time = r.value()
+      participants = list(interned[r.varint()])
+      tuples.append([time, recNodeId, opType, [name, day, start_time, end_time, participants]])
+    else:
+      tuples.append([time, recNodeId, opType, [name]])
+
+  if kind != kindDelta:
+    n = r.varint()
+    flat = r.dense()
+    timeTable = [flat[x*n:(x+1)*n] for x in range(n)]
+    if kind == kindFull:
+      return [nodeId, tuples, timeTable]
+    return [nodeId, tuples, timeTable, seq, ack]
+
+  row = r.dense()
+  cells = []
+  for i in range(r.varint()):
+    cells.append([r.varint(), r.varint(), r.varint()])
+  return [nodeId, tuples, None, seq, ack, row, cells]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This compares the JSON and binary codecs for the distributed log's messages
+# by the time to encode and decode and the number of bytes sent.
+#
+# Example usage:
+# - "python ./codecBenchmark.py" runs with 10^3 to 10^6 records
+# - "python ./codecBenchmark.py 1000 5000" runs with 1000 then 5000 records
+
+import json
+import random
+import sys
+import time
+
+import codec
+
+
+nodeCount = 5
+groupCount = 100 # The number of different groups of participants
+
+
+def buildMessage(recordCount):
+  # Builds a full message with the given number of records from random nodes.
+  rand = random.Random(recordCount)
+  groups = []
+  for i in range(groupCount):
+    groups.append(sorted(rand.sample(range(nodeCount), rand.randint(1, nodeCount))))
+
+  clocks = [0] * nodeCount
+  tuples = []
+  for i in range(recordCount):
+    nodeId = rand.randrange(nodeCount)
+    clocks[nodeId] += 1
+    if rand.random() < 0.8:
+      day = rand.randint(1, 7)
+      start_time = rand.randint(0, 46) / 2.0
+      end_time = start_time + rand.randint(1, 4) / 2.0
+      opArgs = ["appt%d"%i, day, start_time, end_time, groups[rand.randrange(groupCount)]]
+      tuples.append([clocks[nodeId], nodeId, "Insert", opArgs])
+    else:
+      tuples.append([clocks[nodeId], nodeId, "Delete", ["appt%d"%rand.randrange(i+1)]])
+
+  timeTable = []
+  for i in range(nodeCount):
+    timeTable.append(clocks[:])
+  return [0, tuples, timeTable]
+
+
+def timeIt(method, arg):
+  # Runs the method with the given argument and returns the result and the time it took.
+  start = time.time()
+  result = method(arg)
+  return result, time.time() - start
+
+
+def run(recordCount):
+  msg = buildMessage(recordCount)
+
+  jsonData, jsonEncode = timeIt(json.dumps, msg)
+  jsonMsg, jsonDecode = timeIt(json.loads, jsonData)
+  binaryData, binaryEncode = timeIt(codec.encodeMessage, msg)
+  binaryMsg, binaryDecode = timeIt(codec.decodeMessage, binaryData)
+  if jsonMsg != binaryMsg:
+    print("The binary message didn't decode to the same as the JSON message")
+
+  print("%8d records:"%(recordCount))
+  print("  json:   %12d bytes, encode %8.3fs, decode %8.3fs"%(len(jsonData.encode()), jsonEncode, jsonDecode))
+  print("  binary: %12d bytes, encode %8.3fs, decode %8.3fs"%(len(binaryData), binaryEncode, binaryDecode))
+
+
+if __name__ == "__main__":
+  counts = [int(arg) for arg in sys.argv[1:]]
+  if not counts:
+    counts = [1000, 10000, 100000, 1000000]
+  for count in counts:
+    run(count)
@@ -10,9 +10,15 @@
 import threading
 import time
 import socket
+import collections
+import random
+import selectors
+import struct
 import sys
 import select
 
+import metrics
+
 # helpful links:
 # - https://www.tutorialspoint.com/python/python_multithreading.htm
 # - https://www.geeksforgeeks.org/python-different-ways-to-kill-a-thread/
@@ -21,14 +27,186 @@ import select
 # - https://www.geeksforgeeks.org/start-and-stop-a-thread-in-python/
 
 
+# Every message is sent as a frame, the length of the message as a 4 byte
+# big-endian unsigned integer followed by the message itself.
+frameHeader = struct.Struct(">I")
+maxFrameSize = 1 << 30           # Frames bigger than this are treated as a broken stream
+initialReceiveBufferSize = 65536 # The starting size of a connection's receive buffer
+
+# The codec negotiation. When a sender connects and can use codecs other than JSON,
+# it sends the hello frame with the codecs it can use, in order of preference,
+# separated by spaces. The listener replies with a frame with the codec picked.
+# If the listener doesn't reply, JSON is used.
+codecJson   = "json"
+codecHello  = b"CODECS:"
+codecPicked = b"CODEC:"
+codecReplyTimeout = 3.0 # in seconds
+
+# The most messages a sender will hold waiting to be sent. When full, `send` waits
+# up to `sendWaitTimeout` seconds for room before giving up on the message.
+maxPendingMessages = 64
+sendWaitTimeout = 1.0 # in seconds
+
+# The delay before reconnecting starts at the minimum and doubles after each failed
+# attempt up to the maximum. Each delay is randomly changed by the jitter fraction
+# so that senders which lost their connections together don't reconnect together.
+reconnectMinDelay = 0.1  # in seconds
+reconnectMaxDelay = 10.0 # in seconds
+reconnectJitter   = 0.5
+connectTimeout    = 3.0  # in seconds
+
+# The TCP keepalive settings, used where the platform supports them, so that a
+# dead peer is noticed in about `keepAliveIdle + keepAliveInterval*keepAliveCount` seconds.
+keepAliveIdle     = 10 # in seconds
+keepAliveInterval = 5  # in seconds
+keepAliveCount    = 3
+
+receivedMessages = metrics.getCounter("listener_messages_total", "The number of messages received.")
+receivedBytes    = metrics.getCounter("listener_bytes_total", "The number of bytes of messages received.")
+sentMessages     = metrics.getCounter("sender_messages_total", "The number of messages sent.")
+sentBytes        = metrics.getCounter("sender_bytes_total", "The number of bytes sent.")
+droppedMessages  = metrics.getCounter("sender_dropped_total", "The number of messages dropped without being sent.")
+sendLatency      = metrics.getHistogram("sender_latency_seconds", "The time from a message being queued to being sent.")
+
+
+def tuneSocket(sock):
+  # Turns off Nagle's algorithm, since the messages are already batched into
+  # one send, and turns on TCP keepalive so dead connections are noticed.
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+  if hasattr(socket, "TCP_KEEPIDLE"):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepAliveIdle)
+  if hasattr(socket, "TCP_KEEPINTVL"):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, keepAliveInterval)
+  if hasattr(socket, "TCP_KEEPCNT"):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, keepAliveCount)
+
+
+def frameMessage(message):
+  # Gets the frame, as bytes, for the given message string or bytes.
+  if not isinstance(message, bytes):
+    message = message.encode()
+  return frameHeader.pack(len(message)) + message
+
+
+class frameReader:
+  # This reads frames from a socket into a reusable buffer with `recv_into`.
+  # The buffer grows to fit the largest frame so that big messages are read
+  # straight into place instead of being pieced together from chunks.
+
+  def __init__(self, conn):
+    self.__conn = conn
+    self.__buffer = bytearray(initialReceiveBufferSize)
+    self.__start = 0 # The start of the unread data in the buffer
+    self.__end = 0   # The end of the data read into the buffer
+
+
+  def read(self):
+    # Reads more from the socket and returns a list of the memoryviews of the
+    # frames which have been completed. The memoryviews are only valid until the
+    # next read. This returns None if the socket has been closed.
+    self.__makeRoom()
+    view = memoryview(self.__buffer)
+    count = self.__conn.recv_into(view[self.__end:])
+    if count <= 0:
+      return None
+    self.__end += count
+
+    frames = []
+    while self.__end - self.__start >= frameHeader.size:
+      length = frameHeader.unpack_from(self.__buffer, self.__start)[0]
+      if length > maxFrameSize:
+        raise socket.error("frame of %d bytes is too big"%(length))
+      frameEnd = self.__start + frameHeader.size + length
+      if frameEnd > self.__end:
+        break
+      frames.append(view[self.__start + frameHeader.size:frameEnd])
+      self.__start = frameEnd
+    return frames
+
+
+  def __makeRoom(self):
+    # Moves any partial frame to the front of the buffer and
+    # grows the buffer if the partial frame won't fit.
+    if self.__start == self.__end:
+      self.__start = self.__end = 0
+      return
+    needed = len(self.__buffer)
+    if self.__end - self.__start >= frameHeader.size:
+      length = frameHeader.unpack_from(self.__buffer, self.__start)[0]
+      needed = max(needed, frameHeader.size + min(length, maxFrameSize))
+    if (self.__start > 0) or (needed > len(self.__buffer)):
+      remaining = self.__buffer[self.__start:self.__end]
+      if needed > len(self.__buffer):
+        self.__buffer = bytearray(needed)
+      self.__buffer[:len(remaining)] = remaining
+      self.__start = 0
+      self.__end = len(remaining)
+
+
+class inConnection:
+  # This is the state of a connection from a talker, used by both listeners.
+  # It reads the frames, deals with the codec hello, and passes the messages on.
+
+  def __init__(self, conn, handleMethod, codecs):
+    self.__conn = conn
+    self.__handleMethod = handleMethod
+    self.__codecs = codecs
+    self.__reader = frameReader(conn)
+    self.__codec = codecJson
+    self.__first = True
+
+
+  def read(self):
+    # Reads from the connection once and handles any completed messages.
+    # Returns false if the talker has closed the connection.
+    frames = self.__reader.read()
+    if frames is None:
+      return False
+    for frame in frames:
+      if self.__first:
+        self.__first = False
+        if frame[:len(codecHello)] == codecHello:
+          # The first message is the codec hello, pick a codec and reply.
+          offered = frame[len(codecHello):].tobytes().decode().split(" ")
+          self.__codec = self.__pickCodec(offered)
+          self.__conn.sendall(frameMessage(codecPicked + self.__codec.encode()))
+          continue
+
+      # Got a message send it to the handle method. A bad message is logged and
+      # skipped so it doesn't stop the other messages or connections being handled.
+      receivedMessages.inc()
+      receivedBytes.inc(len(frame))
+      try:
+        if self.__codec == codecJson:
+          self.__handleMethod(str(frame, "utf-8"))
+        else:
+          self.__handleMethod(frame.tobytes())
+      except Exception as e:
+        print("Exception in handler of message: %s"%(e))
+    return True
+
+
+  def __pickCodec(self, offered):
+    # Picks the sender's most preferred codec which this listener can use.
+    for name in offered:
+      if name in self.__codecs:
+        return name
+    return codecJson
+
+
 class listener:
   # This is a class to listen for incoming messages sent to the given host and port.
   # This will callback to the given method, `handleMethod`, for handling messages.
 
-  def __init__(self, handleMethod, hostAndPort, useMyHost):
+  def __init__(self, handleMethod, hostAndPort, useMyHost, codecs=None):
     # Creates a new listener to the given host and port.
+    # The codecs are the ones the `handleMethod` can take.
+    # Messages for a connection using JSON are given to the handle method
+    # as strings, any other codec's messages are given as bytes.
     self.__handleMethod = handleMethod
     self.__timeToDie = False
+    self.__codecs = codecs if codecs else [codecJson]
 
     parts = hostAndPort.split(':')
     host = parts[0] if useMyHost else ""
@@ -48,6 +226,7 @@ class listener:
       try:
         sock.settimeout(1)
         conn, addr = sock.accept()
+        tuneSocket(conn)
 
         thread = threading.Thread(target=self.__connection, args=(conn, addr))
         thread.start()
@@ -59,32 +238,126 @@ class listener:
   def __connection(self, conn, addr):
     # This method handles a connection from a talker and listens to it.
     conn.settimeout(1)
+    incoming = inConnection(conn, self.__handleMethod, self.__codecs)
     while not self.__timeToDie:
       try:
-        data = conn.recv(4096)
-        if data:
-          # Got a message send it to the handle method.
-          self.__handleMethod(data.decode())
+        if not incoming.read():
+          # The talker closed the connection.
+          break
       except socket.timeout: 
         continue
+      except socket.error as e:
+        print("Listener connection closed: %s"%(e))
+        break
+    conn.close()
+
+
+  def close(self):
+    # This starts shutting down the listener.
+    self.__timeToDie = True
+
+
+class selectorListener:
+  # This is a listener which handles all of the incoming connections on a single thread
+  # using a selector instead of a thread per connection. It takes the same arguments
+  # and calls `handleMethod` the same way as `listener` so either can be used.
+
+  def __init__(self, handleMethod, hostAndPort, useMyHost, codecs=None):
+    # Creates a new listener to the given host and port.
+    self.__handleMethod = handleMethod
+    self.__timeToDie = False
+    self.__codecs = codecs if codecs else [codecJson]
+
+    # This socket pair is used to wake up the selector when closing.
+    self.__wakeReader, self.__wakeWriter = socket.socketpair()
+
+    parts = hostAndPort.split(':')
+    host = parts[0] if useMyHost else ""
+    port = int(parts[1])
+
+    thread = threading.Thread(target=self.__run, args=(host, port))
+    thread.start()
+
+
+  def __run(self, host, port):
+    # This method runs in a separete thread to accept new connections
+    # and read from all the connections whenever they are ready.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, port))
+    sock.listen(16)
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, None)
+    selector.register(self.__wakeReader, selectors.EVENT_READ, None)
+    while not self.__timeToDie:
+      for key, events in selector.select():
+        if key.fileobj is sock:
+          conn, addr = sock.accept()
+          tuneSocket(conn)
+          conn.settimeout(1)
+          selector.register(conn, selectors.EVENT_READ, inConnection(conn, self.__handleMethod, self.__codecs))
+        elif key.data:
+          self.__read(selector, key.fileobj, key.data)
+
+    for key in list(selector.get_map().values()):
+      if key.data:
+        key.fileobj.close()
+    selector.close()
+    sock.close()
+    self.__wakeReader.close()
+
+
+  def __read(self, selector, conn, incoming):
+    # Reads from a connection which is ready, closing it if the talker has.
+    try:
+      if incoming.read():
+        return
+    except socket.timeout:
+      return
+    except socket.error as e:
+      print("Listener connection closed: %s"%(e))
+    selector.unregister(conn)
     conn.close()
 
 
   def close(self):
     # This starts shutting down the listener.
+    # The listener may have already woken up and stopped, so ignore send errors.
     self.__timeToDie = True
+    try:
+      self.__wakeWriter.send(b"x")
+    except socket.error:
+      pass
+    self.__wakeWriter.close()
 
 
 class sender:
   # This is a class to send messages out the given host and port.
   # This will have a queue of messages which are sent when they can be.
+  # The queue is kept while reconnecting so messages aren't lost to a short
+  # network problem. Messages sent with `coalesce` replace the older such
+  # message still in the queue, since a newer gossip message supersedes it.
 
-  def __init__(self, hostAndPort):
+  def __init__(self, hostAndPort, codecs=None):
     # Creates a new sender to the given host and port.
+    # The codecs are the ones this sender can use in order of preference,
+    # the one used is negotiated with the listener when connecting.
+    self.__codecs = codecs if codecs else [codecJson]
+    self.__codec = codecJson
     self.__connected = False
     self.__timeToDie = False
     self.__queueLock = threading.Lock()
-    self.__pendingQueue = []
+    self.__queueChanged = threading.Condition(self.__queueLock)
+    self.__pendingQueue = collections.deque() # (message, time it was queued, coalesce)
+    self.__random = random.Random()
+
+    # Statistics about the messages sent.
+    self.__sentCount = 0
+    self.__sentBytes = 0
+    self.__sendCalls = 0
+    self.__droppedCount = 0
+    self.__totalLatency = 0.0
+    self.__maxLatency = 0.0
 
     parts = hostAndPort.split(':')
     host = parts[0]
@@ -97,48 +370,186 @@ class sender:
   def __run(self, host, port):
     # This method runs in a separete thread to talk to the socket.
     # Any messages in the queue will be sent out the socket.
+    delay = reconnectMinDelay
     while not self.__timeToDie:
+      sock = None
+      pending = []
       try:
         # Prepare to try to connect/reconnect
         self.__connected = False
-        with self.__queueLock:
-          if self.__pendingQueue:
-            self.__pendingQueue.clear()
-
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
+        tuneSocket(sock)
+        sock.settimeout(connectTimeout)
         sock.connect((host, port))
+        codec = self.__negotiateCodec(sock)
+        sock.settimeout(None)
+        self.__codecChanged(codec)
         self.__connected = True
+        delay = reconnectMinDelay
 
         while not self.__timeToDie:
-          # Check if there are any pending messages and send all of them.
+          # Wait until there are pending messages then take all of them.
           with self.__queueLock:
-            while self.__pendingQueue:
-              message = self.__pendingQueue.pop(0)
-              sock.sendall(message.encode())
+            while (not self.__pendingQueue) and (not self.__timeToDie):
+              self.__queueChanged.wait()
+            pending = list(self.__pendingQueue)
+            self.__pendingQueue.clear()
+            self.__queueChanged.notify_all()
+          if not pending:
+            continue
 
-          # Sleep for a bit to let new messages get pended.
-          time.sleep(1)
+          # Send all of the messages together with one call.
+          data = b"".join([frameMessage(message) for message, queued, coalesce in pending])
+          sock.sendall(data)
+          self.__recordSent(pending, len(data))
+          pending = []
 
         # Close socket and exit thread
         sock.close()
         return
 
-      except socket.timeout:
-        time.sleep(1)
       except socket.error:
-        # Failed to connect or lost connection, wait a little bit then try again.
-        time.sleep(3)
-
-
-  def send(self, message):
+        # Failed to connect or lost connection, put back any messages which
+        # weren't sent then wait a little bit, longer each time, and try again.
+        self.__connected = False
+        if sock:
+          sock.close()
+        self.__requeue(pending)
+        jitter = self.__random.uniform(-reconnectJitter, reconnectJitter)
+        with self.__queueLock:
+          if not self.__timeToDie:
+            self.__queueChanged.wait(delay * (1.0 + jitter))
+        delay = min(delay * 2.0, reconnectMaxDelay)
+
+
+  def __requeue(self, pending):
+    # Puts the messages which failed to send back at the front of the queue.
+    # A coalescing message is dropped if a newer one has been queued since.
+    with self.__queueLock:
+      hasCoalesce = any(coalesce for message, queued, coalesce in self.__pendingQueue)
+      for item in reversed(pending):
+        if item[2] and hasCoalesce:
+          self.__drop(1)
+          continue
+        hasCoalesce = hasCoalesce or item[2]
+        self.__pendingQueue.appendleft(item)
+      while len(self.__pendingQueue) > maxPendingMessages:
+        self.__pendingQueue.pop()
+        self.__drop(1)
+      self.__queueChanged.notify_all()
+
+
+  def __codecChanged(self, codec):
+    # Sets the codec for the new connection. If the listener can't take the codec
+    # the queued messages were encoded with, the queued binary messages are dropped.
+    with self.__queueLock:
+      self.__codec = codec
+      if codec == codecJson:
+        kept = [item for item in self.__pendingQueue if not isinstance(item[0], bytes)]
+        self.__drop(len(self.__pendingQueue) - len(kept))
+        self.__pendingQueue = collections.deque(kept)
+
+
+  def __drop(self, count):
+    # Counts messages which were dropped, the queue lock must be held.
+    self.__droppedCount += count
+    droppedMessages.inc(count)
+
+
+  def __negotiateCodec(self, sock):
+    # Sends the codec hello and waits for the listener to pick one.
+    # If only JSON can be used then there is nothing to negotiate.
+    if self.__codecs == [codecJson]:
+      return codecJson
+    sock.sendall(frameMessage(codecHello + " ".join(self.__codecs).encode()))
+    reader = frameReader(sock)
+    frames = []
+    try:
+      sock.settimeout(codecReplyTimeout)
+      while frames is not None and not frames:
+        frames = reader.read()
+    except socket.timeout:
+      pass
+    if frames:
+      reply = frames[0].tobytes()
+      if reply.startswith(codecPicked):
+        name = reply[len(codecPicked):].decode()
+        if name in self.__codecs:
+          return name
+    return codecJson
+
+
+  def __recordSent(self, pending, byteCount):
+    # Updates the statistics for messages which have been sent.
+    now = time.time()
+    sentMessages.inc(len(pending))
+    sentBytes.inc(byteCount)
+    with self.__queueLock:
+      self.__sendCalls += 1
+      self.__sentBytes += byteCount
+      for message, queued, coalesce in pending:
+        latency = now - queued
+        sendLatency.observe(latency)
+        self.__sentCount += 1
+        self.__totalLatency += latency
+        self.__maxLatency = max(self.__maxLatency, latency)
+
+
+  def getStats(self):
+    # Gets the statistics about the messages sent. The latency is the time,
+    # in seconds, between a message being queued and it being sent.
+    with self.__queueLock:
+      averageLatency = self.__totalLatency / self.__sentCount if self.__sentCount else 0.0
+      return {
+        'Sent':           self.__sentCount,
+        'Bytes':          self.__sentBytes,
+        'SendCalls':      self.__sendCalls,
+        'Dropped':        self.__droppedCount,
+        'Pending':        len(self.__pendingQueue),
+        'AverageLatency': averageLatency,
+        'MaxLatency':     self.__maxLatency,
+      }
+
+
+  def getCodec(self):
+    # Gets the codec which was negotiated for the current connection.
+    return self.__codec
+
+
+  def send(self, message, coalesce=False):
     # Adds the message to the pending messages to be send out the socket.
-    # If this is not connected, the message will be ignored.
-    if self.__connected:
-      with self.__queueLock:
-        self.__pendingQueue.append(message)
+    # The message is a string for JSON or bytes for any other codec.
+    # If coalesce is true, any older coalescing message still queued is replaced.
+    # If the queue is full this waits a little while for room, unless this isn't
+    # connected, then the oldest message is dropped to make room.
+    # Returns true if the message was queued, false if it was dropped
+    # because the queue stayed full.
+    with self.__queueLock:
+      if coalesce:
+        for i in range(len(self.__pendingQueue)):
+          if self.__pendingQueue[i][2]:
+            del self.__pendingQueue[i]
+            self.__drop(1)
+            break
+
+      deadline = time.time() + sendWaitTimeout
+      while len(self.__pendingQueue) >= maxPendingMessages:
+        if not self.__connected:
+          self.__pendingQueue.popleft()
+          self.__drop(1)
+          continue
+        remaining = deadline - time.time()
+        if (remaining <= 0) or self.__timeToDie:
+          self.__drop(1)
+          return False
+        self.__queueChanged.wait(remaining)
+      self.__pendingQueue.append((message, time.time(), coalesce))
+      self.__queueChanged.notify_all()
+    return True
 
 
   def close(self):
     # This starts shutting down the sender.
-    self.__timeToDie = True
+    with self.__queueLock:
+      self.__timeToDie = True
+      self.__queueChanged.notify_all()
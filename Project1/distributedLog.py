@@ -11,12 +11,50 @@
 
 import json
 import threading
+import collections
+import time
 
 import ourCalendar
+import journal
+import codec
+import timeTable
+import rwLock
+import metrics
 
 
-InsertOpType = "Insert"
-DeleteOpType = "Delete"
+InsertOpType = ourCalendar.InsertOpType
+DeleteOpType = ourCalendar.DeleteOpType
+
+# The maximum number of sent delta messages to a single peer which are waiting
+# to be acknowledged. If more are sent the oldest is forgotten.
+maxPendingAcks = 16
+
+# The maximum number of time table cell changes to remember for building deltas.
+# If a peer falls further behind than this it is sent the full time table.
+maxCellChanges = 4096
+
+# The number of appointments in each chunk of a snapshot sent to bootstrap another node.
+snapshotChunkSize = 1000
+
+# How long, in seconds, to wait for the next chunk of a requested snapshot before asking again.
+snapshotRequestTimeout = 10.0
+
+# How long, in seconds, a snapshot being sent is kept after it was last asked for or sent
+# from, so that the chunks the peer missed can be sent again without building a new one.
+snapshotKeepTimeout = 60.0
+
+# The kinds of snapshot messages, these are put where the records would be in a gossip message.
+# - request: [nodeId, "SnapshotRequest", snapshotId, received]
+#            The snapshot Id and the indices of the chunks already received, when asking
+#            for the rest of a snapshot, otherwise None and an empty list.
+# - chunk:   [nodeId, "Snapshot", snapshotId, index, count, appointments, tuples, timeTable]
+#            The tuples and time table are only in the last chunk.
+SnapshotRequestKind = "SnapshotRequest"
+SnapshotChunkKind   = "Snapshot"
+
+receiveSeconds = metrics.getHistogram("log_receive_seconds", "The time to handle a received message.")
+trimSeconds    = metrics.getHistogram("log_trim_seconds", "The time to trim the log.")
+trimmedRecords = metrics.getCounter("log_trimmed_records_total", "The number of records trimmed from the log.")
 
 
 class record:
@@ -44,48 +82,155 @@ class distributedLog:
     self.__calendar = calendar
     self.__nodeId = nodeId
     self.__nodeCount = nodeCount
+    # Changes to the log and time table hold the lock as the writer, while building
+    # messages and showing the log only need to hold it as readers. Since several
+    # readers can build messages at once, the message tracking state is guarded by
+    # its own lock. Messages are decoded and encoded outside of the lock and the
+    # journal is written in the background, so the lock is never held for disk I/O.
+    self.__lockLog = rwLock.rwLock()
+    self.__lockSend = threading.Lock()
+
+    # The log is partitioned by the node the record came from. Each partition is
+    # ordered by time so the records a node doesn't have is always a suffix and
+    # the records everyone has is always a prefix.
     self.__log = []
-    self.__lockLog = threading.Lock()
-
-    self.__timeTable = []
     for i in range(nodeCount):
-      self.__timeTable.append([0] * nodeCount)
-    
+      self.__log.append(collections.deque())
+
+    self.__timeTable = timeTable.timeTable(nodeCount)
+
+    # The watermark of a node is the newest time of its records which everyone
+    # knows about, the minimum of its column of the time table. Since cells only
+    # grow, a watermark can only move when a cell in its column changes, so only
+    # those columns are checked when trimming.
+    self.__watermarks = [0] * nodeCount
+    self.__dirtyColumns = set()
+    self.__trimmedCount = 0
+
+    # Delta gossip tracking. Every change to a time table cell is given a version
+    # and kept in `__cellChanges` where the change with version v is at index
+    # v - __cellChangesBase - 1. For each peer the version of the time table the
+    # peer has acknowledged is kept so that only newer changes need to be sent.
+    self.__tableVersion = 0
+    self.__cellChanges = []
+    self.__cellChangesBase = 0
+    self.__sendSeq = 0
+    self.__ackedVersion = [0] * nodeCount
+    self.__lastAck = [0] * nodeCount
+    self.__pendingAcks = []
+    for i in range(nodeCount):
+      self.__pendingAcks.append({})
+    self.__lastSeqFrom = [0] * nodeCount
+    self.__sentVersion = [-1] * nodeCount # the table version when a tracked message was last sent
+
+    # Snapshot bootstrap. When a peer thinks this node knows more than it does, this node
+    # has lost its state, so it asks that peer for a snapshot. The chunks of a snapshot
+    # being sent to each peer and the chunks received so far are kept here.
+    self.__snapshotFrom = None    # the peer to ask for a snapshot or None
+    self.__snapshotAskedTime = 0.0
+    self.__snapshotsOut = {}      # peer Id to the list of chunk messages left to send
+    self.__snapshotsKept = {}     # peer Id to [snapshot Id, all chunk messages, time last used]
+    self.__snapshotCount = 0
+    self.__snapshotIn = None      # [peer Id, snapshot Id, {index: chunk}]
+
+    # The changes which haven't been written to the journal yet.
+    self.__unsavedRecs = []
+    self.__unsavedCells = {}
+    self.__journal = journal.journal(self.__getLogsFileBaseName())
+
+    # When not loading, the files from an earlier run are left alone
+    # until the first change, which replaces them with a snapshot.
+    self.__replaceFiles = not loadFile
     if loadFile:
       self.__readLogsFromFile()
 
 
   def __getClock(self):
-    return self.__timeTable[self.__nodeId][self.__nodeId]
+    return self.__timeTable.get(self.__nodeId, self.__nodeId)
 
 
   def __incClock(self):
-    self.__timeTable[self.__nodeId][self.__nodeId] += 1
+    self.__setCell(self.__nodeId, self.__nodeId, self.__getClock() + 1)
+
+
+  def __setCell(self, x, y, value):
+    # Sets a time table cell and records the change for building deltas.
+    self.__timeTable.set(x, y, value)
+    self.__cellChanged(x, y, value)
+
+
+  def __cellChanged(self, x, y, value):
+    # Records a time table cell which has already been changed
+    # so that it is journaled and sent in the next deltas.
+    self.__unsavedCells[(x, y)] = value
+    self.__dirtyColumns.add(y)
+    self.__tableVersion += 1
+    self.__cellChanges.append((x, y))
+    if len(self.__cellChanges) > maxCellChanges:
+      # Forget the oldest half of the changes, any peer which hasn't
+      # acknowledged those changes yet will be sent the full time table.
+      dropCount = len(self.__cellChanges) // 2
+      del self.__cellChanges[:dropCount]
+      self.__cellChangesBase += dropCount
 
 
   def __hasRec(self, eR, k):
     # Checks the time table to determine if the given record is known by k.
     # hasrec(Ti, eR, k) = Ti[k, eR.node] >= eR.time
-    return self.__timeTable[k][eR.nodeId] >= eR.time
-
-
-  def __allHasRec(self, eR):
-    # This is for handling "(all j in [n]) not hasrec(Ti, eR, j)}" as part of __trimLogs.
-    # This will return true if everyone knows about this record, false if one or more don't know about it.
-    for j in range(self.__nodeCount):
-      if not self.__hasRec(eR, j):
-        return False
+    return self.__timeTable.get(k, eR.nodeId) >= eR.time
+
+
+  def __records(self):
+    # Gets all the records in the log ordered by node then time.
+    for part in self.__log:
+      for r in part:
+        yield r
+
+
+  def __appendRec(self, r):
+    # Adds a record to the end of its node's partition of the log.
+    # Returns false if the record is not newer than the partition's last record.
+    part = self.__log[r.nodeId]
+    if part and part[-1].time >= r.time:
+      return False
+    part.append(r)
+    if r.time <= self.__watermarks[r.nodeId]:
+      self.__dirtyColumns.add(r.nodeId)
+    self.__unsavedRecs.append(r)
     return True
 
 
   def insert(self, name, day, start_time, end_time, participants):
-    with self.__lockLog:
-      self.__oper(InsertOpType, [name, day, start_time, end_time, participants])
+    with self.__lockLog.writing():
+      self.__applyOpers([[InsertOpType, [name, day, start_time, end_time, participants]]])
 
 
   def delete(self, name):
-    with self.__lockLog:
-      self.__oper(DeleteOpType, [name])
+    with self.__lockLog.writing():
+      self.__applyOpers([[DeleteOpType, [name]]])
+
+
+  def applyBatch(self, ops):
+    # Applies a list of operations, each [opType, opArgs], as one batch.
+    # The operations get a contiguous range of clock values, are performed
+    # against the calendar in one pass, and the changes are journaled once.
+    with self.__lockLog.writing():
+      self.__applyOpers(ops)
+
+
+  def __applyOpers(self, ops):
+    records = []
+    for opType, opArgs in ops:
+      records.append(self.__oper(opType, opArgs))
+
+    # perform the operations oper(p)
+    self.__calendar.startBatch()
+    for r in records:
+      self.__perform(r)
+    self.__calendar.finishBatch()
+
+    # both the log and clock changed so journal the changes
+    self.__saveLogChanges()
 
 
   def __oper(self, opType, opArgs):
@@ -94,40 +239,150 @@ class distributedLog:
     r = record(self.__getClock(), self.__nodeId, opType, opArgs)
 
     # Li = Li union {<"oper(p)", Ti[i,i], i>}
-    self.__log.append(r)
+    self.__appendRec(r)
+    return r
 
-    # perform the operation oper(p)
-    self.__perform(r)
 
-    # both the log and clock changed so rewrite the log file
-    self.__writeLogsToFile()
+  def getSendMessage(self, k, delta=False, binary=False):
+    # Gets the message to send to node k. By default this is the full message,
+    # <NP, Ti>, as defined by Wuu and Bernstein. If delta is true the message
+    # is tracked so that once k acknowledges it, later messages to k only
+    # contain the time table cells which have changed since. If binary is true
+    # the message is encoded with the binary codec instead of JSON.
+    with self.__lockLog.reading():
+      # NP := {eR|eR in Li and not hasRec(Ti, eR, k)}
+      # Since each partition is ordered by time these are the suffixes
+      # of the partitions newer than Ti[k, node]. So we can use json
+      # we need to get the new logs as a tuples.
+      newTuples = []
+      for nodeId in range(self.__nodeCount):
+        known = self.__timeTable.get(k, nodeId)
+        newTuples.extend(self.__newerTuples(nodeId, known))
+
+      if not delta:
+        # send the mssage <NP, Ti> to Nk
+        msg = [self.__nodeId, newTuples, self.__getTableForMessage(binary)]
+      else:
+        with self.__lockSend:
+          msg = self.__getTrackedMessage(k, newTuples, binary)
+    if binary:
+      return codec.encodeMessage(msg)
+    return json.dumps(msg)
 
 
-  def getSendMessage(self, k):
-    with self.__lockLog:
-      # NP := {eR|eR in Li and not hasRec(Ti, eR, k)}
-      newLogs = []
-      for eR in self.__log:
-        if not self.__hasRec(eR, k):
-          newLogs.append(eR)
+  def hasNewsFor(self, k):
+    # Determines if a tracked message to node k would have anything new for it,
+    # either records k doesn't have or time table changes since the last
+    # tracked message sent to k, or if there are snapshot messages for k.
+    with self.__lockLog.reading():
+      if self.__sentVersion[k] != self.__tableVersion:
+        return True
+      if self.__snapshotsOut.get(k) or self.__snapshotFrom == k:
+        return True
+      for nodeId in range(self.__nodeCount):
+        part = self.__log[nodeId]
+        if part and part[-1].time > self.__timeTable.get(k, nodeId):
+          return True
+      return False
 
-      # so we can use json we need to get the new logs as a tuples
-      newTuples = []
-      for log in newLogs:
-        newTuples.append(log.toTuple())
 
-      # send the mssage <NP, Ti> to Nk
-      msg = [self.__nodeId, newTuples, self.__timeTable]
-    return json.dumps(msg)
+  def __newerTuples(self, nodeId, time):
+    # Gets the tuples for the records in the node's partition which are newer than the given time.
+    tuples = []
+    for r in reversed(self.__log[nodeId]):
+      if r.time <= time:
+        break
+      tuples.append(r.toTuple())
+    tuples.reverse()
+    return tuples
+
+
+  def __getTableForMessage(self, binary):
+    # Gets a copy of the time table to put in a message. The binary codec
+    # writes a NumPy table's buffer directly so it doesn't need to be lists.
+    # The message is encoded after the lock is released, so the copy must not
+    # share any rows with the time table; a pure Python table is copied as lists.
+    table = self.__timeTable.raw()
+    if binary and hasattr(table, "tobytes"):
+      return table.copy()
+    return self.__timeTable.toLists()
+
+
+  def __getTrackedMessage(self, k, newTuples, binary):
+    # Creates a message to k with a sequence number and the acknowledgement of
+    # the last message received from k. Only the cells changed since the last
+    # acknowledged message are sent, unless too much has changed, then the full
+    # time table is sent as a resync.
+    self.__sendSeq += 1
+    seq = self.__sendSeq
+    ack = self.__lastSeqFrom[k]
+    self.__sentVersion[k] = self.__tableVersion
+
+    pending = self.__pendingAcks[k]
+    pending[seq] = self.__tableVersion
+    if len(pending) > maxPendingAcks:
+      del pending[min(pending)]
+
+    start = self.__ackedVersion[k] - self.__cellChangesBase
+    if start < 0 or len(self.__cellChanges) - start >= self.__nodeCount*self.__nodeCount:
+      # send the message <NP, Ti> to Nk with tracking
+      return [self.__nodeId, newTuples, self.__getTableForMessage(binary), seq, ack]
+
+    # Collect the changed cells, the sender's row is always sent in full.
+    changed = set(self.__cellChanges[start:])
+    cells = []
+    for x, y in changed:
+      if x != self.__nodeId:
+        cells.append([x, y, self.__timeTable.get(x, y)])
+    row = self.__timeTable.row(self.__nodeId)
+    return [self.__nodeId, newTuples, None, seq, ack, row, cells]
+
+
+  def __receiveAck(self, otherNodeId, seq, ack):
+    # Handles the sequence number and acknowledgement from a tracked message.
+    self.__lastSeqFrom[otherNodeId] = seq
+    pending = self.__pendingAcks[otherNodeId]
+    if ack in pending:
+      self.__ackedVersion[otherNodeId] = max(self.__ackedVersion[otherNodeId], pending[ack])
+      for s in list(pending):
+        if s <= ack:
+          del pending[s]
+    elif ack != self.__lastAck[otherNodeId]:
+      # The acknowledgement is unknown, either the other node or this node
+      # has restarted, so fall back to a full resync.
+      self.__ackedVersion[otherNodeId] = -1
+      pending.clear()
+    self.__lastAck[otherNodeId] = ack
 
 
   def receiveMessage(self, message):
-    with self.__lockLog:
-      # Decode the message from a string
-      # let m = <NPk, Tk>
+    # Handles a message from another node and returns the Id of that node.
+    with receiveSeconds.time():
+      return self.__receiveMessage(message)
+
+
+  def __receiveMessage(self, message):
+    # Decode the message from a string or binary
+    # let m = <NPk, Tk>
+    if codec.isBinary(message):
+      data = codec.decodeMessage(message)
+    else:
       data = json.loads(message)
+    with self.__lockLog.writing():
       otherNodeId = data[0]
+      if data[1] == SnapshotRequestKind:
+        self.__prepareSnapshot(otherNodeId, data)
+        return otherNodeId
+      if data[1] == SnapshotChunkKind:
+        self.__receiveSnapshotChunk(otherNodeId, data)
+        return otherNodeId
+
       otherTimeTable = data[2]
+      if self.__hasLostState(otherTimeTable, data, otherNodeId):
+        # Don't merge the time table since it says this node has records it doesn't.
+        return otherNodeId
+      if len(data) > 3:
+        self.__receiveAck(otherNodeId, data[3], data[4])
       newRecords = []
       logChanged = False
 
@@ -138,110 +393,337 @@ class distributedLog:
         opType = str(logTuple[2])
         opArgs = logTuple[3]
         r = record(time, nodeId, opType, opArgs)
-        if not self.__hasRec(r, self.__nodeId):
-          self.__log.append(r)
+        if not self.__hasRec(r, self.__nodeId) and self.__appendRec(r):
           newRecords.append(r)
           logChanged = True
 
       # update the time with the message's time table
-      timeChanged = self.__updateTimeTable(otherTimeTable, otherNodeId)
+      if otherTimeTable is not None:
+        timeChanged = self.__updateTimeTable(otherTimeTable, otherNodeId)
+      else:
+        timeChanged = self.__updateTimeTableCells(data[5], data[6], otherNodeId)
 
       # remove all logs which everyone knows about
       logChanged = self.__trimLogs() or logChanged
 
-      # if the log or time has changed, rewrite the file for the log
-      if logChanged or timeChanged:
-        self.__writeLogsToFile()
-
       # apply all new records
       # Vi := {v | (v in Vi or cvR in NE) and (not exist dR in NE where dR.op == delete(v))}
+      # not exist dR in NE where dR.op == delete(v)
+      deletedNames = set()
+      for r in newRecords:
+        if r.opType == DeleteOpType:
+          deletedNames.add(r.opArgs[0])
+      self.__calendar.startBatch()
       for r in newRecords:
-        if r.opType == InsertOpType and self.__haveDeleteInLog(r.opArgs[0], newRecords):
+        if r.opType == InsertOpType and r.opArgs[0] in deletedNames:
           continue
         self.__perform(r)
+      self.__calendar.finishBatch()
 
-
-  def __haveDeleteInLog(self, name, newRecords):
-    # not exist dR in NE where dR.op == delete(v)
-    for r in newRecords:
-      if r.opType == DeleteOpType and r.opArgs[0] == name:
+      # if the log or time has changed, journal the changes
+      if logChanged or timeChanged:
+        self.__saveLogChanges()
+      return otherNodeId
+
+
+  def __hasLostState(self, otherTimeTable, data, otherNodeId):
+    # Determines if the other node thinks this node knows about records which it
+    # doesn't, meaning this node has lost its state, so a snapshot is needed.
+    # Node k only knows what i knows from i's own row so Tk[i, x] <= Ti[i, x],
+    # and k only knows of i's records which i has so Tk[k, i] <= Ti[i, i].
+    # The other node's row is in both full and delta messages.
+    if otherTimeTable is not None:
+      claimed = [[self.__nodeId, x, otherTimeTable[self.__nodeId][x]] for x in range(self.__nodeCount)]
+      otherRow = otherTimeTable[otherNodeId]
+    else:
+      claimed = [cell for cell in data[6] if cell[0] == self.__nodeId]
+      otherRow = data[5]
+    claimed.append([self.__nodeId, self.__nodeId, otherRow[self.__nodeId]])
+    for x, y, value in claimed:
+      if value > self.__timeTable.get(x, y):
+        if self.__snapshotFrom is None:
+          self.__snapshotFrom = otherNodeId
+          self.__snapshotAskedTime = 0.0
         return True
-    return False 
+    return False
+
+
+  def getSnapshotMessages(self, k, maxCount):
+    # Gets up to maxCount snapshot messages to send to node k. These are the
+    # request for a snapshot if this node needs one from k, otherwise the next
+    # chunks of the snapshot being sent to k. The chunks are always JSON.
+    with self.__lockLog.reading(), self.__lockSend:
+      now = time.time()
+      if self.__snapshotFrom == k:
+        if now - self.__snapshotAskedTime < snapshotRequestTimeout:
+          return []
+        self.__snapshotAskedTime = now
+        # Ask for only the missing chunks of the snapshot being received.
+        snapshotId = None
+        received = []
+        if (self.__snapshotIn is not None) and (self.__snapshotIn[0] == k):
+          snapshotId = self.__snapshotIn[1]
+          received = sorted(self.__snapshotIn[2])
+        return [json.dumps([self.__nodeId, SnapshotRequestKind, snapshotId, received])]
+
+      kept = self.__snapshotsKept.get(k)
+      if kept and (now - kept[2] > snapshotKeepTimeout):
+        del self.__snapshotsKept[k]
+      chunks = self.__snapshotsOut.get(k)
+      if not chunks:
+        return []
+      taken = chunks[:maxCount]
+      del chunks[:maxCount]
+      if not chunks:
+        del self.__snapshotsOut[k]
+      if kept:
+        kept[2] = now
+    return [json.dumps(chunk) for chunk in taken]
+
+
+  def __prepareSnapshot(self, k, data):
+    # Queues the chunks of the calendar, log, and time table to send to node k.
+    # If k is asking for the rest of the snapshot which is still kept for it,
+    # only the chunks it hasn't received are sent again.
+    snapshotId = data[2] if len(data) > 2 else None
+    kept = self.__snapshotsKept.get(k)
+    if kept and (snapshotId is not None) and (kept[0] == snapshotId):
+      received = set(data[3])
+      self.__snapshotsOut[k] = [chunk for chunk in kept[1] if chunk[3] not in received]
+      kept[2] = time.time()
+      return
+
+    appts = self.__calendar.getSnapshot()
+    tuples = [r.toTuple() for r in self.__records()]
+    self.__snapshotCount += 1
+    snapshotId = self.__snapshotCount
+    count = max(1, (len(appts) + snapshotChunkSize - 1) // snapshotChunkSize)
+    chunks = []
+    for index in range(count):
+      part = appts[index*snapshotChunkSize:(index+1)*snapshotChunkSize]
+      if index == count - 1:
+        chunks.append([self.__nodeId, SnapshotChunkKind, snapshotId, index, count, part, tuples, self.__timeTable.toLists()])
+      else:
+        chunks.append([self.__nodeId, SnapshotChunkKind, snapshotId, index, count, part, None, None])
+    self.__snapshotsOut[k] = chunks[:]
+    self.__snapshotsKept[k] = [snapshotId, chunks, time.time()]
+
+
+  def __receiveSnapshotChunk(self, otherNodeId, data):
+    # Keeps the chunk and once all of the snapshot's chunks have been received, installs it.
+    if self.__snapshotFrom != otherNodeId:
+      return
+    snapshotId, index, count = data[2], data[3], data[4]
+    if (self.__snapshotIn is None) or (self.__snapshotIn[0] != otherNodeId) or (self.__snapshotIn[1] != snapshotId):
+      self.__snapshotIn = [otherNodeId, snapshotId, {}]
+    chunks = self.__snapshotIn[2]
+    chunks[index] = data
+    if len(chunks) < count:
+      # The snapshot is still arriving so don't ask for it again yet. If the last
+      # chunk has arrived, some were lost, so ask for the missing ones now.
+      self.__snapshotAskedTime = 0.0 if index == count - 1 else time.time()
+      return
+
+    appts = []
+    for i in range(count):
+      appts.extend(chunks[i][5])
+    last = chunks[count-1]
+    self.__installSnapshot(otherNodeId, appts, last[6], last[7])
+    self.__snapshotIn = None
+    self.__snapshotFrom = None
+
+
+  def __installSnapshot(self, otherNodeId, appts, tuples, otherTimeTable):
+    # Replaces the calendar with the other node's and merges the logs and time tables.
+    # Any records this node has which the other node didn't are performed again.
+    # Records this node wrote after losing its state may reuse clock values the other
+    # node has already seen for different records, those are given new clock values.
+    otherRow = otherTimeTable[otherNodeId]
+    byTime = []
+    for nodeId in range(self.__nodeCount):
+      byTime.append({})
+    for logTuple in tuples:
+      r = record(int(logTuple[0]), int(logTuple[1]), str(logTuple[2]), logTuple[3])
+      byTime[r.nodeId][r.time] = r
+
+    keep = []
+    restamp = []
+    for r in self.__records():
+      if otherRow[r.nodeId] < r.time:
+        keep.append(r)
+        byTime[r.nodeId][r.time] = r
+      elif r.nodeId == self.__nodeId:
+        other = byTime[r.nodeId].get(r.time)
+        if (other is None) or (other.toTuple() != r.toTuple()):
+          restamp.append(r)
+    self.__log = []
+    for nodeId in range(self.__nodeCount):
+      self.__log.append(collections.deque(byTime[nodeId][t] for t in sorted(byTime[nodeId])))
+
+    # Ti[i, x] := max{Ti[i, x], Tk[k, x]} then Ti[x, y] = max(Ti[x, y], Tk[x, y])
+    changes = self.__timeTable.mergeRow(self.__nodeId, otherRow)
+    changes.extend(self.__timeTable.merge(otherTimeTable))
+    for x, y, value in changes:
+      self.__cellChanged(x, y, value)
+    for nodeId in range(self.__nodeCount):
+      self.__dirtyColumns.add(nodeId)
+
+    # The clock is now past every value the other node has seen from this node.
+    for r in restamp:
+      keep.append(self.__oper(r.opType, r.opArgs))
+
+    self.__calendar.installSnapshot(appts)
+    self.__calendar.startBatch()
+    for r in keep:
+      self.__perform(r)
+    self.__calendar.finishBatch()
+    self.__trimLogs()
+
+    # Every peer is sent the full time table next and the state is written as a new snapshot.
+    self.__ackedVersion = [-1] * self.__nodeCount
+    self.__unsavedRecs = []
+    self.__unsavedCells = {}
+    self.__journal.compact(self.__getSnapshot())
 
 
   def __updateTimeTable(self, otherTimeTable, otherNodeId):
-    changed = False
     # (all x in [n]) do Ti[i, x] := max{Ti[i, x], Tk[k, x]}
-    for x in range(self.__nodeCount):
-      if otherTimeTable[otherNodeId][x] > self.__timeTable[self.__nodeId][x]:
-        self.__timeTable[self.__nodeId][x] = otherTimeTable[otherNodeId][x]
-        changed = True
-    
+    changes = self.__timeTable.mergeRow(self.__nodeId, otherTimeTable[otherNodeId])
+
     # (all x in [n])(all y in [n]) do Ti[x, y] = max(Ti[x, y], Tk[x, y])
-    for x in range(self.__nodeCount):
-      for y in range(self.__nodeCount):
-        if otherTimeTable[x][y] > self.__timeTable[x][y]:
-          self.__timeTable[x][y] = otherTimeTable[x][y]
-          changed = True
-    
+    changes.extend(self.__timeTable.merge(otherTimeTable))
+
+    for x, y, value in changes:
+      self.__cellChanged(x, y, value)
+    return len(changes) > 0
+
+
+  def __updateTimeTableCells(self, otherRow, cells, otherNodeId):
+    # This is the same as __updateTimeTable except for a delta message
+    # where only the other node's row and the changed cells are given.
+    changes = self.__timeTable.mergeRow(self.__nodeId, otherRow)
+    changes.extend(self.__timeTable.mergeRow(otherNodeId, otherRow))
+    for x, y, value in changes:
+      self.__cellChanged(x, y, value)
+
+    changed = len(changes) > 0
+    for x, y, value in cells:
+      if value > self.__timeTable.get(x, y):
+        self.__setCell(x, y, value)
+        changed = True
     return changed
 
 
   def __trimLogs(self):
     # PLi := {eR|eR in (PLi union NE) and (all j in [n]) not hasrec(Ti, eR, j)}
-    newLog = []
-    for r in self.__log:
-      if not self.__allHasRec(r):
-        newLog.append(r)
-    changed = len(self.__log) != len(newLog)
-    self.__log = newLog
-    return changed
+    # The records everyone has are the prefix of each partition up to the
+    # node's watermark. Only the watermarks of changed columns can move.
+    with trimSeconds.time():
+      changed = False
+      for nodeId in self.__dirtyColumns:
+        # (all j in [n]) hasrec(Ti, eR, j) for every eR.time <= watermark
+        watermark = self.__timeTable.columnMin(nodeId)
+        self.__watermarks[nodeId] = watermark
+        part = self.__log[nodeId]
+        while part and part[0].time <= watermark:
+          part.popleft()
+          self.__trimmedCount += 1
+          trimmedRecords.inc()
+          changed = True
+      self.__dirtyColumns.clear()
+      return changed
 
 
   def __perform(self, r):
     if r.opType == InsertOpType:
       inConflictNames = self.__calendar.insert(r.opArgs[0], r.opArgs[1], r.opArgs[2], r.opArgs[3], r.opArgs[4])
       for name in inConflictNames:
-        self.__oper(DeleteOpType, [name])
+        self.__perform(self.__oper(DeleteOpType, [name]))
     else:
       self.__calendar.delete(r.opArgs[0])
 
 
-  def __getLogsFileName(self):
-    return "logs%d.json"%self.__nodeId
+  def __getLogsFileBaseName(self):
+    return "logs%d"%self.__nodeId
 
 
   def __readLogsFromFile(self):
+    # Recovers the log and time table from the snapshot then replays the
+    # journal entries written after the snapshot. The records aren't performed
+    # again since the calendar recovers from its own journal.
     try:
-      f = open(self.__getLogsFileName(), "r")
-      data = f.read()
-      f.close()
-
-      if data:
-        self.receiveMessage(data)
+      snapshot, entries = self.__journal.load()
+      if snapshot:
+        self.__restoreChanges(snapshot[1], [])
+        for x, y, value in self.__timeTable.merge(snapshot[2]):
+          self.__cellChanged(x, y, value)
+      for entry in entries:
+        self.__restoreChanges(entry[0], entry[1])
+      self.__trimLogs()
+      self.__unsavedRecs = []
+      self.__unsavedCells = {}
     except Exception as e:
       print("Failed to load from log file: %s"%(e))
 
 
-  def __writeLogsToFile(self):
+  def __restoreChanges(self, tuples, cells):
+    # Adds the records and the time table cells, [x, y, value],
+    # from a snapshot or journal entry.
+    for logTuple in tuples:
+      self.__appendRec(record(int(logTuple[0]), int(logTuple[1]), str(logTuple[2]), logTuple[3]))
+    for x, y, value in cells:
+      if value > self.__timeTable.get(x, y):
+        self.__setCell(x, y, value)
+
+
+  def __getSnapshot(self):
+    # Gets the full log and time table in the same format as a full message.
     tuples = []
-    for log in self.__log:
+    for log in self.__records():
       tuples.append(log.toTuple())
-    data = json.dumps([self.__nodeId, tuples, self.__timeTable])
+    return [self.__nodeId, tuples, self.__timeTable.toLists()]
+
 
-    f = open(self.__getLogsFileName(), "w")
-    f.write(data)
-    f.close()
+  def __saveLogChanges(self):
+    # Appends the new records and changed time table cells to the journal.
+    # When the journal has gotten long a snapshot is written instead.
+    if not self.__unsavedRecs and not self.__unsavedCells:
+      return
+    tuples = []
+    for r in self.__unsavedRecs:
+      tuples.append(r.toTuple())
+    cells = []
+    for (x, y), value in self.__unsavedCells.items():
+      cells.append([x, y, value])
+    self.__unsavedRecs = []
+    self.__unsavedCells = {}
+
+    if self.__replaceFiles or self.__journal.append([tuples, cells]):
+      self.__replaceFiles = False
+      self.__journal.compact(self.__getSnapshot())
+
+
+  def getLogStats(self):
+    # Gets the number of records retained in the log, in total and from each
+    # node, the number of records trimmed, and the watermark of each node.
+    with self.__lockLog.reading():
+      retained = [len(part) for part in self.__log]
+      return {
+        "Retained":        sum(retained),
+        "RetainedByNode":  retained,
+        "Trimmed":         self.__trimmedCount,
+        "Watermarks":      self.__watermarks[:],
+      }
 
 
   def logsToString(self):
-    with self.__lockLog:
+    with self.__lockLog.reading():
       parts = []
-      for r in self.__log:
+      for r in self.__records():
         parts.append(r.toString())
     return "\n  ".join(parts)
 
 
   def timeTableToString(self):
-    with self.__lockLog:
+    with self.__lockLog.reading():
       return str(self.__timeTable)
@@ -8,10 +8,25 @@
 # To run the unit-test:
 # - In console 1 call "python -m unittest -v"
 
+import json
 import unittest
 
 import ourCalendar
 import distributedLog
+import journal
+import os
+import timeTable
+import simulator
+import gossip
+import rwLock
+import metrics
+import connections
+import asyncNode
+import asyncio
+import codec
+import socket
+import threading
+import time
 
 
 class TestDistributedLogs(unittest.TestCase):
@@ -84,12 +99,678 @@ class TestDistributedLogs(unittest.TestCase):
     log.receiveMessage(fakeMsg)
     self.assertEqual(log.logsToString(), "Delete: time=3, nodeId=0, name=Meetup")
     self.assertEqual(log.timeTableToString(), "[[3, 0, 0], [2, 0, 0], [2, 0, 0]]")
+    stats = log.getLogStats()
+    self.assertEqual(stats["Retained"], 1)
+    self.assertEqual(stats["Trimmed"], 2)
+    self.assertEqual(stats["Watermarks"], [2, 0, 0])
+
+    # A message which doesn't move any watermark doesn't trim anything.
+    log.receiveMessage(fakeMsg)
+    self.assertEqual(log.getLogStats()["Trimmed"], 2)
 
     # Make the log think the other two nodes have gotten the third message.
     fakeMsg = "[1, [], [[3, 0, 0], [3, 0, 0], [3, 0, 0]]]"
     log.receiveMessage(fakeMsg)
     self.assertEqual(log.logsToString(), "")
     self.assertEqual(log.timeTableToString(), "[[3, 0, 0], [3, 0, 0], [3, 0, 0]]")
+    self.assertEqual(log.getLogStats()["RetainedByNode"], [0, 0, 0])
+
+
+  def test_deltaMessages(self):
+    # Tests that tracked messages only send the time table changes
+    # which the other node hasn't acknowledged yet.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 4, False)
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 4, False)
+    log0.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+
+    # Nothing has been acknowledged yet so the first message is only the row
+    # of the sender and all of the changed cells (none outside its row).
+    msg = log0.getSendMessage(1, True)
+    self.assertEqual(msg,
+      '[0, [[1, 0, "Insert", ["Meeting", 2, 12.0, 13.0, [0, 1]]]], null, 1, 0, [1, 0, 0, 0], []]')
+    log1.receiveMessage(msg)
+    self.assertEqual(cal1.toString(), "Meeting, Monday 12:00-13:00, [0, 1]")
+    self.assertEqual(log1.timeTableToString(), "[[1, 0, 0, 0], [1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]")
+
+    # Node 1 acknowledges node 0's message, it sends back the changed cell for node 0.
+    msg = log1.getSendMessage(0, True)
+    self.assertEqual(msg, '[1, [], null, 1, 1, [1, 0, 0, 0], [[0, 0, 1]]]')
+    log0.receiveMessage(msg)
+    self.assertEqual(log0.timeTableToString(), "[[1, 0, 0, 0], [1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]")
+
+    # Node 0's message to node 1 now only has the changes since the acknowledgement.
+    msg = log0.getSendMessage(1, True)
+    self.assertEqual(msg, '[0, [], null, 2, 1, [1, 0, 0, 0], [[1, 0, 1]]]')
+    log1.receiveMessage(msg)
+    log0.receiveMessage(log1.getSendMessage(0, True))
+    msg = log0.getSendMessage(1, True)
+    self.assertEqual(msg, '[0, [], null, 3, 2, [1, 0, 0, 0], []]')
+
+    # An unknown acknowledgement causes a full resync.
+    log0.receiveMessage('[1, [], null, 7, 42, [1, 0, 0, 0], []]')
+    msg = log0.getSendMessage(1, True)
+    self.assertEqual(msg, '[0, [], [[1, 0, 0, 0], [1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]], 4, 7]')
+
+
+  def test_partitionedLog(self):
+    # Tests that records from different nodes are sent and trimmed
+    # based on each node's column of the time table.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 3, False)
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 3, False)
+    log0.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+    log1.insert("Meetup", 3, 13.0, 14.0, [1, 2])
+    log1.insert("Lunch", 3, 12.0, 13.0, [1])
+    log0.receiveMessage(log1.getSendMessage(0))
+    self.assertEqual(log0.logsToString(),
+      "Insert: time=1, nodeId=0, name=Meeting, day=2, start_time=12.0, end_time=13.0, participants=[0, 1]\n" +
+      "  Insert: time=1, nodeId=1, name=Meetup, day=3, start_time=13.0, end_time=14.0, participants=[1, 2]\n" +
+      "  Insert: time=2, nodeId=1, name=Lunch, day=3, start_time=12.0, end_time=13.0, participants=[1]")
+
+    # Node 2 is known to have the first record from node 1, so only the rest is sent.
+    log0.receiveMessage("[2, [], [[0, 0, 0], [0, 0, 0], [0, 1, 0]]]")
+    self.assertEqual(log0.getSendMessage(2),
+      '[0, [[1, 0, "Insert", ["Meeting", 2, 12.0, 13.0, [0, 1]]], ' +
+      '[2, 1, "Insert", ["Lunch", 3, 12.0, 13.0, [1]]]], [[1, 2, 0], [0, 2, 0], [0, 1, 0]]]')
+
+    # Once everyone has the first record from node 1 only that record is trimmed.
+    log0.receiveMessage("[1, [], [[1, 1, 0], [1, 2, 0], [0, 1, 0]]]")
+    self.assertEqual(log0.logsToString(),
+      "Insert: time=1, nodeId=0, name=Meeting, day=2, start_time=12.0, end_time=13.0, participants=[0, 1]\n" +
+      "  Insert: time=2, nodeId=1, name=Lunch, day=3, start_time=12.0, end_time=13.0, participants=[1]")
+
+
+  def test_journalRecovery(self):
+    # Tests that the log, time table, and calendar are recovered
+    # from the snapshot and journal, even if the journal's end is torn.
+    cal = ourCalendar.calendar(0, False)
+    log = distributedLog.distributedLog(cal, 0, 2, False)
+    log.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+    log.insert("Meetup", 3, 13.0, 14.0, [0, 1])
+    log.delete("Meetup")
+    log.receiveMessage("[1, [[1, 1, \"Insert\", [\"Lunch\", 4, 12.0, 13.0, [1]]]], [[2, 0], [2, 1]]]")
+    f = open("logs0.journal", "ab")
+    f.write(b"\x10\x00\x00")
+    f.close()
+
+    cal2 = ourCalendar.calendar(0, True)
+    log2 = distributedLog.distributedLog(cal2, 0, 2, True)
+    self.assertEqual(cal2.toString(), cal.toString())
+    self.assertEqual(log2.logsToString(), log.logsToString())
+    self.assertEqual(log2.timeTableToString(), "[[3, 1], [2, 1]]")
+    self.assertEqual(log2.getSendMessage(1), log.getSendMessage(1))
+
+
+  def test_journalFiles(self):
+    # Tests that creating without loading leaves the files until the first change,
+    # and that entries written in a batch are synced even if nothing else is written.
+    cal = ourCalendar.calendar(0, False)
+    cal.insert("Meeting", 2, 12.0, 13.0, [0])
+    journal.waitForFlush()
+    ourCalendar.calendar(0, False)
+    cal2 = ourCalendar.calendar(0, True)
+    self.assertEqual(cal2.toString(), cal.toString())
+
+    j = journal.journal("test0", journal.syncBatch, 0.05, None, False)
+    try:
+      j.append(["first"])
+      j.append(["second"])
+      self.assertTrue(j in journal.syncDue)
+      deadline = time.time() + 5.0
+      while (j in journal.syncDue) and (time.time() < deadline):
+        time.sleep(0.01)
+      self.assertFalse(j in journal.syncDue)
+    finally:
+      j.close()
+    self.assertEqual(j.load(), (None, [["first"], ["second"]]))
+    os.remove("test0.journal")
+
+
+  def test_conflictResolution(self):
+    # Tests that conflicting appointments are deleted by name order,
+    # the appointment with the latest name wins.
+    cal = ourCalendar.calendar(0, False)
+    log = distributedLog.distributedLog(cal, 0, 2, False)
+    log.insert("B", 2, 12.0, 13.0, [0, 1])
+    log.insert("D", 2, 14.0, 15.0, [1])
+    log.insert("A", 2, 12.5, 14.5, [1])
+    self.assertEqual(cal.toString(),
+      "B, Monday 12:00-13:00, [0, 1]\n" +
+      "  D, Monday 14:00-15:00, [1]")
+    self.assertEqual(cal.getConflict(2, 12.5, 14.5, [0]).name, "B")
+    self.assertEqual(cal.getConflict(2, 12.5, 14.5, [1]).name, "B")
+    self.assertEqual(cal.getConflict(2, 13.0, 14.0, [0, 1]), None)
+
+    log.insert("E", 2, 12.5, 14.5, [1, 2])
+    self.assertEqual(cal.toString(), "E, Monday 12:30-14:30, [1, 2]")
+    self.assertEqual(log.logsToString().count("Delete"), 3)
+
+
+  def test_calendarSnapshotIndex(self):
+    # Tests that appointments bulk loaded from an unsorted snapshot are
+    # sorted and put into the interval index used to find conflicts.
+    cal = ourCalendar.calendar(0, False)
+    cal.insert("Old", 2, 9.0, 10.0, [0])
+    cal.installSnapshot([
+      ["D", 3, 12.0, 13.0, [0]],
+      ["B", 2, 14.0, 15.0, [1, 2]],
+      ["C", 2, 12.0, 13.0, [0, 1]],
+      ["A", 2, 16.0, 17.0, [1]],
+    ])
+    self.assertEqual(cal.toString(),
+      "C, Monday 12:00-13:00, [0, 1]\n" +
+      "  B, Monday 14:00-15:00, [1, 2]\n" +
+      "  A, Monday 16:00-17:00, [1]\n" +
+      "  D, Tuesday 12:00-13:00, [0]")
+    self.assertEqual(cal.getConflict(2, 9.0, 10.0, [0]), None)
+    self.assertEqual(cal.getConflict(2, 12.5, 14.5, [0]).name, "C")
+    self.assertEqual(cal.getConflict(2, 12.5, 14.5, [2]).name, "B")
+    self.assertEqual(cal.getConflict(2, 13.0, 14.0, [0, 1, 2]), None)
+    self.assertEqual(cal.getConflict(3, 12.5, 12.75, [1]), None)
+    self.assertEqual(cal.getConflict(3, 12.5, 12.75, [0, 1]).name, "D")
+
+    # Inserting and deleting after the bulk load keep the index in order.
+    self.assertEqual(cal.insert("E", 2, 14.5, 16.5, [1]), ["B", "A"])
+    cal.delete("B")
+    cal.delete("A")
+    cal.delete("C")
+    self.assertEqual(cal.getConflict(2, 12.0, 17.0, [0, 2]), None)
+    self.assertEqual(cal.getConflict(2, 12.0, 14.75, [0, 1]).name, "E")
+    self.assertEqual(cal.getConflict(2, 16.25, 17.0, [1]).name, "E")
+    self.assertEqual(cal.toString(),
+      "E, Monday 14:30-16:30, [1]\n" +
+      "  D, Tuesday 12:00-13:00, [0]")
+
+    # Reloading bulk loads the snapshot and the journaled changes.
+    cal2 = ourCalendar.calendar(0, True)
+    self.assertEqual(cal2.toString(), cal.toString())
+    self.assertEqual(cal2.getConflict(3, 12.5, 12.75, [0]).name, "D")
+
+
+  def test_applyBatch(self):
+    # Tests that a batch of operations gets a contiguous clock range,
+    # resolves conflicts, and is journaled as a single entry.
+    cal = ourCalendar.calendar(0, False)
+    log = distributedLog.distributedLog(cal, 0, 2, False)
+    log.applyBatch([
+      [distributedLog.InsertOpType, ["A", 2, 12.0, 13.0, [0]]],
+      [distributedLog.InsertOpType, ["B", 2, 12.5, 13.5, [0]]],
+      [distributedLog.InsertOpType, ["C", 3, 12.0, 13.0, [0, 1]]],
+      [distributedLog.DeleteOpType, ["C"]],
+    ])
+    self.assertEqual(cal.toString(), "B, Monday 12:30-13:30, [0]")
+    self.assertEqual(log.logsToString(),
+      "Insert: time=1, nodeId=0, name=A, day=2, start_time=12.0, end_time=13.0, participants=[0]\n" +
+      "  Insert: time=2, nodeId=0, name=B, day=2, start_time=12.5, end_time=13.5, participants=[0]\n" +
+      "  Insert: time=3, nodeId=0, name=C, day=3, start_time=12.0, end_time=13.0, participants=[0, 1]\n" +
+      "  Delete: time=4, nodeId=0, name=C\n" +
+      "  Delete: time=5, nodeId=0, name=A")
+    self.assertEqual(log.timeTableToString(), "[[5, 0], [0, 0]]")
+
+    cal2 = ourCalendar.calendar(0, True)
+    log2 = distributedLog.distributedLog(cal2, 0, 2, True)
+    self.assertEqual(cal2.toString(), cal.toString())
+    self.assertEqual(log2.logsToString(), log.logsToString())
+
+
+  def test_binaryMessages(self):
+    # Tests that binary messages are received the same as JSON messages.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 3, False)
+    log0.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+    log0.insert("Meetup", 3, 13.5, 14.0, [0, 1])
+    log0.delete("Meetup")
+
+    for delta in [False, True]:
+      binMsg = log0.getSendMessage(1, delta, True)
+      jsonMsg = log0.getSendMessage(1, delta)
+      self.assertTrue(len(binMsg) < len(jsonMsg))
+
+      cal1 = ourCalendar.calendar(1, False)
+      log1 = distributedLog.distributedLog(cal1, 1, 3, False)
+      log1.receiveMessage(binMsg)
+      cal2 = ourCalendar.calendar(2, False)
+      log2 = distributedLog.distributedLog(cal2, 1, 3, False)
+      log2.receiveMessage(jsonMsg)
+      self.assertEqual(cal1.toString(), "Meeting, Monday 12:00-13:00, [0, 1]")
+      self.assertEqual(cal1.toString(), cal2.toString())
+      self.assertEqual(log1.logsToString(), log2.logsToString())
+      self.assertEqual(log1.timeTableToString(), log2.timeTableToString())
+
+
+  def test_deleteByName(self):
+    # Tests that appointments are found and deleted by name, even if two share a name.
+    cal = ourCalendar.calendar(0, False)
+    cal.insert("A", 2, 12.0, 13.0, [0])
+    cal.insert("B", 3, 12.0, 13.0, [0])
+    cal.insert("A", 4, 12.0, 13.0, [0])
+    self.assertEqual(cal.getAppointment("B").day, 3)
+    cal.delete("A")
+    self.assertEqual(cal.toString(), "B, Tuesday 12:00-13:00, [0]\n  A, Wednesday 12:00-13:00, [0]")
+    cal.delete("A")
+    cal.delete("A")
+    self.assertEqual(cal.toString(), "B, Tuesday 12:00-13:00, [0]")
+    self.assertIsNone(cal.getAppointment("A"))
+
+
+  def test_timeTableMerge(self):
+    # Tests that the NumPy and pure Python time tables merge the same.
+    other = [[3, 0, 1], [2, 5, 0], [0, 0, 4]]
+    results = []
+    oldUseNumpy = timeTable.useNumpy
+    try:
+      for useNumpy in [True, False]:
+        timeTable.useNumpy = useNumpy
+        table = timeTable.timeTable(3)
+        table.set(0, 0, 4)
+        table.set(1, 2, 2)
+        changes = table.mergeRow(0, other[1])
+        changes.extend(table.merge(other))
+        results.append((sorted(changes), str(table), table.columnMin(0), table.columnMin(1)))
+    finally:
+      timeTable.useNumpy = oldUseNumpy
+    self.assertEqual(results[0], results[1])
+    self.assertEqual(results[0][1], "[[4, 5, 1], [2, 5, 2], [0, 0, 4]]")
+    self.assertEqual(results[0][2], 0)
+
+
+  def test_simulator(self):
+    # Tests that simulated nodes converge after a partition and some lost messages.
+    net = simulator.network(lossRate=0.1, partitions=[(0.0, 5.0, [[0, 1, 2], [3, 4]])])
+    work = simulator.workload(duration=5.0, opsPerSecond=10.0)
+    results = simulator.simulator(5, net, work, seed=3).run()
+    self.assertEqual(results['Operations'], 50)
+    self.assertIsNotNone(results['ConvergenceTime'])
+    self.assertTrue(results['Lost'] > 0)
+
+    # The same seed gives the same run.
+    again = simulator.simulator(5, net, work, seed=3).run()
+    for key in ['ConvergenceTime', 'Messages', 'Lost', 'Bytes', 'LogSizes']:
+      self.assertEqual(results[key], again[key])
+
+    # The nodes also converge when using the gossip scheduler.
+    results = simulator.simulator(5, net, work, seed=3, schedulerOptions={'fanOut': 2}).run()
+    self.assertIsNotNone(results['ConvergenceTime'])
+
+
+  def test_gossipScheduler(self):
+    # Tests that the scheduler only sends to peers which need it and backs off the others.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 3, False)
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 3, False)
+    sched = gossip.scheduler(log0, [1, 2], fanOut=None, minInterval=1.0, maxInterval=4.0, jitter=0.0)
+
+    # Nothing new so the peers are suppressed and backed off.
+    self.assertTrue(log0.hasNewsFor(1))
+    log0.getSendMessage(1, True)
+    log0.getSendMessage(2, True)
+    self.assertFalse(log0.hasNewsFor(1))
+    self.assertEqual(sched.pickPeers(0.0), [])
+    self.assertEqual(sched.getStats()['Intervals'], {1: 2.0, 2: 2.0})
+
+    # A new record makes both peers due once their intervals pass.
+    log0.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+    self.assertEqual(sched.pickPeers(1.0), [])
+    peers = sched.pickPeers(2.0)
+    self.assertEqual(sorted(peers), [1, 2])
+    for peerId in peers:
+      msg = log0.getSendMessage(peerId, True)
+    self.assertEqual(sched.getStats()['Intervals'], {1: 1.0, 2: 1.0})
+
+    # A message from a peer makes a reply to it due right away.
+    self.assertEqual(log1.receiveMessage(log0.getSendMessage(1, True)), 0)
+    sched.received(log0.receiveMessage(log1.getSendMessage(0, True)), 2.5)
+    self.assertEqual(sched.pickPeers(2.5), [1])
+
+    # Once at the maximum interval a heartbeat is sent even with nothing new.
+    # Node 2 still doesn't have the record so it keeps being sent to.
+    log0.getSendMessage(1, True)
+    for now in [3.0, 4.0, 5.0, 6.0, 7.0, 9.0]:
+      self.assertEqual(sched.pickPeers(now), [2])
+    self.assertEqual(sched.getStats()['Intervals'], {1: 4.0, 2: 1.0})
+    self.assertEqual(sorted(sched.pickPeers(13.0)), [1, 2])
+
+
+  def test_snapshotBootstrap(self):
+    # Tests that a node which lost its state gets a snapshot from a peer.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 3, False)
+    log0.insert("A", 2, 12.0, 13.0, [0, 1])
+    log0.insert("B", 3, 12.0, 13.0, [0, 1])
+    log0.insert("C", 4, 12.0, 13.0, [0, 2])
+    log0.receiveMessage(json.dumps([1, [], [[3, 0, 0], [3, 0, 0], [3, 0, 0]]]))
+    self.assertEqual(log0.logsToString(), "")
+
+    # Node 1 restarts with nothing and inserts an appointment before hearing from node 0.
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 3, False)
+    log1.insert("E", 5, 12.0, 13.0, [1])
+    log1.receiveMessage(log0.getSendMessage(1, True))
+    self.assertEqual(log1.timeTableToString(), "[[0, 0, 0], [0, 1, 0], [0, 0, 0]]")
+    self.assertTrue(log1.hasNewsFor(0))
+
+    oldChunkSize = distributedLog.snapshotChunkSize
+    distributedLog.snapshotChunkSize = 2
+    try:
+      requests = log1.getSnapshotMessages(0, 8)
+      self.assertEqual(len(requests), 1)
+      self.assertEqual(log1.getSnapshotMessages(0, 8), [])
+      log0.receiveMessage(requests[0])
+      chunkCount = 0
+      while True:
+        chunks = log0.getSnapshotMessages(1, 1)
+        if not chunks:
+          break
+        chunkCount += 1
+        self.assertEqual(cal1.toString(), "E, Thursday 12:00-13:00, [1]")
+        log1.receiveMessage(chunks[0])
+      self.assertEqual(chunkCount, 2)
+    finally:
+      distributedLog.snapshotChunkSize = oldChunkSize
+
+    self.assertEqual(cal1.toString(),
+      "A, Monday 12:00-13:00, [0, 1]\n  B, Tuesday 12:00-13:00, [0, 1]\n" +
+      "  C, Wednesday 12:00-13:00, [0, 2]\n  E, Thursday 12:00-13:00, [1]")
+    self.assertEqual(log1.timeTableToString(), "[[3, 0, 0], [3, 1, 0], [3, 0, 0]]")
+    self.assertEqual(log1.getSnapshotMessages(0, 8), [])
+
+    # Node 0 gets node 1's appointment by gossip as usual.
+    log0.receiveMessage(log1.getSendMessage(0, True))
+    self.assertEqual(cal0.toString(), cal1.toString())
+
+
+  def startRestartedNode(self):
+    # Creates node 0 which has node 1's appointments from tracked messages so
+    # its next message to node 1 is a delta, then restarts node 1 with nothing.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 2, False)
+    oldCal1 = ourCalendar.calendar(1, False)
+    oldLog1 = distributedLog.distributedLog(oldCal1, 1, 2, False)
+    oldLog1.insert("Old1", 2, 12.0, 13.0, [0, 1])
+    oldLog1.insert("Old2", 3, 12.0, 13.0, [0, 1])
+    for i in range(2):
+      oldLog1.receiveMessage(log0.getSendMessage(1, True))
+      log0.receiveMessage(oldLog1.getSendMessage(0, True))
+
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 2, False)
+    return cal0, log0, cal1, log1
+
+
+  def transferSnapshot(self, log0, log1):
+    # Passes the snapshot request and chunks between the nodes until none are left.
+    for i in range(10):
+      for msg in log1.getSnapshotMessages(0, 8):
+        log0.receiveMessage(msg)
+      for msg in log0.getSnapshotMessages(1, 8):
+        log1.receiveMessage(msg)
+
+
+  def test_snapshotAfterDelta(self):
+    # Tests that a node which lost its state asks for a snapshot when the first
+    # message it gets is a delta, which only has the sender's row and changed cells.
+    cal0, log0, cal1, log1 = self.startRestartedNode()
+    msg = log0.getSendMessage(1, True)
+    self.assertEqual(json.loads(msg)[2:], [None, 3, 2, [0, 2], []])
+    log1.receiveMessage(msg)
+    self.assertEqual(log1.timeTableToString(), "[[0, 0], [0, 0]]")
+    self.assertTrue(log1.hasNewsFor(0))
+
+    self.transferSnapshot(log0, log1)
+    self.assertEqual(cal1.toString(), cal0.toString())
+    self.assertEqual(cal1.toString(), "Old1, Monday 12:00-13:00, [0, 1]\n  Old2, Tuesday 12:00-13:00, [0, 1]")
+
+
+  def test_insertBeforeSnapshot(self):
+    # Tests that an appointment inserted after restarting, but before the snapshot
+    # is installed, isn't lost even though it reused a clock value the peer has seen.
+    cal0, log0, cal1, log1 = self.startRestartedNode()
+    log1.insert("New", 4, 12.0, 13.0, [0, 1])
+    log1.receiveMessage(log0.getSendMessage(1, True))
+    self.transferSnapshot(log0, log1)
+    expected = "Old1, Monday 12:00-13:00, [0, 1]\n  Old2, Tuesday 12:00-13:00, [0, 1]\n" + \
+      "  New, Wednesday 12:00-13:00, [0, 1]"
+    self.assertEqual(cal1.toString(), expected)
+
+    log0.receiveMessage(log1.getSendMessage(0, True))
+    self.assertEqual(cal0.toString(), expected)
+
+
+  def test_snapshotResume(self):
+    # Tests that lost chunks of a snapshot are sent again without starting over.
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 2, False)
+    for i in range(6):
+      log0.insert("A%d"%(i), 1 + i, 12.0, 13.0, [0, 1])
+    log0.receiveMessage(json.dumps([1, [], [[6, 0], [6, 0]]]))
+
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 2, False)
+    log1.receiveMessage(log0.getSendMessage(1, True))
+
+    oldChunkSize = distributedLog.snapshotChunkSize
+    distributedLog.snapshotChunkSize = 2
+    try:
+      log0.receiveMessage(log1.getSnapshotMessages(0, 8)[0])
+      chunks = log0.getSnapshotMessages(1, 8)
+      self.assertEqual(len(chunks), 3)
+
+      # The middle chunk is lost, the last chunk arriving makes node 1 ask for it right away.
+      log1.receiveMessage(chunks[0])
+      self.assertEqual(log1.getSnapshotMessages(0, 8), [])
+      log1.receiveMessage(chunks[2])
+      requests = log1.getSnapshotMessages(0, 8)
+      self.assertEqual(len(requests), 1)
+      self.assertEqual(json.loads(requests[0])[2:], [json.loads(chunks[0])[2], [0, 2]])
+
+      log0.receiveMessage(requests[0])
+      resent = log0.getSnapshotMessages(1, 8)
+      self.assertEqual(resent, [chunks[1]])
+      log1.receiveMessage(resent[0])
+    finally:
+      distributedLog.snapshotChunkSize = oldChunkSize
+    self.assertEqual(cal1.toString(), cal0.toString())
+    self.assertEqual(log1.getSnapshotMessages(0, 8), [])
+
+
+  def test_rwLock(self):
+    # Tests that readers share the lock and a writer waits for them.
+    lock = rwLock.rwLock()
+    order = []
+    lock.acquireRead()
+    lock.acquireRead()
+    def write():
+      with lock.writing():
+        order.append("write")
+    writer = threading.Thread(target=write)
+    writer.start()
+    writer.join(0.1)
+    order.append("read")
+    lock.releaseRead()
+    lock.releaseRead()
+    writer.join()
+    self.assertEqual(order, ["read", "write"])
+
+
+  def test_metrics(self):
+    # Tests that the hot paths are only measured while metrics are enabled.
+    reg = metrics.registry()
+    hist = reg.histogram("test_seconds", "A test.", [0.5, 1.0])
+    count = reg.counter("test_total", "A test.")
+    receives = distributedLog.receiveSeconds.getCount()
+    cal = ourCalendar.calendar(0, False)
+    log = distributedLog.distributedLog(cal, 0, 2, False)
+    log.receiveMessage(json.dumps([1, [], [[0, 0], [0, 0]]]))
+    hist.observe(0.7)
+    count.inc()
+    self.assertEqual(distributedLog.receiveSeconds.getCount(), receives)
+    self.assertEqual(hist.getCount(), 0)
+
+    metrics.enabled = True
+    try:
+      log.receiveMessage(json.dumps([1, [], [[0, 0], [0, 0]]]))
+      hist.observe(0.7)
+      hist.observe(2.0)
+      count.inc(3)
+      with hist.time():
+        pass
+    finally:
+      metrics.enabled = False
+    self.assertEqual(distributedLog.receiveSeconds.getCount(), receives + 1)
+    lines = reg.toText().split("\n")
+    self.assertEqual(lines[:5], ["# HELP test_seconds A test.", "# TYPE test_seconds histogram",
+      'test_seconds_bucket{le="0.5"} 1', 'test_seconds_bucket{le="1"} 2', 'test_seconds_bucket{le="+Inf"} 3'])
+    self.assertTrue(lines[5].startswith("test_seconds_sum 2.7"))
+    self.assertEqual(lines[6:], ["test_seconds_count 3", "# HELP test_total A test.",
+      "# TYPE test_total counter", "test_total 3", ""])
+
+
+  def getFreeHostAndPort(self):
+    # Gets a local host and port which nothing is listening on.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("localhost", 0))
+    hostAndPort = "localhost:%d"%(sock.getsockname()[1])
+    sock.close()
+    return hostAndPort
+
+
+  def waitFor(self, received, count):
+    # Waits until the given number of messages have been received.
+    deadline = time.time() + 20.0
+    while (len(received) < count) and (time.time() < deadline):
+      time.sleep(0.05)
+
+
+  def test_senderQueue(self):
+    # Messages sent before the listener is up are kept until it connects,
+    # with only the newest coalescing message kept.
+    hostAndPort = self.getFreeHostAndPort()
+    received = []
+    out = connections.sender(hostAndPort)
+    try:
+      self.assertTrue(out.send("first"))
+      self.assertTrue(out.send("gossip 1", True))
+      self.assertTrue(out.send("second"))
+      self.assertTrue(out.send("gossip 2", True))
+      self.assertEqual(out.getStats()['Pending'], 3)
+      self.assertEqual(out.getStats()['Dropped'], 1)
+
+      inc = connections.listener(received.append, hostAndPort, True)
+      try:
+        deadline = time.time() + 20.0
+        while (len(received) < 3) and (time.time() < deadline):
+          time.sleep(0.05)
+      finally:
+        inc.close()
+    finally:
+      out.close()
+    self.assertEqual(received, ["first", "second", "gossip 2"])
+
+
+  def test_selectorListener(self):
+    # Tests that the selector listener handles several talkers and keeps
+    # handling them after the handle method fails on a message.
+    received = []
+    def handle(message):
+      if message == "bad":
+        raise ValueError("bad message")
+      received.append(message)
+
+    hostAndPort = self.getFreeHostAndPort()
+    inc = connections.selectorListener(handle, hostAndPort, True)
+    out1 = connections.sender(hostAndPort)
+    out2 = connections.sender(hostAndPort)
+    try:
+      out1.send("bad")
+      out1.send("one")
+      self.waitFor(received, 1)
+      out2.send("two")
+      self.waitFor(received, 2)
+    finally:
+      out1.close()
+      out2.close()
+      inc.close()
+    self.assertEqual(received, ["one", "two"])
+
+
+  def test_framing(self):
+    # Tests that frames coalesced into one read and frames split
+    # across several reads are each handled whole and in order.
+    received = []
+    inSock, outSock = socket.socketpair()
+    inc = connections.inConnection(inSock, received.append, [connections.codecJson])
+    try:
+      outSock.sendall(connections.frameMessage("one") + connections.frameMessage("two") +
+        connections.frameMessage("three"))
+      self.assertTrue(inc.read())
+      self.assertEqual(received, ["one", "two", "three"])
+
+      # Split in the header then in the message, with the next frame after the split one.
+      data = connections.frameMessage("split") + connections.frameMessage("after")
+      outSock.sendall(data[:2])
+      self.assertTrue(inc.read())
+      outSock.sendall(data[2:7])
+      self.assertTrue(inc.read())
+      self.assertEqual(received, ["one", "two", "three"])
+      outSock.sendall(data[7:])
+      self.assertTrue(inc.read())
+      self.assertEqual(received, ["one", "two", "three", "split", "after"])
+
+      # A frame bigger than the receive buffer is read over several reads.
+      big = "x" * (connections.initialReceiveBufferSize * 3)
+      sendThread = threading.Thread(target=outSock.sendall, args=(connections.frameMessage(big),))
+      sendThread.start()
+      while len(received) < 6:
+        self.assertTrue(inc.read())
+      sendThread.join()
+      self.assertEqual(received[5], big)
+
+      outSock.close()
+      self.assertFalse(inc.read())
+    finally:
+      inSock.close()
+
+
+  def test_asyncNode(self):
+    # Tests that two nodes on an event loop send their logs to each other,
+    # one offering the binary codec and the other only taking JSON.
+    hostsAndPorts = {0: self.getFreeHostAndPort(), 1: self.getFreeHostAndPort()}
+    cal0 = ourCalendar.calendar(0, False)
+    log0 = distributedLog.distributedLog(cal0, 0, 2, False)
+    cal1 = ourCalendar.calendar(1, False)
+    log1 = distributedLog.distributedLog(cal1, 1, 2, False)
+    node0 = asyncNode.asyncNode(log0, 0, hostsAndPorts, True, [codec.BinaryCodec, codec.JsonCodec], gossipInterval=1000.0)
+    node1 = asyncNode.asyncNode(log1, 1, hostsAndPorts, True, [codec.JsonCodec], gossipInterval=1000.0)
+
+    async def waitForCount(cal, count):
+      deadline = time.time() + 20.0
+      while (cal.toString().count(",") < count*2) and (time.time() < deadline):
+        await asyncio.sleep(0.05)
+
+    async def run():
+      await node0.start()
+      await node1.start()
+      try:
+        log0.insert("Meeting", 2, 12.0, 13.0, [0, 1])
+        await node0.gossipOnce()
+        await waitForCount(cal1, 1)
+        log1.insert("Lunch", 3, 12.0, 13.0, [0, 1])
+        await node1.gossipOnce()
+        await waitForCount(cal0, 2)
+      finally:
+        await node0.close()
+        await node1.close()
+
+    asyncio.run(run())
+    self.assertEqual(cal0.toString(),
+      "Meeting, Monday 12:00-13:00, [0, 1]\n" +
+      "  Lunch, Tuesday 12:00-13:00, [0, 1]")
+    self.assertEqual(cal1.toString(), cal0.toString())
+    self.assertEqual(log0.timeTableToString(), "[[1, 1], [1, 1]]")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains the gossip scheduler which picks which peers a node sends
+# its log and time table to. It only decides who to send to and when, the
+# caller does the sending, so it is used the same way by the threaded node in
+# main.py, the asyncio node, and the simulator.
+#
+# The scheduler supports:
+# - fan-out:   each tick only sends to up to `fanOut` random peers which are due.
+# - push-pull: when a message is received from a peer, a reply to that peer is
+#              due right away so both sides exchange what they have (anti-entropy).
+# - suppress:  a peer isn't sent to if there is nothing new for it, as determined
+#              from the time table by `distributedLog.hasNewsFor`.
+# - adaptive:  each peer has its own interval. It is reset to the minimum when
+#              there is something to send and doubled, up to the maximum, when not.
+#              Once a peer's interval is at the maximum it is sent to anyway as a
+#              heartbeat, so lost messages and acknowledgements are recovered.
+
+import random
+import threading
+
+
+defaultFanOut      = 3    # None sends to every peer which is due
+defaultMinInterval = 1.0  # in seconds
+defaultMaxInterval = 30.0 # in seconds
+defaultJitter      = 0.2  # the fraction each interval is randomly changed by
+
+
+class scheduler:
+  # This is the gossip scheduler for the given distributed log and peer node Ids.
+
+  def __init__(self, log, peerIds, fanOut=defaultFanOut, pushPull=True, suppressEmpty=True,
+               minInterval=defaultMinInterval, maxInterval=defaultMaxInterval, jitter=defaultJitter, rand=None):
+    self.__log = log
+    self.__peerIds = list(peerIds)
+    self.__fanOut = fanOut
+    self.__pushPull = pushPull
+    self.__suppressEmpty = suppressEmpty
+    self.__minInterval = minInterval
+    self.__maxInterval = maxInterval
+    self.__jitter = jitter
+    self.__random = rand if rand else random.Random()
+    self.__lock = threading.Lock()
+
+    self.__intervals = {}
+    self.__nextSend = {}
+    for peerId in self.__peerIds:
+      self.__intervals[peerId] = minInterval
+      self.__nextSend[peerId] = 0.0
+    self.__suppressedCount = 0
+
+
+  def tickInterval(self):
+    # Gets how often `pickPeers` should be called.
+    return self.__minInterval / 2.0
+
+
+  def received(self, peerId, now):
+    # Tells the scheduler a message was received from the given peer.
+    # With push-pull the peer is due to be sent a reply right away.
+    if self.__pushPull and (peerId in self.__nextSend):
+      with self.__lock:
+        self.__nextSend[peerId] = min(self.__nextSend[peerId], now)
+
+
+  def pickPeers(self, now):
+    # Gets the peers to send to at the given time.
+    with self.__lock:
+      due = [peerId for peerId in self.__peerIds if self.__nextSend[peerId] <= now]
+      if not due:
+        return []
+
+      # Peers with something new go first, then heartbeats to peers at the maximum interval.
+      news = []
+      heartbeats = []
+      for peerId in due:
+        if (not self.__suppressEmpty) or self.__log.hasNewsFor(peerId):
+          news.append(peerId)
+        elif self.__intervals[peerId] >= self.__maxInterval:
+          heartbeats.append(peerId)
+        else:
+          self.__suppressedCount += 1
+          self.__backOff(peerId, now)
+
+      picked = self.__sample(news)
+      if (self.__fanOut is None) or (len(picked) < self.__fanOut):
+        picked.extend(self.__sample(heartbeats, None if self.__fanOut is None else self.__fanOut - len(picked)))
+      for peerId in picked:
+        if peerId in news:
+          self.__intervals[peerId] = self.__minInterval
+          self.__setNext(peerId, now)
+        else:
+          self.__backOff(peerId, now)
+      return picked
+
+
+  def __sample(self, peers, count=-1):
+    # Picks up to count random peers, by default the fan-out.
+    if count == -1:
+      count = self.__fanOut
+    if (count is None) or (count >= len(peers)):
+      return list(peers)
+    return self.__random.sample(peers, count)
+
+
+  def __backOff(self, peerId, now):
+    self.__intervals[peerId] = min(self.__intervals[peerId] * 2.0, self.__maxInterval)
+    self.__setNext(peerId, now)
+
+
+  def __setNext(self, peerId, now):
+    jitter = self.__random.uniform(-self.__jitter, self.__jitter)
+    self.__nextSend[peerId] = now + self.__intervals[peerId] * (1.0 + jitter)
+
+
+  def getStats(self):
+    # Gets the number of times a send was suppressed and the current intervals.
+    with self.__lock:
+      return {
+        'Suppressed': self.__suppressedCount,
+        'Intervals':  dict(self.__intervals),
+      }
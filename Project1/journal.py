@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains the code for an append-only journal with snapshots.
+# Each change is appended to the journal as a length-prefixed, checksummed
+# JSON entry. Once enough entries have been written the owner writes a
+# snapshot of its full state and the journal is emptied. To recover, the
+# snapshot is read and then the entries in the journal are replayed.
+#
+# By default the entries and snapshots are written by a background flusher
+# thread shared by all the journals, so the owner doesn't wait on the disk
+# while holding its locks. The flusher writes everything queued for a journal
+# at once, syncs it once, and skips entries which a queued snapshot replaces.
+# The flusher also syncs, on time, any batch policy journal which has written
+# entries that haven't been synced yet, even if no more entries are written.
+
+import atexit
+import collections
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+
+
+# The fsync policies for the journal:
+# - always: every appended entry is synced to disk before returning.
+# - batch:  entries are flushed to the OS and synced at most once every
+#           `syncInterval` seconds (group commit).
+# - never:  entries are only flushed to the OS, the OS decides when to sync.
+syncAlways = "always"
+syncBatch  = "batch"
+syncNever  = "never"
+
+# The defaults used when a journal is created without them being given.
+defaultSyncPolicy   = syncBatch
+defaultSyncInterval = 0.1  # in seconds
+defaultCompactLimit = 1000 # number of entries before a snapshot should be written
+defaultBackground   = True # write the entries and snapshots on the background flusher thread
+
+# The header for each entry is the length of the entry then the CRC32 of the entry.
+entryHeader = struct.Struct("<II")
+
+writeSeconds    = metrics.getHistogram("journal_write_seconds", "The time to write and sync journal entries.")
+snapshotSeconds = metrics.getHistogram("journal_snapshot_seconds", "The time to write a snapshot.")
+entriesWritten  = metrics.getCounter("journal_entries_total", "The number of journal entries written.")
+
+# The background flusher's queue of (journal, kind, entry or snapshot) and the
+# number of jobs which have been queued and finished, used to wait for a flush.
+flushAppend  = "append"
+flushCompact = "compact"
+flushQueue = collections.deque()
+flushChanged = threading.Condition(threading.Lock())
+flushCounts = [0, 0] # [queued, finished]
+flushThread = None
+
+# The journals with entries written but not synced, to the time they should be synced by.
+syncDue = {}
+
+# The latest journal for each base name, so that opening a journal flushes and
+# closes an older one for the same files first.
+openJournals = {}
+
+
+def checksumOf(payload):
+  # Gets the CRC32 of the given entry. Python 2 may return a negative CRC32
+  # so it is masked to the unsigned value which the entry header holds.
+  return zlib.crc32(payload) & 0xffffffff
+
+
+def replaceFile(source, target):
+  # Moves the source file over the target file. Python 2 doesn't have `os.replace`
+  # and its `os.rename` fails on Windows if the target exists, so it is removed first.
+  if hasattr(os, "replace"):
+    os.replace(source, target)
+  else:
+    if os.name == "nt" and os.path.exists(target):
+      os.remove(target)
+    os.rename(source, target)
+
+
+class journal:
+  # This is a journal for the given file base name. The snapshot is written
+  # to "<baseName>.json" and the journal entries to "<baseName>.journal".
+
+  def __init__(self, baseName, syncPolicy=None, syncInterval=None, compactLimit=None, background=None):
+    self.__snapshotFileName = baseName + ".json"
+    self.__journalFileName = baseName + ".journal"
+    self.__syncPolicy = syncPolicy if syncPolicy else defaultSyncPolicy
+    self.__syncInterval = syncInterval if syncInterval is not None else defaultSyncInterval
+    self.__compactLimit = compactLimit if compactLimit else defaultCompactLimit
+    self.__background = background if background is not None else defaultBackground
+    self.__entryCount = 0
+    self.__lastSync = time.time()
+    self.__file = None
+    self.__unsynced = False
+    self.__fileLock = threading.RLock() # the flusher may sync while the owner writes
+
+    previous = openJournals.get(baseName)
+    if previous:
+      previous.close()
+    openJournals[baseName] = self
+
+
+  def __open(self):
+    # Opens the journal file for appending if it isn't already open.
+    if not self.__file:
+      self.__file = open(self.__journalFileName, "ab")
+
+
+  def load(self):
+    # Reads the snapshot and the journal entries written after it.
+    # Returns the snapshot, or None if there isn't one, and the list of entries.
+    # If the end of the journal is torn or corrupt it is cut off.
+    snapshot = None
+    if os.path.exists(self.__snapshotFileName):
+      f = open(self.__snapshotFileName, "r")
+      data = f.read()
+      f.close()
+      if data:
+        snapshot = json.loads(data)
+
+    entries = []
+    if os.path.exists(self.__journalFileName):
+      f = open(self.__journalFileName, "rb")
+      data = f.read()
+      f.close()
+
+      offset = 0
+      while offset + entryHeader.size <= len(data):
+        length, checksum = entryHeader.unpack_from(data, offset)
+        start = offset + entryHeader.size
+        payload = data[start:start+length]
+        if len(payload) != length or checksumOf(payload) != checksum:
+          break
+        entries.append(json.loads(payload.decode()))
+        offset = start + length
+
+      if offset != len(data):
+        print("Cutting off %d bytes from the end of %s"%(len(data) - offset, self.__journalFileName))
+        f = open(self.__journalFileName, "r+b")
+        f.truncate(offset)
+        f.close()
+
+    self.__entryCount = len(entries)
+    return snapshot, entries
+
+
+  def append(self, entry):
+    # Appends the given entry to the journal and syncs it according to the policy.
+    # Returns true if the journal has gotten long enough that it should be compacted.
+    # In the background the entry must not be changed after it is given.
+    self.__entryCount += 1
+    if self.__background:
+      queueFlush(self, flushAppend, entry)
+    else:
+      with writeSeconds.time():
+        self.__writeEntries([entry])
+    return self.__entryCount >= self.__compactLimit
+
+
+  def __writeEntries(self, entries):
+    # Writes the entries to the journal and syncs them according to the policy.
+    entriesWritten.inc(len(entries))
+    data = bytearray()
+    for entry in entries:
+      payload = json.dumps(entry).encode()
+      data.extend(entryHeader.pack(len(payload), checksumOf(payload)))
+      data.extend(payload)
+    with self.__fileLock:
+      self.__open()
+      self.__file.write(data)
+      self.__file.flush()
+      self.__unsynced = True
+
+      if self.__syncPolicy == syncAlways:
+        self.sync()
+      elif self.__syncPolicy == syncBatch:
+        if time.time() - self.__lastSync >= self.__syncInterval:
+          self.sync()
+        else:
+          # Have the flusher sync these entries if nothing else does in time.
+          queueSync(self, self.__lastSync + self.__syncInterval)
+
+
+  def sync(self):
+    # Forces any written entries to disk.
+    with self.__fileLock:
+      if self.__file and self.__unsynced:
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+      self.__unsynced = False
+      self.__lastSync = time.time()
+
+
+  def compact(self, snapshot):
+    # Writes the given snapshot of the full state and empties the journal.
+    # In the background the snapshot must not be changed after it is given.
+    self.__entryCount = 0
+    if self.__background:
+      queueFlush(self, flushCompact, snapshot)
+    else:
+      with snapshotSeconds.time():
+        self.__writeSnapshot(snapshot)
+
+
+  def __writeSnapshot(self, snapshot):
+    # The snapshot is written to a temporary file and moved into place so
+    # that a crash while writing leaves the previous snapshot and journal.
+    tempFileName = self.__snapshotFileName + ".tmp"
+    f = open(tempFileName, "w")
+    f.write(json.dumps(snapshot))
+    f.flush()
+    if self.__syncPolicy != syncNever:
+      os.fsync(f.fileno())
+    f.close()
+    replaceFile(tempFileName, self.__snapshotFileName)
+
+    with self.__fileLock:
+      self.__closeFile()
+      f = open(self.__journalFileName, "wb")
+      f.close()
+
+
+  def flush(self):
+    # Waits until everything queued for the background flusher has been written.
+    if self.__background:
+      waitForFlush()
+
+
+  def close(self):
+    # Writes anything still queued then syncs and closes the journal file.
+    self.flush()
+    self.__closeFile()
+
+
+  def __closeFile(self):
+    with self.__fileLock:
+      if self.__file:
+        self.sync()
+        self.__file.close()
+        self.__file = None
+
+
+  def runFlush(self, jobs):
+    # Writes the jobs queued for this journal, this is called by the flusher thread.
+    # Only the latest snapshot and the entries after it need to be written.
+    start = 0
+    for i in range(len(jobs)):
+      if jobs[i][0] == flushCompact:
+        start = i
+    jobs = jobs[start:]
+    if jobs[0][0] == flushCompact:
+      with snapshotSeconds.time():
+        self.__writeSnapshot(jobs[0][1])
+      jobs = jobs[1:]
+    if jobs:
+      with writeSeconds.time():
+        self.__writeEntries([entry for kind, entry in jobs])
+
+
+def startFlusher():
+  # Starts the background flusher thread if it isn't running yet.
+  # The flushChanged lock must be held when calling this.
+  global flushThread
+  if flushThread is None:
+    flushThread = threading.Thread(target=runFlusher)
+    flushThread.daemon = True
+    flushThread.start()
+
+
+def queueFlush(j, kind, value):
+  # Queues a job for the background flusher, starting its thread if needed.
+  with flushChanged:
+    startFlusher()
+    flushQueue.append((j, kind, value))
+    flushCounts[0] += 1
+    flushChanged.notify_all()
+
+
+def queueSync(j, due):
+  # Has the background flusher sync the journal by the given time.
+  with flushChanged:
+    startFlusher()
+    if (j not in syncDue) or (due < syncDue[j]):
+      syncDue[j] = due
+      flushChanged.notify_all()
+
+
+def waitForFlush():
+  # Waits until all the jobs queued so far have been written.
+  with flushChanged:
+    target = flushCounts[0]
+    while flushCounts[1] < target:
+      flushChanged.wait()
+
+
+def runFlusher():
+  # This runs on the background flusher thread. It takes everything queued,
+  # groups the jobs by journal, and writes each journal's jobs together.
+  # Between jobs it syncs the journals whose syncs have come due.
+  while True:
+    with flushChanged:
+      while not flushQueue:
+        now = time.time()
+        if syncDue and (min(syncDue.values()) <= now):
+          break
+        flushChanged.wait(min(syncDue.values()) - now if syncDue else None)
+      jobs = list(flushQueue)
+      flushQueue.clear()
+      now = time.time()
+      syncs = [j for j, due in syncDue.items() if due <= now]
+      for j in syncs:
+        del syncDue[j]
+
+    byJournal = collections.OrderedDict()
+    for j, kind, value in jobs:
+      byJournal.setdefault(id(j), (j, []))[1].append((kind, value))
+    for j, journalJobs in byJournal.values():
+      try:
+        j.runFlush(journalJobs)
+      except Exception as e:
+        print("Failed to write journal: %s"%(e))
+
+    for j in syncs:
+      try:
+        j.sync()
+      except Exception as e:
+        print("Failed to sync journal: %s"%(e))
+
+    with flushChanged:
+      flushCounts[1] += len(jobs)
+      flushChanged.notify_all()
+
+
+atexit.register(waitForFlush)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This compares the thread per connection listener with the selector listener
+# by the CPU time, thread count, and memory used with a number of connections
+# open, each sending a small message every second.
+#
+# Example usage:
+# - "python ./listenerBenchmark.py" runs with 10, 50, 100, and 200 connections
+# - "python ./listenerBenchmark.py 20 500" runs with 20 then 500 connections
+
+import resource
+import socket
+import sys
+import threading
+import time
+
+import connections
+
+
+hostAndPort = "127.0.0.1:18520"
+runTime = 5.0 # in seconds, how long to keep the connections open
+
+
+def residentMemory():
+  # Gets the current resident memory, in KB, of this process.
+  # This only works on Linux, otherwise the peak memory is returned.
+  try:
+    f = open("/proc/self/status", "r")
+    for line in f:
+      if line.startswith("VmRSS:"):
+        f.close()
+        return int(line.split()[1])
+    f.close()
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpuTime():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def run(listenerType, connectionCount):
+  received = [0]
+  lock = threading.Lock()
+  def handle(message):
+    with lock:
+      received[0] += 1
+
+  baseThreads = threading.active_count()
+  baseMemory = residentMemory()
+  l = listenerType(handle, hostAndPort, True)
+  time.sleep(0.5)
+
+  parts = hostAndPort.split(':')
+  conns = []
+  for i in range(connectionCount):
+    conns.append(socket.create_connection((parts[0], int(parts[1]))))
+
+  msg = connections.frameMessage('[0, [], [[0]]]')
+  startCpu = cpuTime()
+  start = time.time()
+  maxThreads = 0
+  while time.time() - start < runTime:
+    for conn in conns:
+      conn.sendall(msg)
+    maxThreads = max(maxThreads, threading.active_count() - baseThreads)
+    time.sleep(1.0)
+  cpu = cpuTime() - startCpu
+  memory = residentMemory() - baseMemory
+
+  for conn in conns:
+    conn.close()
+  l.close()
+  time.sleep(1.5)
+
+  print("  %-18s cpu %6.3fs, threads %4d, memory %7d KB, received %d"%(
+    listenerType.__name__, cpu, maxThreads, memory, received[0]))
+
+
+if __name__ == "__main__":
+  counts = [int(arg) for arg in sys.argv[1:]]
+  if not counts:
+    counts = [10, 50, 100, 200]
+  for count in counts:
+    print("%d connections:"%(count))
+    run(connections.listener, count)
+    run(connections.selectorListener, count)
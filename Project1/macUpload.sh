@@ -5,6 +5,13 @@ upload() {
 }
 
 upload $1 $2 ./connections.py
+upload $1 $2 ./journal.py
+upload $1 $2 ./rwLock.py
+upload $1 $2 ./metrics.py
+upload $1 $2 ./codec.py
+upload $1 $2 ./timeTable.py
 upload $1 $2 ./distributedLog.py
+upload $1 $2 ./asyncNode.py
+upload $1 $2 ./gossip.py
 upload $1 $2 ./ourCalendar.py
 upload $1 $2 ./main.py
@@ -6,19 +6,31 @@
 # due M 3/9/2020 by 11:59 PM
 
 # Example usage:
-# - In console 1 call "python ./main.py 0 2"
-# - In console 2 call "python ./main.py 1 2"
+# - In console 1 call "python3 ./main.py 0 2"
+# - In console 2 call "python3 ./main.py 1 2"
 
 import threading
 import sys
 import time
+import json
 
 import connections
 import ourCalendar
 import distributedLog
+import codec
+import asyncNode
+import gossip
+import metrics
 
 
 useMyHost = False
+useSelectorListener = False # True to handle all incoming connections on one thread
+useAsyncRuntime = False # True to run the listener, senders, and gossip on one asyncio thread
+useGossipScheduler = True # True to only gossip with peers which need it, see gossip.py
+gossipFanOut = None # The number of random peers to gossip with each round, None for all
+snapshotChunksPerSend = 8 # The most snapshot chunks sent to a peer at a time, so other peers aren't held up
+metricsEnabled = False # True to collect the metrics shown by the menu, see metrics.py
+metricsHostAndPort = None # The local host and port to serve the metrics on, e.g. "127.0.0.1:9520", or None
 nodeIdToHostsAndPorts = {
   0: "52.38.131.215:8080",
   1: "52.26.86.211:8080",
@@ -26,6 +38,7 @@ nodeIdToHostsAndPorts = {
   3: "18.234.227.138:8080",
 }
 reloadFromFiles = True
+codecs = [codec.BinaryCodec, codec.JsonCodec] # The codecs to use, in order of preference
 
 
 myNodeId = int(sys.argv[1])
@@ -40,19 +53,44 @@ class mainLoopObject:
     self.timeToDie = False
     self.sendMessages = True
 
+    metrics.enabled = metricsEnabled
+    self.metricsServer = None
+    if metricsHostAndPort:
+      self.metricsServer = metrics.server(metricsHostAndPort)
+
     # Create shared calendar and distributed log.
     self.cal = ourCalendar.calendar(myNodeId, reloadFromFiles)
     self.log = distributedLog.distributedLog(self.cal, myNodeId, nodeCount, reloadFromFiles)
 
+    self.node = None
+    self.senders = []
+    self.shareLogThread = None
+    self.scheduler = None
+    if useGossipScheduler:
+      peerIds = [nodeId for nodeId in nodeIdToHostsAndPorts if (nodeId != myNodeId) and (nodeId < nodeCount)]
+      self.scheduler = gossip.scheduler(self.log, peerIds, gossipFanOut)
+    if useAsyncRuntime:
+      # Run the connections and gossip on an event loop in one thread instead.
+      hostsAndPorts = {}
+      for nodeId, hostAndPort in nodeIdToHostsAndPorts.items():
+        if nodeId < nodeCount:
+          hostsAndPorts[nodeId] = hostAndPort
+      self.node = asyncNode.asyncNode(self.log, myNodeId, hostsAndPorts, useMyHost, codecs,
+        gossipFanOut, gossipScheduler=self.scheduler)
+      self.node.startThread()
+      return
+
     # Setup the listener to start watching for incoming messages.
-    self.listener = connections.listener(self.log.receiveMessage, nodeIdToHostsAndPorts[myNodeId], useMyHost)
+    if useSelectorListener:
+      self.listener = connections.selectorListener(self.receiveMessage, nodeIdToHostsAndPorts[myNodeId], useMyHost, codecs)
+    else:
+      self.listener = connections.listener(self.receiveMessage, nodeIdToHostsAndPorts[myNodeId], useMyHost, codecs)
 
     # Setup the collection of connections to talk to the other instances.
-    self.senders = []
     self.senderIDs = []
     for nodeId, hostAndPort in nodeIdToHostsAndPorts.items():
       if (nodeId != myNodeId) and (nodeId < nodeCount):
-        sender = connections.sender(hostAndPort)
+        sender = connections.sender(hostAndPort, codecs)
         self.senders.append(sender)
         self.senderIDs.append(nodeId)
 
@@ -60,32 +98,56 @@ class mainLoopObject:
     self.shareLogThread.start()
 
 
+  def receiveMessage(self, message):
+    # This is called by the listener for each message from another node.
+    fromNodeId = self.log.receiveMessage(message)
+    if self.scheduler:
+      self.scheduler.received(fromNodeId, time.time())
+
+
   def shareLog(self):
     # This is run in a thread to periodically update other threads
-    # with this node's log and time table.
+    # with this node's log and time table. The messages are deltas so
+    # only the time table changes the other node hasn't acknowledged are sent.
     while not self.timeToDie:
+      if self.scheduler:
+        # The scheduler picks which peers need to be sent to.
+        if self.sendMessages:
+          for nodeId in self.scheduler.pickPeers(time.time()):
+            self.sendTo(self.senderIDs.index(nodeId))
+        time.sleep(self.scheduler.tickInterval())
+        continue
       if self.sendMessages:
         for i in range(len(self.senders)):
-          nodeId = self.senderIDs[i]
-          msg = self.log.getSendMessage(nodeId)
-          if msg:
-            self.senders[i].send(msg)
+          self.sendTo(i)
       time.sleep(5)
 
 
+  def sendTo(self, i):
+    # Sends any snapshot messages then the log and time table to the i-th sender's node.
+    nodeId = self.senderIDs[i]
+    for msg in self.log.getSnapshotMessages(nodeId, snapshotChunksPerSend):
+      self.senders[i].send(msg)
+    binary = self.senders[i].getCodec() == codec.BinaryCodec
+    msg = self.log.getSendMessage(nodeId, True, binary)
+    if msg:
+      # A newer log message supersedes any older one still waiting to be sent.
+      self.senders[i].send(msg, True)
+
+
   def insertNewAppointment(self):
-    name = raw_input("Enter Name: ")
+    name = input("Enter Name: ")
 
-    day          = int(raw_input("Enter Day (1-7): "))
-    start_parts  = raw_input("Enter Start Time (e.g., '13:30'): ").split(':')
+    day          = int(input("Enter Day (1-7): "))
+    start_parts  = input("Enter Start Time (e.g., '13:30'): ").split(':')
     hours        = int(start_parts[0])
     minutes      = int(start_parts[1])
     start_time   = hours + minutes / 60.0
-    end_parts    = raw_input("Enter End Time (e.g., '14:30'): ").split(':')
+    end_parts    = input("Enter End Time (e.g., '14:30'): ").split(':')
     hours        = int(end_parts[0])
     minutes      = int(end_parts[1])
     end_time     = hours + minutes / 60.0
-    part_parts   = raw_input("Enter Participants (e.g., '0 1 3'): ").split(' ')
+    part_parts   = input("Enter Participants (e.g., '0 1 3'): ").split(' ')
     participants = [int(participant) for participant in part_parts]
 
     conflict = self.cal.getConflict(day, start_time, end_time, participants)
@@ -97,7 +159,7 @@ class mainLoopObject:
 
 
   def deleteAppointment(self):
-    name = raw_input("Enter Name: ")
+    name = input("Enter Name: ")
     appt = self.cal.getAppointment(name)
     if appt != None:
       if myNodeId in appt.participants:
@@ -108,6 +170,23 @@ class mainLoopObject:
       print("No appointment by that name was found.")
 
 
+  def importAppointments(self):
+    # Reads a JSON file with a list of appointments, each [name, day, start_time, end_time, participants],
+    # the same format as the calendar file, and inserts them all as one batch.
+    # Conflicts are resolved by name like appointments received from other nodes.
+    fileName = input("Enter File Name: ")
+    f = open(fileName, "r")
+    data = json.loads(f.read())
+    f.close()
+
+    ops = []
+    for entry in data:
+      ops.append([distributedLog.InsertOpType, [str(entry[0]), int(entry[1]),
+        float(entry[2]), float(entry[3]), [int(p) for p in entry[4]]]])
+    self.log.applyBatch(ops)
+    print("Imported %d appointments"%(len(ops)))
+
+
   def showAllAppointments(self):
     print("Appointments:")
     appts = self.cal.toString()
@@ -129,14 +208,19 @@ class mainLoopObject:
       print("  "+logs)
     else:
       print("  <None>")
+    stats = self.log.getLogStats()
+    print("Retained %d records %s, trimmed %d, watermarks %s"%(stats["Retained"],
+      stats["RetainedByNode"], stats["Trimmed"], stats["Watermarks"]))
 
 
   def toggleSendingMessages(self):
     self.sendMessages = not self.sendMessages
+    if self.node:
+      self.node.sendMessages = self.sendMessages
 
 
   def showMessage(self):
-    nodeId = int(raw_input("Enter Node Id: "))
+    nodeId = int(input("Enter Node Id: "))
     msg = self.log.getSendMessage(nodeId)
     if msg:
       print("  "+msg)
@@ -144,9 +228,22 @@ class mainLoopObject:
       print("  <None>")
 
 
+  def showMetrics(self):
+    print("Metrics:")
+    if metrics.enabled:
+      print("  "+metrics.defaultRegistry.toText().rstrip("\n").replace("\n", "\n  "))
+    else:
+      print("  <Disabled>")
+
+
   def close(self):
     print("Closing")
     self.timeToDie = True
+    if self.metricsServer:
+      self.metricsServer.close()
+    if self.node:
+      self.node.stopThread()
+      return
     for sender in self.senders:
       sender.close()
     self.listener.close()
@@ -169,10 +266,12 @@ class mainLoopObject:
       else:
         print("  6. Start Sending Messages")
       print("  7. Show Message")
-      print("  8. Exit")
+      print("  8. Import Appointments")
+      print("  9. Show Metrics")
+      print("  10. Exit")
 
       try:
-        choice = int(raw_input("Enter your choice: "))
+        choice = int(input("Enter your choice: "))
       except:
         print("Invalid choice. Try again.")
         continue
@@ -193,6 +292,10 @@ class mainLoopObject:
         elif choice == 7:
           self.showMessage()
         elif choice == 8:
+          self.importAppointments()
+        elif choice == 9:
+          self.showMetrics()
+        elif choice == 10:
           self.close()
         else:
           print("Invalid choice \"%s\". Try again." % (choice))
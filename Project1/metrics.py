@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains a small metrics registry of counters and histograms with
+# fixed buckets. The other files create their metrics when loaded and update
+# them on their hot paths. While `enabled` is false updating a metric only
+# checks the flag, so the metrics cost next to nothing until turned on.
+#
+# The metrics can be shown as text in the Prometheus text format, either from
+# the menu in main.py or from the local HTTP endpoint started by creating a `server`.
+
+import bisect
+import threading
+import time
+
+try:
+  import http.server as httpServer
+except ImportError:
+  import BaseHTTPServer as httpServer
+
+
+# Set this to true to start collecting metrics.
+enabled = False
+
+# The default histogram buckets, in seconds, for timing the hot paths.
+defaultBuckets = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+
+class counter:
+  # This is a count which only goes up.
+
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.__lock = threading.Lock()
+    self.__value = 0
+
+
+  def inc(self, amount=1):
+    if enabled:
+      with self.__lock:
+        self.__value += amount
+
+
+  def get(self):
+    return self.__value
+
+
+  def toText(self):
+    return "# HELP %s %s\n# TYPE %s counter\n%s %s\n"%(
+      self.name, self.help, self.name, self.name, self.__value)
+
+
+class noTimer:
+  # This is the timer given when metrics aren't enabled, it does nothing.
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, excType, excValue, traceback):
+    return False
+
+
+class histogramTimer:
+  # This times the block of a `with` statement into a histogram.
+
+  def __init__(self, hist):
+    self.__hist = hist
+    self.__start = 0.0
+
+
+  def __enter__(self):
+    self.__start = time.time()
+    return self
+
+
+  def __exit__(self, excType, excValue, traceback):
+    self.__hist.observe(time.time() - self.__start)
+    return False
+
+
+theNoTimer = noTimer()
+
+
+class histogram:
+  # This counts the values observed into fixed buckets. Each bucket has the
+  # count of values less than or equal to its bound, plus the count of all.
+
+  def __init__(self, name, help, buckets=None):
+    self.name = name
+    self.help = help
+    self.__bounds = sorted(buckets if buckets else defaultBuckets)
+    self.__lock = threading.Lock()
+    self.__counts = [0] * (len(self.__bounds) + 1)
+    self.__sum = 0.0
+    self.__count = 0
+
+
+  def observe(self, value):
+    if enabled:
+      i = bisect.bisect_left(self.__bounds, value)
+      with self.__lock:
+        self.__counts[i] += 1
+        self.__sum += value
+        self.__count += 1
+
+
+  def time(self):
+    # Gets a timer for a `with` statement which observes how long its block takes.
+    if enabled:
+      return histogramTimer(self)
+    return theNoTimer
+
+
+  def getCount(self):
+    return self.__count
+
+
+  def toText(self):
+    with self.__lock:
+      counts = self.__counts[:]
+      total = self.__sum
+      count = self.__count
+    lines = ["# HELP %s %s"%(self.name, self.help), "# TYPE %s histogram"%(self.name)]
+    cumulative = 0
+    for bound, bucketCount in zip(self.__bounds, counts):
+      cumulative += bucketCount
+      lines.append('%s_bucket{le="%g"} %d'%(self.name, bound, cumulative))
+    lines.append('%s_bucket{le="+Inf"} %d'%(self.name, count))
+    lines.append("%s_sum %f"%(self.name, total))
+    lines.append("%s_count %d"%(self.name, count))
+    return "\n".join(lines) + "\n"
+
+
+class registry:
+  # This is a collection of metrics by name. Asking for a metric which
+  # already exists gives the existing metric.
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__metrics = {}
+
+
+  def counter(self, name, help=""):
+    return self.__get(name, lambda: counter(name, help))
+
+
+  def histogram(self, name, help="", buckets=None):
+    return self.__get(name, lambda: histogram(name, help, buckets))
+
+
+  def __get(self, name, create):
+    with self.__lock:
+      metric = self.__metrics.get(name)
+      if metric is None:
+        metric = create()
+        self.__metrics[name] = metric
+      return metric
+
+
+  def toText(self):
+    # Gets all of the metrics, sorted by name, in the Prometheus text format.
+    with self.__lock:
+      metrics = [self.__metrics[name] for name in sorted(self.__metrics)]
+    return "".join(metric.toText() for metric in metrics)
+
+
+defaultRegistry = registry()
+
+
+def getCounter(name, help=""):
+  return defaultRegistry.counter(name, help)
+
+
+def getHistogram(name, help="", buckets=None):
+  return defaultRegistry.histogram(name, help, buckets)
+
+
+class server:
+  # This is a local HTTP endpoint which replies to any GET with the metrics as text.
+
+  def __init__(self, hostAndPort, reg=None):
+    reg = reg if reg else defaultRegistry
+    class handler(httpServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = reg.toText().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    parts = hostAndPort.split(':')
+    self.__httpServer = httpServer.HTTPServer((parts[0], int(parts[1])), handler)
+    self.__thread = threading.Thread(target=self.__httpServer.serve_forever)
+    self.__thread.daemon = True
+    self.__thread.start()
+
+
+  def close(self):
+    self.__httpServer.shutdown()
+    self.__httpServer.server_close()
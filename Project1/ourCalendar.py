@@ -11,6 +11,17 @@
 import threading
 import json
 import math
+import bisect
+
+import journal
+import metrics
+
+
+# The types of changes written to the journal, these match the distributed log's operations.
+InsertOpType = "Insert"
+DeleteOpType = "Delete"
+
+conflictSeconds = metrics.getHistogram("calendar_find_conflicts_seconds", "The time to find an appointment's conflicts.")
 
 
 dayNumberToName = {
@@ -55,6 +66,11 @@ class appointment:
        (self.day == other.day and self.start_time == other.start_time and self.end_time == other.end_time and self.name > other.name)
 
 
+  def sortKey(self):
+    # The key appointments are sorted by, this is the same order as laterTime.
+    return (self.day, self.start_time, self.end_time, self.name)
+
+
   def toString(self):
     dayName = dayNumberToName[self.day]
 
@@ -77,49 +93,90 @@ class appointment:
 class calendar:
   def __init__(self, nodeId, loadFile):
     self.__nodeId = nodeId
-    self.__appointments = []
     self.__lockCal = threading.Lock()
 
+    # The appointments sorted by day, start_time, end_time, then name
+    # and the matching sort keys so that they can be bisected.
+    self.__appointments = []
+    self.__apptKeys = []
+
+    # The appointments by name. Names should be unique but two nodes could
+    # insert the same name at once, so each name has a list of appointments.
+    self.__byName = {}
+
+    # The interval index, for each (day, participant) this has the appointments'
+    # (start_time, end_time, name) sorted and the matching appointments.
+    # Since conflicts are always deleted right after being found, the intervals
+    # for one (day, participant) don't overlap so they are also sorted by end_time.
+    self.__indexKeys = {}
+    self.__indexAppts = {}
+    self.__journal = journal.journal(self.__getAppointmentsFileBaseName())
+    self.__unsavedChanges = []
+    self.__batchDepth = 0
+
+    # When not loading, the files from an earlier run are left alone
+    # until the first change, which replaces them with a snapshot.
+    self.__replaceFiles = not loadFile
     if loadFile:
       self.__readAppointmentsFromFile()
 
  
   def __findByName(self, name):
-    for appt in self.__appointments:
-      if appt.name == name:
-        return appt
+    appts = self.__byName.get(name)
+    if appts:
+      return appts[0]
     return None
 
 
   def getConflict(self, day, start_time, end_time, participants):
     with self.__lockCal:
       fakeAppt = appointment("fake", day, start_time, end_time, participants)
-      for appt in self.__appointments:
-        if appt.isConflicting(fakeAppt):
-          return appt
-      return None
-  
-
-  def __findConflicts(self):
-    def getName(appt):
-      return appt.name
-
-    apptByName = self.__appointments[:]
-    apptByName.sort(key = getName)
-
+      first = None
+      for appt in self.__findOverlapping(fakeAppt):
+        if (first is None) or first.laterTime(appt):
+          first = appt
+      return first
+
+
+  def __findOverlapping(self, appt):
+    # Finds all the other appointments which are in conflict with the given appointment
+    # by looking up each of its participants in the interval index.
+    found = {}
+    for participant in appt.participants:
+      key = (appt.day, participant)
+      keys = self.__indexKeys.get(key)
+      if not keys:
+        continue
+      appts = self.__indexAppts[key]
+
+      # Start from the last interval starting before the appointment ends and step
+      # back until the intervals end before the appointment starts.
+      i = bisect.bisect_left(keys, (appt.end_time,)) - 1
+      while i >= 0 and keys[i][1] > appt.start_time:
+        other = appts[i]
+        if other is not appt:
+          found[id(other)] = other
+        i -= 1
+    return list(found.values())
+
+
+  def __findConflicts(self, appt):
     # Find all conflicts sorted by name (unique arbitrary),
     # if there are conflicts the first name will win, the second is in conflict.
     # Only conflicts if overlapping times and participants.
-    inConflictNames = []
-    for i in range(len(apptByName)-1, -1, -1):
-      first = apptByName[i]
-      if not first.name in inConflictNames:
-        for j in range(i-1, -1, -1):
-          second = apptByName[j]
-          if not second.name in inConflictNames:
-            if first.isConflicting(second):
-              inConflictNames.append(second.name)
-    return inConflictNames
+    # Since the other appointments aren't in conflict with each other, if any
+    # appointment overlapping the new one has a later name the new one loses,
+    # otherwise all the overlapping appointments lose.
+    def getName(appt):
+      return appt.name
+
+    with conflictSeconds.time():
+      others = self.__findOverlapping(appt)
+      for other in others:
+        if other.name > appt.name:
+          return [appt.name]
+      others.sort(key = getName, reverse = True)
+      return [other.name for other in others]
 
 
   def getAppointment(self, name):
@@ -131,28 +188,105 @@ class calendar:
     # This returns the name of any appointment in conflict
     with self.__lockCal:
       appt = appointment(name, day, start_time, end_time, participants)
-
-      # Insert sort new appointment by day and start_time
-      found = False
-      for i in range(len(self.__appointments)-1, -1, -1):
-        if not self.__appointments[i].laterTime(appt):
-          self.__appointments.insert(i+1, appt)
-          found = True
-          break
-      if not found:
-        self.__appointments.insert(0, appt)
-
-      inConflictNames = self.__findConflicts()
-      self.__writeAppointmentsToFile()
+      self.__addAppointment(appt)
+      inConflictNames = self.__findConflicts(appt)
+      self.__saveChange(InsertOpType, appt.toTuple())
       return inConflictNames
 
 
+  def __addAppointment(self, appt):
+    # Insert sort new appointment by day and start_time
+    key = appt.sortKey()
+    i = bisect.bisect_right(self.__apptKeys, key)
+    self.__apptKeys.insert(i, key)
+    self.__appointments.insert(i, appt)
+    self.__byName.setdefault(appt.name, []).append(appt)
+
+    # Add the appointment into the interval index.
+    indexKey = (appt.start_time, appt.end_time, appt.name)
+    for participant in appt.participants:
+      key = (appt.day, participant)
+      keys = self.__indexKeys.setdefault(key, [])
+      appts = self.__indexAppts.setdefault(key, [])
+      i = bisect.bisect_right(keys, indexKey)
+      keys.insert(i, indexKey)
+      appts.insert(i, appt)
+
+
+  def __loadAppointments(self, appts):
+    # Adds many appointments at once by sorting them once instead of
+    # insert sorting each one, this is used when starting up.
+    appts = self.__appointments + appts
+    appts.sort(key = appointment.sortKey)
+    self.__appointments = appts
+    self.__apptKeys = [appt.sortKey() for appt in appts]
+
+    self.__byName = {}
+    byIndexKey = {}
+    for appt in appts:
+      self.__byName.setdefault(appt.name, []).append(appt)
+      for participant in appt.participants:
+        byIndexKey.setdefault((appt.day, participant), []).append(appt)
+
+    # The appointments are sorted by day, start_time, end_time, and name so
+    # each participant's appointments are already in the interval index's order.
+    self.__indexKeys = {}
+    self.__indexAppts = {}
+    for key, others in byIndexKey.items():
+      self.__indexKeys[key] = [(other.start_time, other.end_time, other.name) for other in others]
+      self.__indexAppts[key] = others
+
+
+  def __removeAppointment(self, appt):
+    i = bisect.bisect_left(self.__apptKeys, appt.sortKey())
+    while self.__appointments[i] is not appt:
+      i += 1
+    del self.__apptKeys[i]
+    del self.__appointments[i]
+    appts = self.__byName[appt.name]
+    appts.remove(appt)
+    if not appts:
+      del self.__byName[appt.name]
+
+    # Remove the appointment from the interval index.
+    indexKey = (appt.start_time, appt.end_time, appt.name)
+    for participant in appt.participants:
+      key = (appt.day, participant)
+      keys = self.__indexKeys[key]
+      appts = self.__indexAppts[key]
+      i = bisect.bisect_left(keys, indexKey)
+      while appts[i] is not appt:
+        i += 1
+      del keys[i]
+      del appts[i]
+      if not keys:
+        del self.__indexKeys[key]
+        del self.__indexAppts[key]
+
+
   def delete(self, apptName):
     with self.__lockCal:
       appt = self.__findByName(apptName)
       if appt:
-        self.__appointments.remove(appt)
-        self.__writeAppointmentsToFile()
+        self.__removeAppointment(appt)
+        self.__saveChange(DeleteOpType, apptName)
+
+
+  def getSnapshot(self):
+    # Gets the tuples of all the appointments, used to bootstrap another node.
+    with self.__lockCal:
+      return [appt.toTuple() for appt in self.__appointments]
+
+
+  def installSnapshot(self, tuples):
+    # Replaces all the appointments with the given appointment tuples
+    # from another node's snapshot and writes them as this calendar's snapshot.
+    with self.__lockCal:
+      self.__appointments = []
+      self.__apptKeys = []
+      self.__loadAppointments([appointment(entry[0], entry[1], entry[2], entry[3], entry[4]) for entry in tuples])
+      self.__unsavedChanges = []
+      self.__journal.compact([appt.toTuple() for appt in self.__appointments])
 
 
   def toString(self):
@@ -163,31 +297,61 @@ class calendar:
     return "\n  ".join(parts)
 
 
-  def __getAppointmentsFileName(self):
-    return "calendar%d.json"%self.__nodeId
+  def __getAppointmentsFileBaseName(self):
+    return "calendar%d"%self.__nodeId
 
 
   def __readAppointmentsFromFile(self):
+    # Recovers the appointments from the snapshot then replays the journal entries
+    # written after it. Each entry is a list of changes, either an inserted
+    # appointment's tuple or a deleted appointment's name. Since the snapshot may have been written without
+    # the journal being emptied, inserts of appointments which exist are skipped.
     try:
-      f = open(self.__getAppointmentsFileName(), "r")
-      msg = f.read()
-      f.close()
-
-      if msg:
-        data = json.loads(msg)
-        for entry in data:
-          self.insert(entry[0], entry[1], entry[2], entry[3], entry[4])
+      snapshot, entries = self.__journal.load()
+      if snapshot:
+        self.__loadAppointments([appointment(entry[0], entry[1], entry[2], entry[3], entry[4]) for entry in snapshot])
+      for entry in entries:
+        for opType, opArgs in entry:
+          if opType == InsertOpType:
+            if not self.__findByName(opArgs[0]):
+              self.__addAppointment(appointment(opArgs[0], opArgs[1], opArgs[2], opArgs[3], opArgs[4]))
+          else:
+            appt = self.__findByName(opArgs)
+            if appt:
+              self.__removeAppointment(appt)
     except Exception as e:
       print("Failed to load from calendar file: %s"%(e))
 
 
-  def __writeAppointmentsToFile(self):
-    tuples = []
-    for appt in self.__appointments:
-      tuples.append(appt.toTuple())
-    msg = json.dumps(tuples)
+  def startBatch(self):
+    # Starts a batch of changes, the changes aren't journaled until the batch is finished.
+    with self.__lockCal:
+      self.__batchDepth += 1
 
-    f = open(self.__getAppointmentsFileName(), "w")
-    f.write(msg)
-    f.close()
 
+  def finishBatch(self):
+    # Finishes a batch of changes and journals all of the changes as one entry.
+    with self.__lockCal:
+      self.__batchDepth -= 1
+      self.__saveChanges()
+
+
+  def __saveChange(self, opType, opArgs):
+    self.__unsavedChanges.append([opType, opArgs])
+    if self.__batchDepth <= 0:
+      self.__saveChanges()
+
+
+  def __saveChanges(self):
+    # Appends the changes to the journal. When the journal
+    # has gotten long a snapshot is written instead.
+    if self.__batchDepth > 0 or not self.__unsavedChanges:
+      return
+    changes = self.__unsavedChanges
+    self.__unsavedChanges = []
+    if self.__replaceFiles or self.__journal.append(changes):
+      self.__replaceFiles = False
+      tuples = []
+      for appt in self.__appointments:
+        tuples.append(appt.toTuple())
+      self.__journal.compact(tuples)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains a reader/writer lock. Any number of readers can hold
+# the lock at once but a writer holds it alone. Waiting writers go before
+# new readers so that a steady stream of readers can't starve a writer.
+
+import contextlib
+import threading
+
+
+class rwLock:
+
+  def __init__(self):
+    self.__changed = threading.Condition(threading.Lock())
+    self.__readers = 0
+    self.__writing = False
+    self.__waitingWriters = 0
+
+
+  def acquireRead(self):
+    with self.__changed:
+      while self.__writing or self.__waitingWriters:
+        self.__changed.wait()
+      self.__readers += 1
+
+
+  def releaseRead(self):
+    with self.__changed:
+      self.__readers -= 1
+      if not self.__readers:
+        self.__changed.notify_all()
+
+
+  def acquireWrite(self):
+    with self.__changed:
+      self.__waitingWriters += 1
+      while self.__writing or self.__readers:
+        self.__changed.wait()
+      self.__waitingWriters -= 1
+      self.__writing = True
+
+
+  def releaseWrite(self):
+    with self.__changed:
+      self.__writing = False
+      self.__changed.notify_all()
+
+
+  @contextlib.contextmanager
+  def reading(self):
+    # Use with a `with` statement to hold the lock as a reader.
+    self.acquireRead()
+    try:
+      yield
+    finally:
+      self.releaseRead()
+
+
+  @contextlib.contextmanager
+  def writing(self):
+    # Use with a `with` statement to hold the lock as the writer.
+    self.acquireWrite()
+    try:
+      yield
+    finally:
+      self.releaseWrite()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains a deterministic simulator for the distributed log. It runs
+# a number of distributed logs and calendars in one process with a simulated
+# network between them instead of sockets. Time is simulated too, the events
+# (gossip rounds, message deliveries, and workload operations) are run in order
+# of their simulated time, so a run with the same seed always gives the same result.
+#
+# It reports:
+# - ops/sec:     the operations and received messages handled per second of real time
+# - convergence: the simulated time from the end of the workload until every calendar matches
+# - log size:    the number of records retained in all the logs over simulated time
+# - bytes:       the number of bytes of messages gossiped
+#
+# Example usage:
+# - "python ./simulator.py" runs with 10, 50, and 100 nodes
+# - "python ./simulator.py 200 500" runs with 200 then 500 nodes
+
+import heapq
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import ourCalendar
+import distributedLog
+import journal
+import gossip
+
+
+snapshotChunksPerSend = 8 # the most snapshot chunks sent to a peer each round
+
+
+class network:
+  # This is the simulated network between the nodes. Each message is delayed by
+  # the latency plus a random jitter and is lost with the given probability.
+  # A partition is (start, end, groups) where between the start and end times,
+  # messages between nodes in different groups are lost. Nodes not in any group
+  # are in a group by themselves.
+
+  def __init__(self, latency=0.05, jitter=0.02, lossRate=0.0, partitions=None):
+    self.latency = latency
+    self.jitter = jitter
+    self.lossRate = lossRate
+    self.partitions = partitions if partitions else []
+
+
+  def delay(self, rand, now, fromNodeId, toNodeId):
+    # Gets how long the message will take to be delivered or None if it is lost.
+    for start, end, groups in self.partitions:
+      if start <= now < end and not self.__sameGroup(groups, fromNodeId, toNodeId):
+        return None
+    if rand.random() < self.lossRate:
+      return None
+    return self.latency + rand.uniform(0.0, self.jitter)
+
+
+  def __sameGroup(self, groups, a, b):
+    for group in groups:
+      if a in group:
+        return b in group
+    return False
+
+
+class workload:
+  # This is the workload of operations run against random nodes. For the given
+  # duration, operations are started at the given rate across all of the nodes.
+  # Each operation is an insert of a short appointment for a few participants
+  # or, with the given probability, a delete of an appointment the node has seen.
+
+  def __init__(self, duration=10.0, opsPerSecond=20.0, deleteRate=0.2, participantCount=3):
+    self.duration = duration
+    self.opsPerSecond = opsPerSecond
+    self.deleteRate = deleteRate
+    self.participantCount = participantCount
+
+
+class simulator:
+  # This runs the given number of nodes with the network and workload.
+  # Each node gossips with `fanOut` random peers, or all of them if None,
+  # every `gossipInterval` seconds of simulated time. If `schedulerOptions` is
+  # given, each node instead uses a gossip scheduler created with those options.
+
+  def __init__(self, nodeCount, net=None, work=None, gossipInterval=1.0, fanOut=None,
+               seed=0, sampleInterval=1.0, maxTime=600.0, schedulerOptions=None):
+    self.__nodeCount = nodeCount
+    self.__net = net if net else network()
+    self.__work = work if work else workload()
+    self.__gossipInterval = gossipInterval
+    self.__fanOut = fanOut
+    self.__schedulerOptions = schedulerOptions
+    self.__random = random.Random(seed)
+    self.__sampleInterval = sampleInterval
+    self.__maxTime = maxTime
+
+    self.__events = [] # a heap of (time, event order, method, args)
+    self.__eventCount = 0
+    self.__now = 0.0
+
+    self.__cals = []
+    self.__logs = []
+    self.__names = [] # the appointment names each node has inserted
+    self.__schedulers = []
+    self.__opCount = 0
+    self.__receiveCount = 0
+    self.__messageCount = 0
+    self.__lostCount = 0
+    self.__bytesSent = 0
+    self.__logSizes = [] # (time, records retained in all logs)
+
+
+  def __schedule(self, delay, method, *args):
+    self.__eventCount += 1
+    heapq.heappush(self.__events, (self.__now + delay, self.__eventCount, method, args))
+
+
+  def run(self):
+    # Runs the simulation and returns the results. The logs and calendars write
+    # their journals into a temporary folder which is removed afterwards.
+    oldDir = os.getcwd()
+    oldPolicy = journal.defaultSyncPolicy
+    tempDir = tempfile.mkdtemp()
+    os.chdir(tempDir)
+    journal.defaultSyncPolicy = journal.syncNever
+    try:
+      return self.__run()
+    finally:
+      journal.waitForFlush()
+      journal.defaultSyncPolicy = oldPolicy
+      os.chdir(oldDir)
+      shutil.rmtree(tempDir, ignore_errors=True)
+
+
+  def __run(self):
+    for nodeId in range(self.__nodeCount):
+      cal = ourCalendar.calendar(nodeId, False)
+      self.__cals.append(cal)
+      self.__logs.append(distributedLog.distributedLog(cal, nodeId, self.__nodeCount, False))
+      self.__names.append([])
+      if self.__schedulerOptions is not None:
+        peerIds = [other for other in range(self.__nodeCount) if other != nodeId]
+        self.__schedulers.append(gossip.scheduler(self.__logs[nodeId], peerIds,
+          rand=self.__random, **self.__schedulerOptions))
+      # Start the gossip at a random point of the interval so the nodes aren't in lock step.
+      self.__schedule(self.__random.uniform(0.0, self.__gossipInterval), self.__gossip, nodeId)
+
+    opCount = int(self.__work.duration * self.__work.opsPerSecond)
+    for i in range(opCount):
+      self.__schedule(self.__random.uniform(0.0, self.__work.duration), self.__operation, i)
+    self.__schedule(0.0, self.__sample)
+
+    start = time.time()
+    convergedTime = None
+    while self.__events and self.__now < self.__maxTime:
+      self.__now, order, method, args = heapq.heappop(self.__events)
+      method(*args)
+      if (method == self.__sample) and (self.__now >= self.__work.duration) and self.__converged():
+        convergedTime = self.__now
+        break
+    elapsed = time.time() - start
+
+    handled = self.__opCount + self.__receiveCount
+    return {
+      'Nodes':           self.__nodeCount,
+      'Operations':      self.__opCount,
+      'OpsPerSecond':    handled / elapsed if elapsed > 0 else 0.0,
+      'ConvergenceTime': (convergedTime - self.__work.duration) if convergedTime is not None else None,
+      'Messages':        self.__messageCount,
+      'Lost':            self.__lostCount,
+      'Bytes':           self.__bytesSent,
+      'LogSizes':        self.__logSizes,
+      'RealTime':        elapsed,
+    }
+
+
+  def __operation(self, i):
+    # Runs one operation of the workload on a random node.
+    nodeId = self.__random.randrange(self.__nodeCount)
+    names = self.__names[nodeId]
+    if names and self.__random.random() < self.__work.deleteRate:
+      name = names.pop(self.__random.randrange(len(names)))
+      self.__logs[nodeId].delete(name)
+    else:
+      name = "appt%d"%(i)
+      day = self.__random.randint(1, 7)
+      start_time = self.__random.randint(0, 46) / 2.0
+      end_time = start_time + 0.5
+      count = min(self.__work.participantCount, self.__nodeCount)
+      participants = sorted(self.__random.sample(range(self.__nodeCount), count))
+      self.__logs[nodeId].insert(name, day, start_time, end_time, participants)
+      names.append(name)
+    self.__opCount += 1
+
+
+  def __pickPeers(self, nodeId):
+    peers = [other for other in range(self.__nodeCount) if other != nodeId]
+    if (self.__fanOut is None) or (self.__fanOut >= len(peers)):
+      return peers
+    return self.__random.sample(peers, self.__fanOut)
+
+
+  def __gossip(self, nodeId):
+    # Sends the node's gossip messages and schedules its next round.
+    if self.__schedulers:
+      peers = self.__schedulers[nodeId].pickPeers(self.__now)
+      interval = self.__schedulers[nodeId].tickInterval()
+    else:
+      peers = self.__pickPeers(nodeId)
+      interval = self.__gossipInterval
+    for other in peers:
+      msgs = self.__logs[nodeId].getSnapshotMessages(other, snapshotChunksPerSend)
+      msgs.append(self.__logs[nodeId].getSendMessage(other, True))
+      for msg in msgs:
+        self.__messageCount += 1
+        self.__bytesSent += len(msg)
+        delay = self.__net.delay(self.__random, self.__now, nodeId, other)
+        if delay is None:
+          self.__lostCount += 1
+        else:
+          self.__schedule(delay, self.__deliver, other, msg)
+    self.__schedule(interval, self.__gossip, nodeId)
+
+
+  def __deliver(self, nodeId, msg):
+    fromNodeId = self.__logs[nodeId].receiveMessage(msg)
+    if self.__schedulers:
+      self.__schedulers[nodeId].received(fromNodeId, self.__now)
+    self.__receiveCount += 1
+
+
+  def __sample(self):
+    # Records the size of the logs and schedules the next sample.
+    retained = 0
+    for log in self.__logs:
+      retained += log.getLogStats()["Retained"]
+    self.__logSizes.append((self.__now, retained))
+    self.__schedule(self.__sampleInterval, self.__sample)
+
+
+  def __converged(self):
+    # Determines if every calendar has the same appointments.
+    first = self.__cals[0].toString()
+    for cal in self.__cals[1:]:
+      if cal.toString() != first:
+        return False
+    return True
+
+
+def printResults(results):
+  print("%d nodes, %d operations:"%(results['Nodes'], results['Operations']))
+  print("  ops/sec:     %.1f (%.2fs real time)"%(results['OpsPerSecond'], results['RealTime']))
+  if results['ConvergenceTime'] is None:
+    print("  convergence: did not converge")
+  else:
+    print("  convergence: %.2fs after the workload"%(results['ConvergenceTime']))
+  print("  messages:    %d sent, %d lost, %d bytes"%(results['Messages'], results['Lost'], results['Bytes']))
+  sizes = results['LogSizes']
+  step = max(1, len(sizes) // 10)
+  print("  log size:    " + ", ".join("%d@%.0fs"%(size, t) for t, size in sizes[::step]))
+
+
+if __name__ == "__main__":
+  counts = [int(arg) for arg in sys.argv[1:]]
+  if not counts:
+    counts = [10, 50, 100]
+  for count in counts:
+    print("Every peer every round:")
+    printResults(simulator(count).run())
+    print("Gossip scheduler:")
+    printResults(simulator(count, schedulerOptions={}).run())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 1 (Replicated Log Project)
+# due M 3/9/2020 by 11:59 PM
+
+# This file contains the time table used by the distributed log.
+# When NumPy is available the table is an int64 matrix so that merging
+# another node's table is a single vectorized maximum, otherwise the
+# table is a list of lists and merged with Python loops.
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Set this to false to always use the pure Python time table.
+useNumpy = True
+
+
+class timeTable:
+  # This is an N by N table where T[x, y] is the newest time of the
+  # records from node y which node x is known to have.
+
+  def __init__(self, nodeCount):
+    self.__nodeCount = nodeCount
+    self.__useNumpy = useNumpy and (numpy is not None)
+    if self.__useNumpy:
+      self.__cells = numpy.zeros((nodeCount, nodeCount), dtype=numpy.int64)
+    else:
+      self.__cells = []
+      for i in range(nodeCount):
+        self.__cells.append([0] * nodeCount)
+
+
+  def get(self, x, y):
+    if self.__useNumpy:
+      return int(self.__cells[x, y])
+    return self.__cells[x][y]
+
+
+  def set(self, x, y, value):
+    if self.__useNumpy:
+      self.__cells[x, y] = value
+    else:
+      self.__cells[x][y] = value
+
+
+  def row(self, x):
+    # Gets a copy of the given row as a list.
+    if self.__useNumpy:
+      return self.__cells[x].tolist()
+    return self.__cells[x][:]
+
+
+  def columnMin(self, y):
+    # Gets the minimum of the given column, the newest time of the
+    # records from node y which every node is known to have.
+    if self.__useNumpy:
+      return int(self.__cells[:, y].min())
+    return min(row[y] for row in self.__cells)
+
+
+  def mergeRow(self, x, values):
+    # Sets T[x, y] = max(T[x, y], values[y]) for all y.
+    # Returns the list of [x, y, value] for the cells which changed.
+    if self.__useNumpy:
+      values = numpy.asarray(values, dtype=numpy.int64)
+      changed = numpy.nonzero(values > self.__cells[x])[0]
+      if not len(changed):
+        return []
+      self.__cells[x, changed] = values[changed]
+      return [[x, int(y), int(values[y])] for y in changed]
+
+    changes = []
+    row = self.__cells[x]
+    for y in range(self.__nodeCount):
+      if values[y] > row[y]:
+        row[y] = values[y]
+        changes.append([x, y, values[y]])
+    return changes
+
+
+  def merge(self, other):
+    # Sets T[x, y] = max(T[x, y], other[x, y]) for all x and y.
+    # Returns the list of [x, y, value] for the cells which changed.
+    if self.__useNumpy:
+      other = numpy.asarray(other, dtype=numpy.int64)
+      xs, ys = numpy.nonzero(other > self.__cells)
+      if not len(xs):
+        return []
+      numpy.maximum(self.__cells, other, out=self.__cells)
+      return [[int(x), int(y), int(self.__cells[x, y])] for x, y in zip(xs, ys)]
+
+    changes = []
+    for x in range(self.__nodeCount):
+      row = self.__cells[x]
+      otherRow = other[x]
+      for y in range(self.__nodeCount):
+        if otherRow[y] > row[y]:
+          row[y] = otherRow[y]
+          changes.append([x, y, otherRow[y]])
+    return changes
+
+
+  def toLists(self):
+    # Gets a copy of the table as a list of lists, used for JSON.
+    if self.__useNumpy:
+      return self.__cells.tolist()
+    return [row[:] for row in self.__cells]
+
+
+  def raw(self):
+    # Gets the table for the binary codec. This is the NumPy matrix itself,
+    # so its buffer can be written directly, otherwise the list of lists.
+    return self.__cells
+
+
+  def __str__(self):
+    return str(self.toLists())
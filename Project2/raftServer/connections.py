@@ -13,6 +13,7 @@ import socket
 import sys
 import json
 import select
+import selectors
 
 # helpful links:
 # - https://www.tutorialspoint.com/python/python_multithreading.htm
@@ -60,24 +61,29 @@ class listener:
   def __connection(self, conn, addr):
     # This method handles a connection from a talker and listens to it.
     conn.settimeout(1)
+    partial = ''
     while not self.__timeToDie:
       try:
         data = conn.recv(4096)
-        if data:
-          # Got a message send it to the handle method.
-          parts = data.decode().split('#')
-          for part in parts:
-            if part:
-              msg = ''
+        if not data:
+          # The talker has closed the connection.
+          break
+        # Got a message send it to the handle method. The last part
+        # is kept until the rest of the message has been read.
+        parts = (partial + data.decode()).split('#')
+        partial = parts.pop()
+        for part in parts:
+          if part:
+            msg = ''
+            try:
+              msg = json.loads(part)
+            except Exception as e:
+              print('Error parsing JSON(%s): %s' % (part, e))
+            if msg:
               try:
-                msg = json.loads(part)
+                self.__handleMethod(msg, conn)
               except Exception as e:
-                print('Error parsing JSON(%s): %s' % (part, e))
-              if msg:
-                try:
-                  self.__handleMethod(msg, conn)
-                except Exception as e:
-                  print('Exception in handler of (%s): %s' % (part, e))
+                print('Exception in handler of (%s): %s' % (part, e))
       except socket.timeout: 
         continue
     conn.close()
@@ -88,6 +94,97 @@ class listener:
     self.__timeToDie = True
 
 
+class selectorListener:
+  # This is a listener which handles all of the incoming connections on a single thread
+  # using a selector instead of a thread per connection. It takes the same arguments
+  # and calls `handleMethod` the same way as `listener` so either can be used.
+
+  def __init__(self, handleMethod, hostAndPort, useMyHost):
+    # Creates a new listener to the given host and port.
+    self.__handleMethod = handleMethod
+    self.__timeToDie = False
+
+    # This socket pair is used to wake up the selector when closing.
+    self.__wakeReader, self.__wakeWriter = socket.socketpair()
+
+    parts = hostAndPort.split(':')
+    host = parts[0] if useMyHost else ""
+    port = int(parts[1])
+
+    thread = threading.Thread(target=self.__run, args=(host, port))
+    thread.start()
+
+
+  def __run(self, host, port):
+    # This method runs in a separete thread to accept new connections
+    # and read from all the connections whenever they are ready.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, port))
+    sock.listen(16)
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, None)
+    selector.register(self.__wakeReader, selectors.EVENT_READ, None)
+    while not self.__timeToDie:
+      for key, events in selector.select():
+        if key.fileobj is sock:
+          conn, addr = sock.accept()
+          conn.settimeout(1)
+          # The data for each connection is the part of a message which hasn't been finished.
+          selector.register(conn, selectors.EVENT_READ, [''])
+        elif key.data:
+          self.__read(selector, key.fileobj, key.data)
+
+    for key in list(selector.get_map().values()):
+      if key.data:
+        key.fileobj.close()
+    selector.close()
+    sock.close()
+    self.__wakeReader.close()
+
+
+  def __read(self, selector, conn, partial):
+    # Reads from a connection which is ready, closing it if the talker has.
+    try:
+      data = conn.recv(4096)
+    except socket.timeout:
+      return
+    except socket.error as e:
+      data = None
+    if not data:
+      selector.unregister(conn)
+      conn.close()
+      return
+
+    # Got a message send it to the handle method. The last part
+    # is kept until the rest of the message has been read.
+    parts = (partial[0] + data.decode()).split('#')
+    partial[0] = parts.pop()
+    for part in parts:
+      if part:
+        msg = ''
+        try:
+          msg = json.loads(part)
+        except Exception as e:
+          print('Error parsing JSON(%s): %s' % (part, e))
+        if msg:
+          try:
+            self.__handleMethod(msg, conn)
+          except Exception as e:
+            print('Exception in handler of (%s): %s' % (part, e))
+
+
+  def close(self):
+    # This starts shutting down the listener.
+    # The listener may have already woken up and stopped, so ignore send errors.
+    self.__timeToDie = True
+    try:
+      self.__wakeWriter.send(b'x')
+    except socket.error:
+      pass
+    self.__wakeWriter.close()
+
+
 class sender:
   # This is a class to send messages out the given host and port.
   # This will have a queue of messages which are sent when they can be.
@@ -6,9 +6,12 @@
 # due Apr 6, 2020 by 11:59 PM
 
 import sys
+import heapq
 import json
 import random
 import threading
+import time
+import collections
 
 import connections
 import customTimer
@@ -16,6 +19,7 @@ import customTimer
 
 # The configurations for the raft servers.
 useMyHost = False
+useSelectorListener = False # True to handle all incoming connections on one thread
 nodeIdToURL = {
   0: '35.155.81.205:8080',
   1: '54.244.147.5:8080',
@@ -37,6 +41,12 @@ heartbeatInterval   = 0.1 # Time, in seconds, between an election or a leader's
 heartbeatLowerBound = 1.0 # Lowest random time, in seconds, to add to timeout on heartbeat
 heartbeatUpperBound = 3.0 # Highest random time, in seconds, to add to timeout on heartbeat
 
+maxEntriesPerAppend = 64        # The most log entries sent in one AppendEntries request
+maxBytesPerAppend   = 64 * 1024 # The most bytes of log entries sent in one AppendEntries request
+maxAppendsInFlight  = 4         # The most AppendEntries requests with entries sent to a follower without a reply
+appendRetryTimeout  = 1.0       # Time, in seconds, to wait for a reply before resending from the matchIndex
+snapshotThreshold   = 1000      # The number of applied entries in the log before a snapshot is taken
+
 stateNeutral           = 'neutral'
 stateStartNewGame      = 'start_new_game'
 stateRightBlock        = 'blocking_with_right'
@@ -68,9 +78,23 @@ class mainObject:
     self.leaderNodeId  = -1 # nodeId of who this node thinks is the leader, -1 for not set
     self.votedFor      = -1 # nodeId of who this node has voted for, -1 means not voted yet
     self.pendingEvents = [] # list of dict: {'Type': punch/block, 'Color': Red/Blue, 'Hand': Right/Left}
-    self.log           = [] # list of dict: {'Term': <int>, 'Color':  Red/Blue, 'State': <string>, 'Committed': True/False}
+    self.log           = [] # list of dict: {'Term': <int>, 'Color':  Red/Blue, 'State': <string>}
     self.leaderTimeout = None
 
+    # The snapshot of the applied state replaces the entries up to and including the snapshotIndex
+    # (See section 7 of the paper.) The first entry in the log has the index snapshotIndex+1,
+    # so an entry with a log index `i` is at `self.log[i-self.snapshotIndex-1]`.
+    self.snapshotIndex = -1
+    self.snapshotTerm  = -1
+    self.snapshotState = {} # dict: key = color, value = the state at the snapshotIndex
+
+    # The index of the highest log entry known to be committed and the index of the highest
+    # log entry applied to the state (See the first column on page 4 of the paper.)
+    # An entry is committed when its index is less than or equal to the commitIndex.
+    self.commitIndex  = -1
+    self.lastApplied  = -1
+    self.appliedState = {} # dict: key = color, value = the state of the last applied entry for that color
+
     # VARIABLES USED BY CANDIDATES:
     self.whoVoted = {} # dict: key = nodeId, value = (granted) True/False
     self.electionHeartbeat = None
@@ -79,7 +103,8 @@ class mainObject:
     # dict: key = nodeId, value = the index of the next log entry the leader will send to that
     # follower (See the second column on page 7 of the paper and the sendOutLeaderHeartbeat method.)
     self.nextIndex  = {}
-    self.matchIndex = {} # The index of highest log entry known to be replicated on server.
+    self.matchIndex = {} # The index of highest log entry known to be replicated on server, -1 for none.
+    self.inFlight   = {} # dict: key = nodeId, value = deque of (last index sent, time sent) waiting for replies
     self.leaderHeartbeat = None
 
 
@@ -90,7 +115,9 @@ class mainObject:
     print('%s client connected' % (color))
 
     # Update the client with the state.
-    self.updateClientsForNewCommits(-1)
+    with self.dataLock:
+      state = dict(self.appliedState)
+    self.updateClientsForNewCommits(state)
 
 
   def resetGame(self):
@@ -149,7 +176,7 @@ class mainObject:
           newState = stateRightPunchHit if hit else stateRightPunchMissed
       
       # Write new state to log as an uncommitted entry,
-      # the next heartbeat will pick it up and start sharing it.
+      # it is sent out to the followers right away.
       self.addNewLogEntry(color, newState)
 
 
@@ -175,59 +202,97 @@ class mainObject:
       newState = stateLeftBlock if hand == 'Left' else stateRightBlock
 
       # Write new state to log as an uncommitted entry,
-      # the next heartbeat will pick it up and start sharing it.
+      # it is sent out to the followers right away.
       self.addNewLogEntry(color, newState)
 
 
   def lastLogInfo(self):
     # Gets the last entries on the log.
     with self.dataLock:
-      lastLogIndex = len(self.log)-1
-      lastLogTerm  = -1
-      if lastLogIndex >= 0:
-        lastLogTerm = self.log[lastLogIndex]['Term']
-      return (lastLogIndex, lastLogTerm)
+      lastLogIndex = self.lastIndex()
+      return (lastLogIndex, self.termAt(lastLogIndex))
+
+
+  def lastIndex(self):
+    # Gets the index of the last entry in the log, or of the snapshot if the log is empty.
+    # The data lock must be held when calling this.
+    return self.snapshotIndex + len(self.log)
+
+
+  def termAt(self, index):
+    # Gets the term of the entry at the given index. The index must be at or after the
+    # snapshotIndex, -1 is returned for the snapshotIndex when there is no snapshot.
+    # The data lock must be held when calling this.
+    if index == self.snapshotIndex:
+      return self.snapshotTerm
+    return self.log[index-self.snapshotIndex-1]['Term']
+
+
+  def firstIndexOfTerm(self, termNum):
+    # Gets the index of the first entry in the log with a term greater than or equal to
+    # the given term, or the index after the last entry if there isn't one. The terms only
+    # increase along the log so this is a binary search. Entries in the snapshot aren't
+    # searched. The data lock must be held when calling this.
+    low  = 0
+    high = len(self.log)
+    while low < high:
+      mid = (low + high) // 2
+      if self.log[mid]['Term'] < termNum:
+        low = mid + 1
+      else:
+        high = mid
+    return self.snapshotIndex + 1 + low
 
 
   def lastCommittedIndex(self):
     # Gets the index of the last committed index in the log.
     with self.dataLock:
-      for i in reversed(range(len(self.log))):
-        if self.log[i]['Committed']:
-          return i
-      return -1
+      return self.commitIndex
 
 
   def addNewLogEntry(self, color, state):
     # This will append a new log entry which sets our color (variable) to state (value).
+    # If this is the leader the entry is sent to the followers right away.
     print('New Log Entry: %s <- %s' % (color, state))
     with self.dataLock:
       self.log.append({
         'Term':      self.currentTerm,
         'Color':     color,
         'State':     state,
-        'Committed': False,
       })
+    if self.nodeStatus == statusLeader:
+      for nodeId in self.senders.keys():
+        if nodeId != myNodeId:
+          self.replicateTo(nodeId, False)
 
 
   def getLogValue(self, color):
-    # This will find the most recent state (value) for the given color (variable).
+    # This will find the most recent committed state (value) for the given color (variable).
     with self.dataLock:
-      for entry in reversed(self.log):
-        if entry['Committed'] and (entry['Color'] == color):
-          return entry['State']
-      return stateNeutral
+      return self.appliedState.get(color, stateNeutral)
 
 
-  def getLogNewestValue(self, color, lowestIndex):
-    # This will find the most recent state (value) for the given color (variable)
-    # which is above the given 'lowIndex'. This is used to find recently committed.
-    with self.dataLock:
-      for entry in reversed(self.log[lowestIndex:]):
-        if entry['Committed'] and (entry['Color'] == color):
-          return (True, entry['State'])
-      return (False, stateNeutral)
-  
+  def applyCommitted(self):
+    # Applies the entries from lastApplied up to the commitIndex to the state.
+    # Returns the newest state for each color which was changed.
+    # The data lock must be held when calling this.
+    changed = {}
+    while self.lastApplied < self.commitIndex:
+      self.lastApplied += 1
+      entry = self.log[self.lastApplied-self.snapshotIndex-1]
+      self.appliedState[entry['Color']] = entry['State']
+      changed[entry['Color']] = entry['State']
+    return changed
+
+
+  def takeSnapshot(self):
+    # Replaces the applied entries in the log with a snapshot of the applied state.
+    # The data lock must be held when calling this.
+    self.snapshotTerm  = self.termAt(self.lastApplied)
+    self.snapshotState = dict(self.appliedState)
+    del self.log[:self.lastApplied-self.snapshotIndex]
+    self.snapshotIndex = self.lastApplied
+
 
   #=========================================================
   # Candidate Election (RequestVote) Message Handlers
@@ -306,38 +371,88 @@ class mainObject:
     # This method is called periodically by a timer.
     # Even empty the AppendEntries works as a heartbeat.
     if self.nodeStatus == statusLeader:
-
-      # Send the sequence of log entries from nextIndex to lastLogIndex, which will in general be
-      # different for each follower.
-      lastLogIndex, lastLogTerm = self.lastLogInfo()
-      leaderCommit = self.lastCommittedIndex()
       for nodeId in self.senders.keys():
-        if nodeId == myNodeId:
-          # Skip over my nodeId since I'm the leader.
-          continue
+        if nodeId != myNodeId:
+          self.replicateTo(nodeId, True)
+
 
-        if self.nextIndex[nodeId] > lastLogIndex:
-          # for a heartbeat
-          entries = []
+  def replicateTo(self, nodeId, heartbeat):
+    # Sends the follower the log entries from its nextIndex in batches, while there are
+    # fewer than `maxAppendsInFlight` requests waiting for replies. The nextIndex is moved
+    # past the sent entries without waiting for the reply so the requests are pipelined.
+    # If `heartbeat` is true and no entries were sent, an empty AppendEntries is sent.
+    # The messages are sent while holding the data lock so they stay in order.
+    with self.dataLock:
+      if (self.nodeStatus != statusLeader) or (nodeId not in self.senders):
+        return
+      conn = self.senders[nodeId]
+      inFlight = self.inFlight[nodeId]
+      now = time.time()
+      if inFlight and (now - inFlight[0][1] > appendRetryTimeout):
+        # A request or its reply was lost, start again from the last known match.
+        inFlight.clear()
+        self.nextIndex[nodeId] = self.matchIndex[nodeId] + 1
+
+      sent = False
+      while (len(inFlight) < maxAppendsInFlight) and (self.nextIndex[nodeId] <= self.lastIndex()):
+        if self.nextIndex[nodeId] <= self.snapshotIndex:
+          # The entries the follower needs have been replaced by the snapshot.
+          msg = self.newInstallSnapshot()
+          lastIndex = self.snapshotIndex
         else:
-          # for a proper AppendEntries request
-          with self.dataLock:
-            entries = self.log[self.nextIndex[nodeId]:]
-
-        prevLogIndex = self.nextIndex[nodeId] - 1
-        prevLogTerm  = -1
-        if prevLogIndex >= 0:
-          prevLogTerm = self.log[prevLogIndex]['Term']
-
-        self.sendToNode(nodeId, {
-          'Type':         'AppendEntriesRequest',
-          'From':         myNodeId,
-          'Term':         self.currentTerm,
-          'PrevLogIndex': prevLogIndex,
-          'PrevLogTerm':  prevLogTerm,
-          'Entries':      entries,
-          'LeaderCommit': leaderCommit
-        })
+          msg = self.newAppendEntries(self.nextIndex[nodeId])
+          lastIndex = msg['PrevLogIndex'] + len(msg['Entries'])
+        self.nextIndex[nodeId] = lastIndex + 1
+        inFlight.append((lastIndex, now))
+        conn.send(msg)
+        sent = True
+
+      if heartbeat and not sent:
+        # Check from the nextIndex unless requests are in flight, then from the known match.
+        nextIndex = self.matchIndex[nodeId] + 1 if inFlight else self.nextIndex[nodeId]
+        nextIndex = max(nextIndex, self.snapshotIndex + 1)
+        conn.send(self.newAppendEntries(nextIndex, 0))
+
+
+  def newAppendEntries(self, nextIndex, maxEntries=maxEntriesPerAppend):
+    # Creates an AppendEntries request with up to `maxEntries` entries, and up to
+    # `maxBytesPerAppend` bytes of entries, starting at the given index.
+    # The data lock must be held when calling this.
+    entries = []
+    size = 0
+    start = nextIndex - self.snapshotIndex - 1
+    for entry in self.log[start:start+maxEntries]:
+      size += len(json.dumps(entry))
+      if entries and (size > maxBytesPerAppend):
+        break
+      entries.append(entry)
+
+    prevLogIndex = nextIndex - 1
+    prevLogTerm  = self.termAt(prevLogIndex)
+
+    return {
+      'Type':         'AppendEntriesRequest',
+      'From':         myNodeId,
+      'Term':         self.currentTerm,
+      'PrevLogIndex': prevLogIndex,
+      'PrevLogTerm':  prevLogTerm,
+      'Entries':      entries,
+      'LeaderCommit': self.commitIndex
+    }
+
+
+  def newInstallSnapshot(self):
+    # Creates an InstallSnapshot request with this node's snapshot. The state is small
+    # so the whole snapshot is sent in one request instead of in chunks.
+    # The data lock must be held when calling this.
+    return {
+      'Type':              'InstallSnapshotRequest',
+      'From':              myNodeId,
+      'Term':              self.currentTerm,
+      'LastIncludedIndex': self.snapshotIndex,
+      'LastIncludedTerm':  self.snapshotTerm,
+      'State':             self.snapshotState,
+    }
 
 
   def appendEntriesRequest(self, fromNodeId, termNum, prevLogIndex, prevLogTerm, entries, leaderCommit):
@@ -352,87 +467,186 @@ class mainObject:
       # Bump the timer to keep from leader election from being kicked off.
       self.heartbeat()
 
-      # Add and update entries if possible
-      if entries:
+      with self.dataLock:
+        # The entries up to the snapshot are committed so they already match the leader's log.
+        requestPrevLogIndex = prevLogIndex
+        if prevLogIndex < self.snapshotIndex:
+          entries = entries[self.snapshotIndex-prevLogIndex:]
+          prevLogIndex = self.snapshotIndex
+          prevLogTerm  = self.snapshotTerm
+
         # the consistency check (See page 7 paragraph 3 "The second property is guaranteed by...".)
-        lastLogIndex = len(self.log)-1
+        lastLogIndex = self.lastIndex()
         logTermAtPrevLogIndex = -1
-        if (prevLogIndex >= 0) and (prevLogIndex <= lastLogIndex):
-          logTermAtPrevLogIndex = self.log[prevLogIndex]['Term']
+        if prevLogIndex <= lastLogIndex:
+          logTermAtPrevLogIndex = self.termAt(prevLogIndex)
 
-        if logTermAtPrevLogIndex != prevLogTerm: # the consistency check fails
+        conflictTerm  = -1
+        conflictIndex = -1
+        if (prevLogIndex > lastLogIndex) or (logTermAtPrevLogIndex != prevLogTerm): # the consistency check fails
           success = False
+          logIndex = lastLogIndex
+          # Give the leader a hint where the logs stop matching so it can skip back a whole term
+          # at a time (See page 7 and 8, the paragraph under "The leader maintains a nextIndex...").
+          if prevLogIndex > lastLogIndex:
+            conflictIndex = lastLogIndex + 1
+          else:
+            conflictTerm  = logTermAtPrevLogIndex
+            conflictIndex = self.firstIndexOfTerm(conflictTerm)
         else: # the consistency check passes
           success = True
-          # update the local log
-          with self.dataLock:
-            if lastLogIndex != prevLogIndex:
-              del self.log[prevLogIndex+1:]
-            for entry in entries:
-              entry['Committed'] = False
-              self.log.append(entry)
-
-        logIndex = len(self.log)-1
-        self.sendToNode(fromNodeId, {
-          'Type': 'AppendEntriesReply',
-          'From': myNodeId,
-          'Term': self.currentTerm,
-          'Index': logIndex,
-          'Success': success
-        })
-
-      # Update the committed
-      self.commitEntries(leaderCommit)
-
-
-  def appendEntriesReply(self, fromNodeId, termNum, index, success):
-    # This handles an AppendEntries reply from another raft instance.
-    if not success:
-      self.nextIndex[fromNodeId] = max(-1, self.nextIndex[fromNodeId]-1)
-    else:
-      self.nextIndex[fromNodeId] = index + 1
-      self.matchIndex[fromNodeId] = index + 1
-
-    # Update leader commits by checking for a majority.
-    leaderCommit = self.lastCommittedIndex()
-    nextCommit = -1
-    for i in range(leaderCommit, len(self.log)):
-      if not self.hasMajorityMatch(i):
-        break
-      nextCommit = i
+          # Update the local log, skipping entries which are already in the log since the
+          # requests are pipelined and may be resent. Only remove entries which conflict.
+          start = prevLogIndex - self.snapshotIndex
+          for i in range(len(entries)):
+            if start + i >= len(self.log):
+              self.log.extend(entries[i:])
+              break
+            if self.log[start + i]['Term'] != entries[i]['Term']:
+              del self.log[start + i:]
+              self.log.extend(entries[i:])
+              break
+          logIndex = prevLogIndex + len(entries)
+
+      self.sendToNode(fromNodeId, {
+        'Type': 'AppendEntriesReply',
+        'From': myNodeId,
+        'Term': self.currentTerm,
+        'PrevLogIndex': requestPrevLogIndex,
+        'Index': logIndex,
+        'Success': success,
+        'ConflictTerm': conflictTerm,
+        'ConflictIndex': conflictIndex
+      })
+
+      # Update the committed, only up to the entries known to match the leader's log.
+      if success:
+        self.commitEntries(min(leaderCommit, logIndex))
+
+
+  def installSnapshotRequest(self, fromNodeId, termNum, lastIncludedIndex, lastIncludedTerm, state):
+    # This handles an InstallSnapshot Request from the leader, sent when this node
+    # is missing entries which the leader has already replaced with its snapshot.
+    if termNum < self.currentTerm:
+      return
+    if (self.leaderNodeId != fromNodeId) or (termNum > self.currentTerm) or (self.votedFor != -1):
+      self.setAsFollower(fromNodeId, termNum)
+    self.heartbeat()
+
+    changed = None
+    with self.dataLock:
+      if lastIncludedIndex > self.commitIndex:
+        # Keep any entries after the snapshot if the log has the snapshot's last entry,
+        # otherwise the whole log is replaced by the snapshot.
+        if (lastIncludedIndex <= self.lastIndex()) and (self.termAt(lastIncludedIndex) == lastIncludedTerm):
+          del self.log[:lastIncludedIndex-self.snapshotIndex]
+        else:
+          self.log = []
+        self.snapshotIndex = lastIncludedIndex
+        self.snapshotTerm  = lastIncludedTerm
+        self.snapshotState = dict(state)
+        self.appliedState  = dict(state)
+        self.commitIndex   = lastIncludedIndex
+        self.lastApplied   = lastIncludedIndex
+        changed = dict(state)
 
-    if nextCommit > leaderCommit:
-      self.commitEntries(nextCommit)
+    self.sendToNode(fromNodeId, {
+      'Type':  'InstallSnapshotReply',
+      'From':  myNodeId,
+      'Term':  self.currentTerm,
+      'Index': lastIncludedIndex,
+    })
+
+    if changed is not None:
+      self.saveLog()
+      self.updateClientsForNewCommits(changed)
 
 
-  def hasMajorityMatch(self, index):
-    # This checks if the majority of the nodes hav update to the given index.
-    count = 1 # Start at 1 since we know the leader has matched itself.
-    for nodeId in self.matchIndex.keys():
-      if nodeId != myNodeId:
-        if index <= self.matchIndex[nodeId]:
-          count +=1
-    return count >= nodeCount/2
+  def installSnapshotReply(self, fromNodeId, termNum, index):
+    # This handles an InstallSnapshot reply, the follower now has everything up to the index.
+    self.appendEntriesReply(fromNodeId, termNum, index, index, True, -1, -1)
+
+
+  def appendEntriesReply(self, fromNodeId, termNum, prevLogIndex, index, success, conflictTerm, conflictIndex):
+    # This handles an AppendEntries reply from another raft instance.
+    if termNum > self.currentTerm:
+      # The follower has seen a newer term so this node is no longer the leader.
+      self.setAsFollower(-1, termNum)
+      return
+    if (termNum < self.currentTerm) or (self.nodeStatus != statusLeader):
+      # The reply is to a request from an older term.
+      return
+
+    advanced = False
+    with self.dataLock:
+      inFlight = self.inFlight[fromNodeId]
+      if not success:
+        # Replies to other requests which were in flight may fail too,
+        # only back up for the ones from before the nextIndex.
+        if prevLogIndex < self.nextIndex[fromNodeId]:
+          inFlight.clear()
+          # Jump back to just after the leader's last entry in the conflicting term,
+          # if the leader has that term, otherwise to the follower's conflict index.
+          nextIndex = conflictIndex
+          if conflictTerm != -1:
+            lastIndex = self.firstIndexOfTerm(conflictTerm + 1) - 1
+            if (lastIndex >= 0) and (self.termAt(lastIndex) == conflictTerm):
+              nextIndex = lastIndex + 1
+          nextIndex = max(0, min(nextIndex, prevLogIndex))
+          self.nextIndex[fromNodeId] = nextIndex
+          if nextIndex <= self.matchIndex[fromNodeId]:
+            # The follower lost entries it had, such as from restarting.
+            self.matchIndex[fromNodeId] = nextIndex - 1
+      else:
+        while inFlight and (inFlight[0][0] <= index):
+          inFlight.popleft()
+        self.nextIndex[fromNodeId] = max(self.nextIndex[fromNodeId], index + 1)
+        # The commit can only move when a follower's matchIndex advances.
+        if index > self.matchIndex[fromNodeId]:
+          self.matchIndex[fromNodeId] = index
+          advanced = True
+
+    if advanced:
+      self.updateLeaderCommit()
+    # Fill the follower's window of requests in flight.
+    self.replicateTo(fromNodeId, False)
+
+
+  def updateLeaderCommit(self):
+    # Finds the highest index replicated on a majority of the nodes, which is the
+    # majority-th largest matchIndex, counting the leader's own last log index.
+    # The leader only commits entries from its current term by counting replicas,
+    # older entries are committed along with them (See page 8, section 5.4.2).
+    with self.dataLock:
+      matches = [self.lastIndex()]
+      for nodeId in self.senders.keys():
+        if nodeId != myNodeId:
+          matches.append(self.matchIndex[nodeId])
+      majority = nodeCount//2 + 1
+      if len(matches) < majority:
+        return
+      newCommit = heapq.nlargest(majority, matches)[-1]
+      if (newCommit <= self.commitIndex) or (self.termAt(newCommit) != self.currentTerm):
+        return
+    self.commitEntries(newCommit)
 
 
   def commitEntries(self, leaderCommit):
-    # Updates the committed logs up to the leaderCommit.
-    # This is done for all logs.
-    anyNewCommits = False
-    lowestIndex = -1
+    # Updates the commitIndex up to the leaderCommit and applies the newly committed entries.
+    # Only the newly committed entries are looked at. Once enough entries have been
+    # applied they are replaced by a snapshot to keep the log from growing forever.
     with self.dataLock:
-      for i in range(min(len(self.log), leaderCommit+1)):
-        entry = self.log[i]
-        if not entry['Committed']:
-          if lowestIndex < 0:
-            lowestIndex = i
-          anyNewCommits = True
-          entry['Committed'] = True
-
-    # If there are new commits, persist the log and update the clients.
-    if anyNewCommits:
-      self.saveLog()
-      self.updateClientsForNewCommits(lowestIndex)
+      newCommitIndex = min(self.lastIndex(), leaderCommit)
+      if newCommitIndex <= self.commitIndex:
+        return
+      self.commitIndex = newCommitIndex
+      changed = self.applyCommitted()
+      if self.lastApplied - self.snapshotIndex >= snapshotThreshold:
+        self.takeSnapshot()
+
+    # There are new commits, persist the log and update the clients.
+    self.saveLog()
+    self.updateClientsForNewCommits(changed)
 
 
   def heartbeat(self):
@@ -479,10 +693,11 @@ class mainObject:
       self.pendingEvents = []
 
       # Initialize all nextIndex values to the index just after the last one in its log.
-      logLength = len(self.log)
+      logLength = self.lastIndex() + 1
       for nodeId in self.senders.keys():
         self.nextIndex[nodeId]  = logLength
-        self.matchIndex[nodeId] = 0
+        self.matchIndex[nodeId] = -1
+        self.inFlight[nodeId]   = collections.deque()
 
       # Start the leader heartbeat.
       print('%d: %d is now the leader' % (self.currentTerm, myNodeId))
@@ -518,15 +733,18 @@ class mainObject:
       self.receiveMessage(event)
 
 
-  def updateClientsForNewCommits(self, lowestIndex):
+  def updateClientsForNewCommits(self, changed):
     # This updates the connected clients for the state of the game.
+    # The changed are the newest states of the colors which were just committed.
     if len(self.clients) <= 0:
       # No clients so don't bother updating them.
       return
 
-    newRedState, redState = self.getLogNewestValue('Red', lowestIndex)
-    newBlueState, blueState = self.getLogNewestValue('Blue', lowestIndex)
-    
+    newRedState = 'Red' in changed
+    redState = changed.get('Red', stateNeutral)
+    newBlueState = 'Blue' in changed
+    blueState = changed.get('Blue', stateNeutral)
+
     # Check for a game reset in both red and blue to know that no other action
     # has been taken, otherwise treat a `stateStartNewGame` as a `stateNeutral`.
     if redState == stateStartNewGame and blueState == stateStartNewGame:
@@ -607,19 +825,16 @@ class mainObject:
 
 
   def saveLog(self):
-    # Save the log to the file. For debugging the log are JSON'ed
-    # as is including the committed and uncommitted entries.
-    committed = []
+    # Save the snapshot and the committed entries after it to the file.
+    # The snapshot keeps the number of entries written each time bounded.
     with self.dataLock:
-      for entry in self.log:
-        if entry['Committed']:
-          committed.append({
-            'Term':  entry['Term'],
-            'Color': entry['Color'],
-            'State': entry['State']
-          })
-
-    data = json.dumps(committed)  
+      data = json.dumps({
+        'SnapshotIndex': self.snapshotIndex,
+        'SnapshotTerm':  self.snapshotTerm,
+        'State':         self.snapshotState,
+        'Entries':       self.log[:self.commitIndex-self.snapshotIndex],
+      })
+
     f = open(self.__getLogFileName(), 'w')
     f.write(data)
     f.close()
@@ -633,16 +848,26 @@ class mainObject:
       f.close()
 
       if data:
-        termNum = -1
-        log = json.loads(data)
+        data = json.loads(data)
+        if isinstance(data, list):
+          # The file is from before snapshots were added, it only has entries.
+          data = {'SnapshotIndex': -1, 'SnapshotTerm': -1, 'State': {}, 'Entries': data}
+        log = data['Entries']
+        termNum = data['SnapshotTerm']
         for entry in log:
           termNum = max(termNum, entry['Term'])
-          entry['Committed'] = True
 
-        # (Optional) strip out uncommitted values.
+        # Only committed entries are saved so they are all committed and can be applied.
         with self.dataLock:
           self.log = log
-          self.currentTerm = termNum
+          self.currentTerm   = termNum
+          self.snapshotIndex = data['SnapshotIndex']
+          self.snapshotTerm  = data['SnapshotTerm']
+          self.snapshotState = data['State']
+          self.appliedState  = dict(self.snapshotState)
+          self.lastApplied   = self.snapshotIndex
+          self.commitIndex   = self.lastIndex()
+          self.applyCommitted()
     except Exception as e:
       print('Failed to load from log file: %s' % (e))
 
@@ -716,7 +941,13 @@ class mainObject:
     elif msgType == 'AppendEntriesRequest':
       self.appendEntriesRequest(msg['From'], msg['Term'], msg['PrevLogIndex'], msg['PrevLogTerm'], msg['Entries'], msg['LeaderCommit'])
     elif msgType == 'AppendEntriesReply':
-      self.appendEntriesReply(msg['From'], msg['Term'], msg['Index'], msg['Success'])
+      self.appendEntriesReply(msg['From'], msg['Term'], msg['PrevLogIndex'], msg['Index'], msg['Success'], msg['ConflictTerm'], msg['ConflictIndex'])
+
+    # Handle Raft Messages for InstallSnapshot
+    elif msgType == 'InstallSnapshotRequest':
+      self.installSnapshotRequest(msg['From'], msg['Term'], msg['LastIncludedIndex'], msg['LastIncludedTerm'], msg['State'])
+    elif msgType == 'InstallSnapshotReply':
+      self.installSnapshotReply(msg['From'], msg['Term'], msg['Index'])
 
     # Handle unknown messages
     else:
@@ -732,6 +963,9 @@ class mainObject:
       print('  Status:     %s' % (self.nodeStatus))
       print('  Leader Id:  %d' % (self.leaderNodeId))
       print('  Term Num:   %d' % (self.currentTerm))
+      print('  Committed:  %d' % (self.commitIndex))
+      print('  Applied:    %d' % (self.lastApplied))
+      print('  Snapshot:   %d' % (self.snapshotIndex))
       print('  Timeout:    %0.5fs' % (self.leaderTimeout.timeLeft()))
       if self.clients:
         print('  Client(s): ', ', '.join(self.clients.keys()))
@@ -744,11 +978,14 @@ class mainObject:
     # Prints the log in this node.
     with self.dataLock:
       print('Log:')
-      for entry in self.log:
+      if self.snapshotIndex >= 0:
+        print('   [X] %d: snapshot up to %d, %s'%(self.snapshotTerm, self.snapshotIndex, self.snapshotState))
+      for i in range(len(self.log)):
+        entry = self.log[i]
         term  = entry['Term']
         color = entry['Color']
         state = entry['State']
-        check = 'X' if entry['Committed'] else ' '
+        check = 'X' if self.snapshotIndex+1+i <= self.commitIndex else ' '
         print('   [%s] %d: %s <- %s'%(check, term, color, state))
 
 
@@ -764,7 +1001,10 @@ class mainObject:
 
   def main(self):
     # Setup the listener to start watching for incoming messages.
-    self.listener = connections.listener(self.receiveMessage, nodeIdToURL[myNodeId], useMyHost)
+    if useSelectorListener:
+      self.listener = connections.selectorListener(self.receiveMessage, nodeIdToURL[myNodeId], useMyHost)
+    else:
+      self.listener = connections.listener(self.receiveMessage, nodeIdToURL[myNodeId], useMyHost)
 
     # Setup the collection of connections to talk to the other instances.
     for nodeId, hostAndPort in nodeIdToURL.items():
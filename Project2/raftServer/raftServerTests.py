@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+# Grant Nelson and John M. Singleton
+# CSCI 520 - Distributed Systems
+# Project 2 (Consensus Project)
+# due Apr 6, 2020 by 11:59 PM
+
+# To run the unit-test:
+# - In console 1 call "python -m unittest -v raftServerTests"
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+import connections
+
+# The raft server reads its node Id and the node count from the command line
+# when it is imported, the tests run it as node 0 of 3 unless a test changes it.
+savedArgv = sys.argv
+sys.argv = ['main.py', '0', '3']
+import main
+sys.argv = savedArgv
+
+
+class fakeSender:
+  # This records the messages sent to another node instead of sending them.
+
+  def __init__(self):
+    self.sent = []
+
+
+  def send(self, message):
+    # Copies the message the same as sending it would so later changes don't show up in it.
+    self.sent.append(json.loads(json.dumps(message)))
+
+
+  def take(self):
+    # Gets and clears the messages which have been sent.
+    sent = self.sent
+    self.sent = []
+    return sent
+
+
+class fakeTimer:
+  # This stands in for a customTimer so that no timeouts go off during a test.
+
+  def start(self, duration):
+    pass
+
+
+  def stop(self):
+    pass
+
+
+  def timeLeft(self):
+    return -1.0
+
+
+def newEntry(termNum, state):
+  # Creates a log entry setting red to the given state.
+  return {'Term': termNum, 'Color': 'Red', 'State': state}
+
+
+class TestRaftServer(unittest.TestCase):
+
+  def setUp(self):
+    # The log files are written into a temporary folder.
+    self.oldDir = os.getcwd()
+    self.tempDir = tempfile.mkdtemp()
+    os.chdir(self.tempDir)
+
+
+  def tearDown(self):
+    os.chdir(self.oldDir)
+    shutil.rmtree(self.tempDir)
+
+
+  def newNode(self, nodeIds, termNum=0, log=None):
+    # Creates a raft node, without a listener or timers, with senders
+    # which record the messages sent to the given node Ids.
+    o = main.mainObject()
+    o.leaderTimeout     = fakeTimer()
+    o.leaderHeartbeat   = fakeTimer()
+    o.electionHeartbeat = fakeTimer()
+    for nodeId in nodeIds:
+      o.senders[nodeId] = fakeSender()
+    o.currentTerm = termNum
+    o.log = log if log else []
+    return o
+
+
+  def getFreeHostAndPort(self):
+    # Gets a local host and port which nothing is listening on.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    hostAndPort = 'localhost:%d' % (sock.getsockname()[1])
+    sock.close()
+    return hostAndPort
+
+
+  def connectTo(self, hostAndPort):
+    # Connects a plain socket to the given host and port once something is listening on it.
+    parts = hostAndPort.split(':')
+    deadline = time.time() + 10.0
+    while True:
+      try:
+        return socket.create_connection((parts[0], int(parts[1])))
+      except socket.error:
+        if time.time() > deadline:
+          raise
+        time.sleep(0.05)
+
+
+  def waitFor(self, received, count):
+    # Waits until the given number of messages have been received.
+    deadline = time.time() + 20.0
+    while (len(received) < count) and (time.time() < deadline):
+      time.sleep(0.05)
+
+
+  def checkLargeAppends(self, newListener):
+    # Sends several AppendEntries, each larger than one read from the socket,
+    # back to back and checks that every one of them is handled whole.
+    received = []
+    hostAndPort = self.getFreeHostAndPort()
+    inc = newListener(lambda msg, conn: received.append(msg), hostAndPort, True)
+    messages = []
+    for i in range(5):
+      entries = [{'Term': 1, 'Color': 'Red', 'State': 'neutral %d.%d' % (i, j)} for j in range(100)]
+      messages.append({
+        'Type': 'AppendEntriesRequest',
+        'From': 0,
+        'Term': 1,
+        'PrevLogIndex': i*100,
+        'PrevLogTerm': 1,
+        'Entries': entries,
+        'LeaderCommit': 0,
+      })
+    data = ''.join(json.dumps(msg)+'#' for msg in messages)
+    self.assertGreater(len(data)//len(messages), 4096)
+
+    sock = self.connectTo(hostAndPort)
+    try:
+      sock.sendall(data.encode())
+      self.waitFor(received, len(messages))
+    finally:
+      sock.close()
+      inc.close()
+    self.assertEqual(received, messages)
+
+
+  def test_listenerLargeAppends(self):
+    self.checkLargeAppends(connections.listener)
+
+
+  def test_selectorListenerLargeAppends(self):
+    self.checkLargeAppends(connections.selectorListener)
+
+
+  def test_followerCommit(self):
+    # Tests that a follower only commits and applies the entries which the
+    # leader has committed and that it has, and saves the committed entries.
+    o = self.newNode([1, 2])
+    o.appendEntriesRequest(1, 1, -1, -1, [newEntry(1, 'a'), newEntry(1, 'b'), newEntry(1, 'c')], -1)
+    self.assertEqual(o.senders[1].take(), [{'Type': 'AppendEntriesReply', 'From': 0, 'Term': 1,
+      'PrevLogIndex': -1, 'Index': 2, 'Success': True, 'ConflictTerm': -1, 'ConflictIndex': -1}])
+    self.assertEqual((o.commitIndex, o.lastApplied), (-1, -1))
+    self.assertEqual(o.getLogValue('Red'), main.stateNeutral)
+
+    o.appendEntriesRequest(1, 1, 2, 1, [], 1)
+    self.assertEqual((o.commitIndex, o.lastApplied), (1, 1))
+    self.assertEqual(o.getLogValue('Red'), 'b')
+
+    # The commit only goes as far as the entries known to match the leader's log.
+    o.appendEntriesRequest(1, 1, 0, 1, [], 5)
+    self.assertEqual((o.commitIndex, o.lastApplied), (1, 1))
+    o.appendEntriesRequest(1, 1, 2, 1, [], 5)
+    self.assertEqual((o.commitIndex, o.lastApplied), (2, 2))
+    self.assertEqual(o.getLogValue('Red'), 'c')
+
+    o2 = self.newNode([1, 2])
+    o2.loadLog()
+    self.assertEqual(o2.log, o.log)
+    self.assertEqual((o2.commitIndex, o2.lastApplied, o2.currentTerm), (2, 2, 1))
+    self.assertEqual(o2.getLogValue('Red'), 'c')
+
+
+  def newLeader(self, nodeIds, termNum, log):
+    # Creates a raft node which has just become the leader for the given term.
+    o = self.newNode(nodeIds, termNum, log)
+    o.setAsLeader()
+    return o
+
+
+  def successReply(self, fromNodeId, termNum, index):
+    # Creates a successful AppendEntries reply from the given follower.
+    return {'Type': 'AppendEntriesReply', 'From': fromNodeId, 'Term': termNum,
+      'PrevLogIndex': index, 'Index': index, 'Success': True, 'ConflictTerm': -1, 'ConflictIndex': -1}
+
+
+  def exchange(self, leader, follower, followerId):
+    # Passes the messages between the leader (node 0) and the follower until neither
+    # has anything more to send. The follower's replies are sent to the leader as if
+    # from the given node Id. Returns the requests which the follower was sent.
+    requests = []
+    toFollower = leader.senders[followerId]
+    toLeader = follower.senders[0]
+    while toFollower.sent or toLeader.sent:
+      for msg in toFollower.take():
+        requests.append(msg)
+        follower.receiveMessage(msg, None)
+      for msg in toLeader.take():
+        msg['From'] = followerId
+        leader.receiveMessage(msg, None)
+    return requests
+
+
+  def test_leaderCommit(self):
+    # Tests that the leader commits the index which a majority of the nodes have,
+    # and only by counting replicas of an entry from its current term.
+    oldNodeCount = main.nodeCount
+    main.nodeCount = 5
+    self.addCleanup(setattr, main, 'nodeCount', oldNodeCount)
+
+    o = self.newLeader([1, 2, 3, 4], 2, [newEntry(1, 'a'), newEntry(1, 'b'), newEntry(2, 'c'), newEntry(2, 'd')])
+    o.receiveMessage(self.successReply(1, 2, 1), None)
+    self.assertEqual(o.commitIndex, -1)
+
+    # A majority has index 1 but it is from an older term so it can't be committed yet.
+    o.receiveMessage(self.successReply(2, 2, 1), None)
+    self.assertEqual(o.commitIndex, -1)
+    o.receiveMessage(self.successReply(3, 2, 3), None)
+    self.assertEqual(o.commitIndex, -1)
+
+    # Once a majority has an entry from this term, it and the entries before it are committed.
+    o.receiveMessage(self.successReply(2, 2, 2), None)
+    self.assertEqual((o.commitIndex, o.lastApplied), (2, 2))
+    self.assertEqual(o.getLogValue('Red'), 'c')
+    o.receiveMessage(self.successReply(4, 2, 3), None)
+    self.assertEqual((o.commitIndex, o.lastApplied), (3, 3))
+    self.assertEqual(o.getLogValue('Red'), 'd')
+
+    # A reply from an older term doesn't change anything.
+    o.receiveMessage(self.successReply(1, 1, 3), None)
+    self.assertEqual(o.matchIndex[1], 1)
+
+
+  def test_pipelining(self):
+    # Tests that the leader sends batches of entries without waiting for replies,
+    # up to the window of requests in flight, and fills the window as replies come.
+    o = self.newLeader([1, 2], 1, [])
+    o.log.extend([newEntry(1, str(i)) for i in range(300)])
+    o.replicateTo(1, False)
+    sent = o.senders[1].take()
+    self.assertEqual(len(sent), main.maxAppendsInFlight)
+    self.assertEqual([msg['PrevLogIndex'] for msg in sent], [-1, 63, 127, 191])
+    self.assertEqual([len(msg['Entries']) for msg in sent], [64, 64, 64, 64])
+    self.assertEqual(o.nextIndex[1], 256)
+
+    # The window is full, a heartbeat only checks from the known match.
+    o.replicateTo(1, False)
+    self.assertEqual(o.senders[1].take(), [])
+    o.replicateTo(1, True)
+    sent = o.senders[1].take()
+    self.assertEqual([(msg['PrevLogIndex'], msg['Entries']) for msg in sent], [(-1, [])])
+
+    # Each reply lets another request be sent.
+    o.receiveMessage(self.successReply(1, 1, 63), None)
+    sent = o.senders[1].take()
+    self.assertEqual([(msg['PrevLogIndex'], len(msg['Entries'])) for msg in sent], [(255, 44)])
+    self.assertEqual((o.matchIndex[1], o.nextIndex[1]), (63, 300))
+    o.addNewLogEntry('Red', 'new')
+    self.assertEqual(o.senders[1].take(), [])
+    o.receiveMessage(self.successReply(1, 1, 127), None)
+    sent = o.senders[1].take()
+    self.assertEqual([(msg['PrevLogIndex'], msg['Entries']) for msg in sent], [(299, [newEntry(1, 'new')])])
+
+    # If no reply comes in time the leader starts again from the known match.
+    o.inFlight[1][0] = (o.inFlight[1][0][0], time.time() - main.appendRetryTimeout - 1.0)
+    o.replicateTo(1, False)
+    sent = o.senders[1].take()
+    self.assertEqual([(msg['PrevLogIndex'], len(msg['Entries'])) for msg in sent], [(127, 64), (191, 64), (255, 45)])
+
+
+  def test_appendBatchSize(self):
+    # Tests that a batch of entries is cut short to keep it under the byte limit,
+    # and that a follower skips entries it already has when a request is resent.
+    o = self.newLeader([1, 2], 1, [])
+    o.log.extend([newEntry(1, str(i) * 20000) for i in range(5)])
+    o.replicateTo(1, False)
+    sent = o.senders[1].take()
+    self.assertEqual([len(msg['Entries']) for msg in sent], [3, 2])
+
+    f = self.newNode([1, 2])
+    for msg in sent + sent:
+      f.appendEntriesRequest(1, msg['Term'], msg['PrevLogIndex'], msg['PrevLogTerm'], msg['Entries'], msg['LeaderCommit'])
+    self.assertEqual(f.log, o.log)
+    self.assertEqual([msg['Index'] for msg in f.senders[1].take()], [2, 4, 2, 4])
+
+
+  def test_conflictBacktracking(self):
+    # Tests that a follower with extra entries from an old term has them replaced,
+    # with the leader skipping back over the whole conflicting term at once.
+    leader = self.newLeader([1, 2], 3, [newEntry(1, 'a'), newEntry(1, 'b')] +
+      [newEntry(3, 'c%d' % i) for i in range(4)])
+    follower = self.newNode([0], 2, [newEntry(1, 'a'), newEntry(1, 'b')] +
+      [newEntry(2, 'x%d' % i) for i in range(5)])
+
+    follower.appendEntriesRequest(0, 3, 5, 3, [], -1)
+    reply = follower.senders[0].take()[0]
+    self.assertEqual((reply['Success'], reply['Index'], reply['ConflictTerm'], reply['ConflictIndex']), (False, 6, 2, 2))
+
+    leader.replicateTo(1, True)
+    requests = self.exchange(leader, follower, 1)
+    self.assertEqual([(msg['PrevLogIndex'], len(msg['Entries'])) for msg in requests], [(5, 0), (1, 4)])
+    self.assertEqual(follower.log, leader.log)
+    self.assertEqual((leader.matchIndex[1], leader.nextIndex[1], leader.commitIndex), (5, 6, 5))
+
+    leader.replicateTo(1, True)
+    self.exchange(leader, follower, 1)
+    self.assertEqual(follower.commitIndex, 5)
+    self.assertEqual(follower.getLogValue('Red'), 'c3')
+
+
+  def test_missingEntries(self):
+    # Tests that a follower missing entries has the leader jump back to the end of its log.
+    leader = self.newLeader([1, 2], 3, [newEntry(1, 'a'), newEntry(1, 'b')] +
+      [newEntry(3, 'c%d' % i) for i in range(8)])
+    follower = self.newNode([0], 1, [newEntry(1, 'a'), newEntry(1, 'b')])
+    leader.replicateTo(1, True)
+    requests = self.exchange(leader, follower, 1)
+    self.assertEqual([(msg['PrevLogIndex'], len(msg['Entries'])) for msg in requests], [(9, 0), (1, 8)])
+    self.assertEqual(follower.log, leader.log)
+
+    # A reply which fails with a conflicting term the leader also has goes back to
+    # just after the leader's last entry in that term.
+    leader.receiveMessage({'Type': 'AppendEntriesReply', 'From': 2, 'Term': 3, 'PrevLogIndex': 9,
+      'Index': 9, 'Success': False, 'ConflictTerm': 1, 'ConflictIndex': 0}, None)
+    self.assertEqual(leader.senders[2].take()[0]['PrevLogIndex'], 1)
+
+
+  def test_installSnapshot(self):
+    # Tests that a follower behind the leader's snapshot is sent the snapshot
+    # and then the entries after it.
+    leader = self.newNode([1, 2], 2, [newEntry(2, 'x'), newEntry(2, 'y')])
+    leader.snapshotIndex = 9
+    leader.snapshotTerm  = 1
+    leader.snapshotState = {'Red': 'r9', 'Blue': 'b9'}
+    leader.appliedState  = dict(leader.snapshotState)
+    leader.commitIndex   = 9
+    leader.lastApplied   = 9
+    leader.setAsLeader()
+    follower = self.newNode([0], 1, [newEntry(1, 'a'), newEntry(1, 'b')])
+
+    leader.replicateTo(1, True)
+    requests = self.exchange(leader, follower, 1)
+    self.assertEqual([msg['Type'] for msg in requests],
+      ['AppendEntriesRequest', 'InstallSnapshotRequest', 'AppendEntriesRequest'])
+    self.assertEqual((follower.snapshotIndex, follower.snapshotTerm), (9, 1))
+    self.assertEqual(follower.log, leader.log)
+    self.assertEqual((leader.matchIndex[1], leader.commitIndex), (11, 11))
+
+    leader.replicateTo(1, True)
+    self.exchange(leader, follower, 1)
+    self.assertEqual((follower.commitIndex, follower.lastApplied), (11, 11))
+    self.assertEqual(follower.getLogValue('Red'), 'y')
+    self.assertEqual(follower.getLogValue('Blue'), 'b9')
+
+    # A snapshot older than what the follower has committed is ignored.
+    follower.installSnapshotRequest(0, 2, 5, 1, {'Red': 'old'})
+    self.assertEqual((follower.snapshotIndex, follower.commitIndex), (9, 11))
+    self.assertEqual(follower.senders[0].take()[0]['Index'], 5)
+
+
+  def test_takeSnapshot(self):
+    # Tests that the applied entries are replaced by a snapshot, and that it is saved and reloaded.
+    oldThreshold = main.snapshotThreshold
+    main.snapshotThreshold = 4
+    self.addCleanup(setattr, main, 'snapshotThreshold', oldThreshold)
+
+    o = self.newNode([1, 2])
+    entries = [newEntry(1, str(i)) for i in range(6)]
+    o.appendEntriesRequest(1, 1, -1, -1, entries, 2)
+    self.assertEqual((o.snapshotIndex, len(o.log)), (-1, 6))
+    o.appendEntriesRequest(1, 1, 5, 1, [], 4)
+    self.assertEqual((o.snapshotIndex, o.snapshotTerm, o.snapshotState), (4, 1, {'Red': '4'}))
+    self.assertEqual(o.log, entries[5:])
+    self.assertEqual(o.lastIndex(), 5)
+
+    o.appendEntriesRequest(1, 1, 5, 1, [], 5)
+    o2 = self.newNode([1, 2])
+    o2.loadLog()
+    self.assertEqual((o2.snapshotIndex, o2.snapshotTerm, o2.commitIndex, o2.lastApplied), (4, 1, 5, 5))
+    self.assertEqual(o2.log, entries[5:])
+    self.assertEqual(o2.getLogValue('Red'), '5')
+
+
+if __name__ == '__main__':
+  unittest.main()